@@ -0,0 +1,130 @@
+"""Seeded generators for synthetic SharePoint lists.
+
+`generate_lists` builds all ten lists the job reads, sized from the number of
+products. `apply_churn` then edits, adds and removes a share of the records, as
+SharePoint users would between two runs.
+"""
+
+import random
+
+people_lists = {
+  'Service Owners': 'ServiceOwnerName',
+  'Product Managers': 'ProductManagerName',
+  'Delivery Managers': 'DeliveryManagerName',
+  'Lead Developers': 'Title',
+  'Technical Architects': 'TechnicalArchitectName',
+  'Principal Technical Architect': 'PrincipalTechnicalArchitectName',
+}
+
+# Teams no product references, removed by apply_churn to exercise the deletion pass
+orphan_teams = 5
+
+
+def item(item_id, **fields):
+  return {'id': str(item_id), 'fields': fields}
+
+
+def product_id(number):
+  # ProductIDs must match ^[A-Z]{3,5}[0-9]{0,5}$
+  return f'PR{chr(65 + number // 100000)}{number % 100000:05d}'
+
+
+def product_item(rng, number, counts):
+  fields = {
+    'ProductID': product_id(number),
+    'Product': f'Product {number}',
+    'ProductType': 'Product',
+    'Description_x0028_SourceData_x00': f'Description of product {number} &amp; more',
+    'field_7': rng.choice(['Discovery', 'Alpha', 'Beta', 'Live']),
+    'Portfolio': rng.choice(['Prisons', 'Probation', 'Youth Custody']),
+    'HMPPSBusinessOwner': f'Owner {rng.randrange(50)}',
+    'DecommissionedProduct': rng.choice(['No'] * 9 + ['Yes']),
+    'TeamLookupId': str(rng.randrange(1, counts['Teams'] + 1)),
+    'ProductSetLookupId': str(rng.randrange(1, counts['Product Set'] + 1)),
+    'ServiceAreaLookupId': str(rng.randrange(1, counts['Service Areas'] + 1)),
+    'ProductManagerLookupId': str(rng.randrange(1, counts['people'] + 1)),
+    'DeliveryManagerLookupId': str(rng.randrange(1, counts['people'] + 1)),
+    'LeadDeveloperLookupId': str(rng.randrange(1, counts['people'] + 1)),
+  }
+  if number > 1 and rng.random() < 0.2:
+    fields['ProductType'] = 'SubProduct'
+    fields['ParentProductLookupId'] = str(rng.randrange(1, number))
+  return item(number, **fields)
+
+
+def generate_lists(products, seed=1):
+  rng = random.Random(seed)
+  counts = {
+    'Teams': max(10, products // 20),
+    'Product Set': max(5, products // 50),
+    'Service Areas': 12,
+    'people': max(20, products // 25),
+  }
+  lists = {
+    'Teams': [
+      item(i, TeamID=f'TM{i:05d}', Team=f'Team {i}', BudgetCode=f'B{i % 97}')
+      for i in range(1, counts['Teams'] + orphan_teams + 1)
+    ],
+    'Product Set': [
+      item(
+        i,
+        ProductSetID=f'PS{i:05d}',
+        ProductSet=f'Product Set {i}',
+        LeadDeveloperLookupId=str(rng.randrange(1, counts['people'] + 1)),
+      )
+      for i in range(1, counts['Product Set'] + 1)
+    ],
+    'Service Areas': [
+      item(
+        i,
+        ServiceAreaID=f'SA{i:03d}',
+        ServiceArea=f'Service Area {i}',
+        ServiceOwnerLookupId=str(i),
+      )
+      for i in range(1, counts['Service Areas'] + 1)
+    ],
+    'Products and Teams Main List': [
+      product_item(rng, number, counts) for number in range(1, products + 1)
+    ],
+  }
+  for list_name, column in people_lists.items():
+    lists[list_name] = [
+      item(i, **{column: f'{list_name} person {i}', 'ServiceOwnerLookupId': str(i)})
+      for i in range(1, counts['people'] + 1)
+    ]
+  return lists
+
+
+def apply_churn(lists, churn, seed=1):
+  if not churn:
+    return lists
+  rng = random.Random(seed + 1)
+  lists = {name: list(items) for name, items in lists.items()}
+
+  for list_name, column in (('Teams', 'Team'), ('Product Set', 'ProductSet')):
+    items = lists[list_name]
+    for index in rng.sample(range(len(items)), int(len(items) * churn)):
+      changed = item(items[index]['id'], **items[index]['fields'])
+      changed['fields'][column] = f'{changed["fields"][column]} (renamed)'
+      items[index] = changed
+
+  products = lists['Products and Teams Main List']
+  counts = {
+    'Teams': len(lists['Teams']) - orphan_teams,
+    'Product Set': len(lists['Product Set']),
+    'Service Areas': len(lists['Service Areas']),
+    'people': len(lists['Product Managers']),
+  }
+  changes = int(len(products) * churn)
+  for index in rng.sample(range(len(products)), changes):
+    changed = item(products[index]['id'], **products[index]['fields'])
+    changed['fields']['field_7'] = rng.choice(['Alpha', 'Beta', 'Live', 'Retired'])
+    changed['fields']['TeamLookupId'] = str(rng.randrange(1, counts['Teams'] + 1))
+    products[index] = changed
+  next_number = len(products) + 1
+  for number in range(next_number, next_number + max(1, changes // 2)):
+    products.append(product_item(rng, number, counts))
+
+  removed = min(orphan_teams, max(1, int(orphan_teams * churn * 10)))
+  lists['Teams'] = lists['Teams'][: len(lists['Teams']) - removed]
+  return lists
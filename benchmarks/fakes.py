@@ -0,0 +1,105 @@
+"""In-memory stand-ins for SharePoint and the Service Catalogue.
+
+They expose the same surface the processes use (`data`/`dict` for SharePoint,
+`get_all_records`/`add`/`update`/`delete` for the catalogue) and count every call
+so benchmark runs can report API usage without touching a live service.
+"""
+
+import itertools
+import threading
+from collections import Counter
+
+relations = {
+  'parent': 'products',
+  'team': 'teams',
+  'product_set': 'product-sets',
+  'service_area': 'service-areas',
+}
+
+
+class InMemorySharePoint:
+  def __init__(self, lists):
+    self.lists = lists
+    self.data = {}
+    self.dict = {}
+    self.calls = Counter()
+    self.connection_ok = True
+
+  def load_sharepoint_lists(self, list_names):
+    for list_name in list_names:
+      self.calls['list_load'] += 1
+      items = self.lists[list_name]
+      self.data[list_name] = {'value': items}
+      self.dict[list_name] = {item['id']: item for item in items}
+
+  def iter_list_pages(self, list_name, page_size=200):
+    items = self.data[list_name].get('value', [])
+    for start in range(0, len(items), page_size):
+      yield items[start : start + page_size]
+
+
+class InMemoryServiceCatalogue:
+  def __init__(self, tables=None):
+    self.tables = tables or {
+      'teams': {},
+      'product-sets': {},
+      'service-areas': {},
+      'products': {},
+    }
+    self.calls = Counter()
+    self.connection_ok = True
+    self._ids = itertools.count(1)
+    self._lock = threading.Lock()
+
+  def _collection(self, table):
+    return table.split('?')[0]
+
+  def _populate(self, record):
+    record = dict(record)
+    for key, collection in relations.items():
+      if document_id := record.get(key):
+        related = self.tables[collection].get(document_id)
+        record[key] = (
+          {'documentId': document_id, 'name': related.get('name')} if related else None
+        )
+      else:
+        record[key] = None
+    return record
+
+  def get_all_records(self, table):
+    collection = self._collection(table)
+    with self._lock:
+      self.calls['get_all_records'] += 1
+      records = list(self.tables[collection].values())
+    if collection == 'products':
+      return [self._populate(record) for record in records]
+    return [dict(record) for record in records]
+
+  def get_all(self, table, fields=None, populate=None):
+    records = self.get_all_records(table)
+    if fields is None:
+      return records
+    keep = {'id', 'documentId', *fields, *(populate or {})}
+    return [{key: value for key, value in record.items() if key in keep} for record in records]
+
+  def add(self, table, data):
+    with self._lock:
+      self.calls['add'] += 1
+      record = {**data, 'documentId': f'doc{next(self._ids)}'}
+      self.tables[self._collection(table)][record['documentId']] = record
+    return {'data': dict(record)}
+
+  def update(self, table, document_id, data):
+    with self._lock:
+      self.calls['update'] += 1
+      record = self.tables[self._collection(table)][document_id]
+      record.update(data)
+    return {'data': dict(record)}
+
+  def delete(self, table, document_id):
+    with self._lock:
+      self.calls['delete'] += 1
+      self.tables[self._collection(table)].pop(document_id, None)
+
+  def update_scheduled_job(self, status):
+    self.calls['update_scheduled_job'] += 1
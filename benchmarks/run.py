@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+"""Offline benchmark for the discovery processes.
+
+Each scenario generates a seeded SharePoint dataset and syncs it once into an empty
+in-memory Service Catalogue. It then applies a share of churn to the SharePoint side
+and times a second, measured sync. Scenarios run in separate processes so that
+peak memory is reported per scenario.
+
+  uv run python -m benchmarks.run --sizes 1000,10000 --churn 0.01 \\
+    --output bench.json --baseline previous.json --max-regression 0.25
+
+Results are written as JSON. With --baseline, the run fails if any scenario's API
+call count has grown by more than --max-regression. Wall time depends on the runner,
+so changes in it are reported but never fail the run.
+"""
+
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+def peak_rss_mb():
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # ru_maxrss is in bytes on macOS and kilobytes on Linux
+  return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def sync(lists, sc, state, workers):
+  from benchmarks.fakes import InMemorySharePoint
+  from includes.catalogue import CatalogueSnapshot
+  from includes.catalogue_writer import CatalogueWriter
+  from includes.scheduler import run_phases
+  from includes.selection import everything
+  from includes.xref import CrossReference
+  from sharepoint_discovery import build_phases, missing_links, sp_lists
+
+  class Services:
+    pass
+
+  services = Services()
+  services.sp = InMemorySharePoint(lists)
+  services.sc = CatalogueSnapshot(sc, api=sc)
+  services.writer = CatalogueWriter(services.sc, api=sc, workers=workers, rate=0)
+  services.state = state
+  services.xref = CrossReference(state)
+  services.selection = everything
+
+  start = time.perf_counter()
+  services.sp.load_sharepoint_lists(sp_lists)
+  # The phases and dependencies the job itself runs
+  phases = build_phases(
+    selection=services.selection,
+    links=missing_links(services, services.selection),
+  )
+  run_phases(services, phases)
+  services.writer.close()
+  return {
+    'total_seconds': round(time.perf_counter() - start, 3),
+    'phases': {
+      phase.name: {'seconds': round(phase.duration, 3), 'status': phase.status}
+      for phase in phases
+    },
+    'api_calls': dict(services.sp.calls) | dict(sc.calls),
+  }
+
+
+def run_scenario(scenario):
+  from benchmarks.datasets import apply_churn, generate_lists
+  from benchmarks.fakes import InMemoryServiceCatalogue
+  from includes.state import StateStore
+
+  size, churn, seed, workers, verbose = scenario
+  with tempfile.TemporaryDirectory() as directory:
+    state = StateStore(os.path.join(directory, 'state.db'))
+    sc = InMemoryServiceCatalogue()
+    # The service areas process will not run against an empty collection, and
+    # catalogue-only 'SP' service areas are never deleted
+    sc.add('service-areas', {'sa_id': 'SP001', 'name': 'Catalogue only'})
+    lists = generate_lists(size, seed)
+    output = contextlib.nullcontext() if verbose else open(os.devnull, 'w')
+    with output as devnull, contextlib.redirect_stdout(devnull or sys.stdout):
+      initial = sync(lists, sc, state, workers)
+      sc.calls.clear()
+      measured = sync(apply_churn(lists, churn, seed), sc, state, workers)
+    state.close()
+  return {
+    'size': size,
+    'churn': churn,
+    'seed': seed,
+    'initial_sync_seconds': initial['total_seconds'],
+    **measured,
+    'peak_rss_mb': peak_rss_mb(),
+  }
+
+
+def compare(results, baseline, max_regression):
+  """API call regressions, and the change in time of every scenario in the baseline."""
+  previous = {(s['size'], s['churn']): s for s in baseline.get('scenarios', [])}
+  regressions, timings = [], []
+  for scenario in results['scenarios']:
+    if not (before := previous.get((scenario['size'], scenario['churn']))):
+      continue
+    name = f'size={scenario["size"]} churn={scenario["churn"]}'
+    old, new = sum(before['api_calls'].values()), sum(scenario['api_calls'].values())
+    if old and new > old * (1 + max_regression):
+      regressions.append(f'{name} api_calls: {old} -> {new}')
+    old, new = before['total_seconds'], scenario['total_seconds']
+    change = f' ({(new - old) / old:+.0%})' if old else ''
+    timings.append(f'{name} total_seconds: {old} -> {new}{change}')
+  return regressions, timings
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--sizes', default='1000,10000,100000')
+  parser.add_argument('--churn', default='0.01')
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--workers', type=int, default=4)
+  parser.add_argument('--output', default='bench_output.json')
+  parser.add_argument('--baseline')
+  parser.add_argument('--max-regression', type=float, default=0.25)
+  parser.add_argument('--verbose', action='store_true')
+  args = parser.parse_args()
+
+  scenarios = [
+    (int(size), float(churn), args.seed, args.workers, args.verbose)
+    for size in args.sizes.split(',')
+    for churn in args.churn.split(',')
+  ]
+  results = {
+    'timestamp': datetime.now(timezone.utc).isoformat(),
+    'python': platform.python_version(),
+    'scenarios': [],
+  }
+  context = multiprocessing.get_context('spawn')
+  for scenario in scenarios:
+    with context.Pool(1) as pool:
+      result = pool.apply(run_scenario, (scenario,))
+    results['scenarios'].append(result)
+    print(
+      f'size={result["size"]} churn={result["churn"]}: {result["total_seconds"]}s '
+      f'(initial {result["initial_sync_seconds"]}s), '
+      f'{sum(result["api_calls"].values())} API calls, {result["peak_rss_mb"]} MB peak'
+    )
+    for name, phase in result['phases'].items():
+      print(f'  {name}: {phase["seconds"]}s {phase["status"]}')
+
+  with open(args.output, 'w') as f:
+    json.dump(results, f, indent=2)
+  print(f'Results written to {args.output}')
+
+  if args.baseline:
+    with open(args.baseline) as f:
+      regressions, timings = compare(results, json.load(f), args.max_regression)
+    for timing in timings:
+      print(f'Timing: {timing}')
+    for regression in regressions:
+      print(f'Regression: {regression}')
+    if regressions:
+      raise SystemExit(1)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,615 @@
+#!/usr/bin/env python
+"""Local HTTP stand-in for Microsoft Graph and the Service Catalogue (Strapi).
+
+Serves the Graph site, list and list item endpoints (paged with @odata.nextLink,
+plus delta queries) under /graph/v1.0, and the Strapi collection endpoints used by
+ServiceCatalogue under /sc. Lists are generated with benchmarks.datasets. Each
+backend can be given latency, jitter, a share of 429 responses with Retry-After,
+and a share of 503 errors, so concurrency and retry settings can be tuned against
+realistic network conditions.
+
+  uv run python -m benchmarks.standin --products 1000 --graph-latency 0.05 \\
+    --sc-latency 0.02 --sc-throttle 0.05 --run-job --churn 0.01
+
+With --run-job, sharepoint_discovery.main() is run end to end against the stand-in
+(once to populate the catalogue, then again after any --churn) and the timings and
+request counts are printed. With --watch PORT, the job runs in watch mode with its
+notification receiver on PORT, and the sync triggered by the --churn notifications
+is timed. Without either, the server runs until interrupted and prints the
+environment variables to point the job at it.
+
+It can also be used as a pytest plugin (pytest_plugins = ['benchmarks.standin']),
+which provides a `standin` fixture.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import Counter
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, unquote, urlencode, urlsplit
+from urllib.request import Request, urlopen
+
+from benchmarks.datasets import apply_churn, generate_lists
+from benchmarks.fakes import relations
+
+try:
+  import pytest
+except ImportError:
+  pytest = None
+
+site_id = 'standin-site'
+job_name = 'hmpps-sharepoint-discovery'
+
+
+@dataclass
+class Faults:
+  latency: float = 0.0
+  jitter: float = 0.0
+  throttle_rate: float = 0.0
+  retry_after: float = 1.0
+  error_rate: float = 0.0
+
+
+# Served with every item, as Graph does, unless a projection leaves them out
+item_metadata = {
+  '@odata.etag': '"00000000-0000-0000-0000-000000000000,1"',
+  'createdDateTime': '2024-01-01T00:00:00Z',
+  'lastModifiedDateTime': '2024-01-01T00:00:00Z',
+  'webUrl': 'https://standin.sharepoint.com/sites/standin/Lists/items',
+  'createdBy': {'user': {'email': 'someone@example.com', 'displayName': 'Someone'}},
+  'lastModifiedBy': {'user': {'email': 'someone@example.com', 'displayName': 'Someone'}},
+  'contentType': {'id': '0x0100', 'name': 'Item'},
+}
+field_metadata = {
+  '@odata.etag': '"00000000-0000-0000-0000-000000000000,1"',
+  'ContentType': 'Item',
+  'Modified': '2024-01-01T00:00:00Z',
+  'Created': '2024-01-01T00:00:00Z',
+  'AuthorLookupId': '7',
+  'EditorLookupId': '7',
+  '_UIVersionString': '1.0',
+  'Attachments': False,
+  'Edit': '',
+  'LinkTitleNoMenu': '',
+  'LinkTitle': '',
+  'ItemChildCount': '0',
+  'FolderChildCount': '0',
+  '_ComplianceFlags': '',
+  '_ComplianceTag': '',
+  'AppAuthorLookupId': '1',
+}
+
+
+def list_id(list_name):
+  return list_name.lower().replace(' ', '-')
+
+
+def served_item(item, params):
+  if '@removed' in item:
+    return item
+  fields = {**field_metadata, **item['fields']}
+  expand = params.get('$expand', 'fields')
+  if expand.startswith('fields($select='):
+    wanted = set(expand[len('fields($select=') : -1].split(','))
+    fields = {key: value for key, value in fields.items() if key in wanted}
+  if '$select' in params:
+    return {'id': item['id'], 'fields': fields}
+  return {**item_metadata, 'id': item['id'], 'fields': fields}
+
+
+def page_link(url, params, **changes):
+  return f'{url}?{urlencode({**params, **changes}, safe="$(),=")}'
+
+
+class GraphData:
+  """SharePoint lists with a version per change, so delta queries can be answered."""
+
+  def __init__(self, lists=None):
+    self.version = 0
+    self.names = {}
+    self.items = {}
+    self.changes = {}
+    self._lock = threading.Lock()
+    self.set_lists(lists or {})
+
+  def set_lists(self, lists):
+    """Applies new list contents, returning the ids of the lists that changed."""
+    changed = set()
+    with self._lock:
+      self.version += 1
+      for list_name, items in lists.items():
+        key = list_id(list_name)
+        self.names[key] = list_name
+        current = self.items.setdefault(key, {})
+        changes = self.changes.setdefault(key, {})
+        latest = {item['id']: item for item in items}
+        for item_id in set(current) - set(latest):
+          del current[item_id]
+          changes[item_id] = self.version
+          changed.add(key)
+        for item_id, item in latest.items():
+          if current.get(item_id) != item:
+            current[item_id] = item
+            changes[item_id] = self.version
+            changed.add(key)
+    return changed
+
+  def page(self, key, start, size):
+    with self._lock:
+      items = list(self.items[key].values())
+    return items[start : start + size], start + size < len(items)
+
+  def delta(self, key, since):
+    with self._lock:
+      changed = sorted(
+        (item_id for item_id, version in self.changes[key].items() if version > since),
+        key=lambda item_id: int(item_id) if item_id.isdigit() else 0,
+      )
+      return [
+        self.items[key].get(item_id) or {'id': item_id, '@removed': {'reason': 'deleted'}}
+        for item_id in changed
+      ], self.version
+
+
+class CatalogueData:
+  """Strapi collections keyed by documentId, created on first use."""
+
+  def __init__(self):
+    self.collections = {'scheduled-jobs': {}}
+    self._ids = itertools.count(1)
+    self._lock = threading.Lock()
+    self.add('scheduled-jobs', {'name': job_name})
+    # The service areas process will not run against an empty collection
+    self.add('service-areas', {'sa_id': 'SP001', 'name': 'Catalogue only'})
+
+  def collection(self, name):
+    return self.collections.setdefault(name, {})
+
+  def populate(self, record):
+    record = dict(record)
+    for key, collection in relations.items():
+      if key in record:
+        related = self.collection(collection).get(record[key] or '')
+        record[key] = (
+          {'documentId': related['documentId'], 'name': related.get('name')}
+          if related
+          else None
+        )
+    return record
+
+  def query(self, name, params):
+    filters = [
+      (key[len('filters[') :].split(']')[0], value)
+      for key, value in params.items()
+      if key.startswith('filters[') and key.endswith('[$eq]')
+    ]
+    with self._lock:
+      records = [
+        record
+        for record in self.collection(name).values()
+        if all(str(record.get(field)) == value for field, value in filters)
+      ]
+    if 'populate' in params or any(key.startswith('populate') for key in params):
+      records = [self.populate(record) for record in records]
+    if fields := {value for key, value in params.items() if key.startswith('fields[')}:
+      # Populated relations are kept, as Strapi returns them alongside the fields
+      keep = fields | {'id', 'documentId'} | {
+        key.split('[')[1].rstrip(']') for key in params if key.startswith('populate[')
+      }
+      records = [{k: v for k, v in record.items() if k in keep} for record in records]
+    return records
+
+  def add(self, name, data):
+    with self._lock:
+      number = next(self._ids)
+      record = {**data, 'id': number, 'documentId': f'doc{number:08d}'}
+      self.collection(name)[record['documentId']] = record
+      return dict(record)
+
+  def update(self, name, document_id, data):
+    with self._lock:
+      record = self.collection(name).get(document_id)
+      if record is None:
+        return None
+      record.update(data)
+      return dict(record)
+
+  def delete(self, name, document_id):
+    with self._lock:
+      return self.collection(name).pop(document_id, None)
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, format, *args):
+    pass
+
+  def _send(self, status, body=None, headers=None):
+    payload = json.dumps(body).encode() if body is not None else b''
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(payload)))
+    for name, value in (headers or {}).items():
+      self.send_header(name, value)
+    self.end_headers()
+    if self.command != 'HEAD':
+      self.wfile.write(payload)
+
+  def _body(self):
+    return json.loads(self.payload or b'{}')
+
+  def _inject(self, backend):
+    server = self.server
+    faults = server.faults[backend]
+    server.count(backend, self.command)
+    delay = faults.latency + random.uniform(0, faults.jitter)
+    if delay:
+      time.sleep(delay)
+    if random.random() < faults.throttle_rate:
+      server.count(backend, 'throttled')
+      self._send(
+        429,
+        {'error': {'code': 'TooManyRequests'}},
+        {'Retry-After': f'{faults.retry_after:g}'},
+      )
+      return True
+    if random.random() < faults.error_rate:
+      server.count(backend, 'errors')
+      self._send(503, {'error': {'code': 'ServiceUnavailable'}})
+      return True
+    return False
+
+  def _route(self):
+    # Always drained, so a rejected request leaves the kept-alive connection usable
+    self.payload = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+    path = self.path
+    # Clients append '&pagination[...]' to tables that carry no query string
+    if '?' not in path and '&' in path:
+      path = path.replace('&', '?', 1)
+    url = urlsplit(path)
+    params = dict(parse_qsl(url.query, keep_blank_values=True))
+    parts = [unquote(part) for part in url.path.strip('/').split('/')]
+    if parts[:2] == ['graph', 'v1.0']:
+      backend, handle = 'graph', self._graph
+      parts = parts[2:]
+    elif parts[:1] == ['sc']:
+      backend, handle = 'sc', self._catalogue
+      parts = parts[2:] if parts[1:2] in (['v1'], ['api']) else parts[1:]
+    else:
+      return self._send(404, {'error': 'not found'})
+    if self._inject(backend):
+      return
+    try:
+      handle(parts, params)
+    except (KeyError, ValueError) as e:
+      self._send(400 if isinstance(e, ValueError) else 404, {'error': str(e)})
+
+  do_GET = do_HEAD = do_POST = do_PUT = do_PATCH = do_DELETE = _route
+
+  def _subscriptions(self, parts):
+    subscriptions = self.server.subscriptions
+    if self.command == 'POST' and len(parts) == 1:
+      subscription = self._body()
+      # Graph checks the endpoint echoes a validation token before subscribing
+      token = f'token-{len(subscriptions)}'
+      url = f'{subscription["notificationUrl"]}?{urlencode({"validationToken": token})}'
+      with urlopen(Request(url, data=b'', method='POST'), timeout=10) as response:
+        if response.read().decode() != token:
+          raise ValueError('subscription validation failed')
+      subscription['id'] = f'subscription-{len(subscriptions) + 1}'
+      subscriptions[subscription['id']] = subscription
+      return self._send(201, subscription)
+    subscription = subscriptions[parts[1]]
+    if self.command == 'PATCH':
+      subscription.update(self._body())
+      return self._send(200, subscription)
+    if self.command == 'DELETE':
+      del subscriptions[parts[1]]
+      return self._send(204)
+    self._send(200, subscription)
+
+  def _graph(self, parts, params):
+    data = self.server.graph
+    base = f'{self.server.base_url}/graph/v1.0/sites/{site_id}/lists'
+    if parts[:1] == ['subscriptions']:
+      return self._subscriptions(parts)
+    if self.command != 'GET' or parts[:1] != ['sites']:
+      return self._send(404, {'error': 'not found'})
+    if parts[1].endswith(':'):
+      # /sites/{hostname}:/sites/{site name}
+      return self._send(200, {'id': site_id, 'name': parts[-1]})
+    if parts[2:] == ['lists']:
+      return self._send(
+        200,
+        {
+          'value': [
+            {'id': key, 'displayName': name} for key, name in data.names.items()
+          ]
+        },
+      )
+    key, rest = parts[3], parts[4:]
+    if key not in data.items:
+      raise KeyError(f'list {key}')
+    if rest == ['items']:
+      start = int(params.get('$skiptoken', 0))
+      size = int(params.get('$top', self.server.page_size))
+      items, more = data.page(key, start, size)
+      body = {'value': [served_item(item, params) for item in items]}
+      if more:
+        body['@odata.nextLink'] = page_link(
+          f'{base}/{key}/items', params, **{'$top': size, '$skiptoken': start + size}
+        )
+      return self._send(200, body)
+    if rest == ['items', 'delta']:
+      since, start = int(params.get('token', 0)), int(params.get('$skiptoken', 0))
+      if since > data.version:
+        return self._send(410, {'error': {'code': 'resyncRequired'}})
+      changes, version = data.delta(key, since)
+      size = self.server.page_size
+      body = {'value': [served_item(item, params) for item in changes[start : start + size]]}
+      # Like Graph, the links keep the projection the delta was started with
+      params.pop('$skiptoken', None)
+      if start + size < len(changes):
+        body['@odata.nextLink'] = page_link(
+          f'{base}/{key}/items/delta', params, token=since, **{'$skiptoken': start + size}
+        )
+      else:
+        body['@odata.deltaLink'] = page_link(
+          f'{base}/{key}/items/delta', params, token=version
+        )
+      return self._send(200, body)
+    if len(rest) == 2 and rest[0] == 'items':
+      return self._send(200, served_item(data.items[key][rest[1]], params))
+    self._send(404, {'error': 'not found'})
+
+  def _catalogue(self, parts, params):
+    data = self.server.catalogue
+    if parts[:1] == ['_health']:
+      return self._send(200, {'status': 'ok'})
+    if not parts or not parts[0]:
+      return self._send(404, {'error': 'not found'})
+    name, document_id = parts[0], parts[1] if len(parts) > 1 else None
+
+    if self.command in ('GET', 'HEAD') and document_id:
+      record = data.collection(name).get(document_id)
+      return self._send(200 if record else 404, {'data': record})
+    if self.command in ('GET', 'HEAD'):
+      records = data.query(name, params)
+      size = int(params.get('pagination[pageSize]', params.get('pagination[limit]', 25)))
+      # Strapi silently caps page sizes at its maxLimit
+      size = min(size, self.server.sc_max_page_size)
+      if 'pagination[start]' in params:
+        start = int(params['pagination[start]'])
+        page = start // size + 1
+      else:
+        page = int(params.get('pagination[page]', 1))
+        start = (page - 1) * size
+      return self._send(
+        200,
+        {
+          'data': records[start : start + size],
+          'meta': {
+            'pagination': {
+              'page': page,
+              'pageSize': size,
+              'pageCount': max(1, -(-len(records) // size)),
+              'total': len(records),
+            }
+          },
+        },
+      )
+    if self.command == 'POST' and not document_id:
+      return self._send(201, {'data': data.add(name, self._body().get('data', {}))})
+    if self.command == 'PUT' and document_id:
+      record = data.update(name, document_id, self._body().get('data', {}))
+      return self._send(200 if record else 404, {'data': record})
+    if self.command == 'DELETE' and document_id:
+      record = data.delete(name, document_id)
+      return self._send(200 if record else 404, {'data': record})
+    self._send(405, {'error': 'method not allowed'})
+
+
+class Standin(ThreadingHTTPServer):
+  daemon_threads = True
+
+  def __init__(
+    self, lists=None, port=0, page_size=200, graph=None, sc=None, sc_max_page_size=100
+  ):
+    super().__init__(('127.0.0.1', port), StandinHandler)
+    self.base_url = f'http://127.0.0.1:{self.server_address[1]}'
+    self.graph = GraphData(lists)
+    self.catalogue = CatalogueData()
+    self.page_size = page_size
+    self.sc_max_page_size = sc_max_page_size
+    self.faults = {'graph': graph or Faults(), 'sc': sc or Faults()}
+    self.requests = Counter()
+    self.subscriptions = {}
+    self._count_lock = threading.Lock()
+    self._thread = None
+
+  def count(self, backend, name):
+    with self._count_lock:
+      self.requests[f'{backend}_{name.lower()}'] += 1
+
+  def set_lists(self, lists):
+    """Changes the lists and sends change notifications to their subscribers."""
+    changed = self.graph.set_lists(lists)
+    notifications = {}
+    for subscription in list(self.subscriptions.values()):
+      if subscription['resource'].split('/')[-1] in changed:
+        notifications.setdefault(subscription['notificationUrl'], []).append(
+          {
+            'subscriptionId': subscription['id'],
+            'clientState': subscription.get('clientState'),
+            'changeType': 'updated',
+            'resource': subscription['resource'],
+          }
+        )
+    for url, value in notifications.items():
+      request = Request(
+        url,
+        data=json.dumps({'value': value}).encode(),
+        headers={'Content-Type': 'application/json'},
+        method='POST',
+      )
+      with urlopen(request, timeout=10):
+        pass
+    return changed
+
+  def environment(self):
+    return {
+      'GRAPH_API_URL': f'{self.base_url}/graph/v1.0',
+      'GRAPH_ACCESS_TOKEN': 'standin',
+      'SP_SITE_ID': 'standin.sharepoint.com',
+      'SERVICE_CATALOGUE_API_ENDPOINT': f'{self.base_url}/sc',
+      'SERVICE_CATALOGUE_API_KEY': 'standin',
+    }
+
+  def start(self):
+    self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+    self._thread.start()
+    return self
+
+  def stop(self):
+    self.shutdown()
+    self.server_close()
+
+
+if pytest:
+
+  @pytest.fixture
+  def standin(monkeypatch, tmp_path):
+    server = Standin(generate_lists(100)).start()
+    for name, value in server.environment().items():
+      monkeypatch.setenv(name, value)
+    monkeypatch.setenv('DISCOVERY_STATE_PATH', str(tmp_path / 'state.db'))
+    yield server
+    server.stop()
+
+
+def run_job(server, label):
+  import sharepoint_discovery
+
+  server.requests.clear()
+  start = time.perf_counter()
+  sharepoint_discovery.main([])
+  seconds = time.perf_counter() - start
+  print(f'{label}: {seconds:.2f}s, {sum(server.requests.values())} requests')
+  for name, count in sorted(server.requests.items()):
+    print(f'  {name}: {count}')
+
+
+def watch_job(server, port, lists, churn, seed):
+  """Runs the job in watch mode, applies the churn and times the notified sync."""
+  os.environ['WATCH_PORT'] = str(port)
+  os.environ.setdefault('WATCH_NOTIFICATION_URL', f'http://127.0.0.1:{port}/notifications')
+  os.environ.setdefault('WATCH_DEBOUNCE_SECONDS', '1')
+  import sharepoint_discovery
+  from includes import watch
+
+  job = threading.Thread(target=sharepoint_discovery.main, args=(['--watch'],))
+  start = time.perf_counter()
+  job.start()
+  # The initial reconcile has finished once every list is subscribed and the job idles
+  while len(server.subscriptions) < len(server.graph.names) or server_busy(server):
+    time.sleep(0.5)
+  print(f'Initial reconcile: {time.perf_counter() - start:.2f}s')
+  try:
+    if churn:
+      server.requests.clear()
+      start = time.perf_counter()
+      changed = server.set_lists(apply_churn(lists, churn, seed))
+      print(f'Notified {len(changed)} changed lists')
+      time.sleep(float(os.environ['WATCH_DEBOUNCE_SECONDS']))
+      while server_busy(server):
+        time.sleep(0.5)
+      seconds = time.perf_counter() - start
+      print(f'Sync after {churn:g} churn: {seconds:.2f}s, {sum(server.requests.values())} requests')
+      for name, count in sorted(server.requests.items()):
+        print(f'  {name}: {count}')
+  finally:
+    watch.stopping.set()
+    job.join()
+
+
+def server_busy(server, quiet=1.0):
+  """Whether the stand-in served any request in the last `quiet` seconds."""
+  before = sum(server.requests.values())
+  time.sleep(quiet)
+  return sum(server.requests.values()) != before
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--products', type=int, default=1000)
+  parser.add_argument('--seed', type=int, default=1)
+  parser.add_argument('--churn', type=float, default=0.0)
+  parser.add_argument('--port', type=int, default=0)
+  parser.add_argument('--page-size', type=int, default=200)
+  parser.add_argument('--sc-max-page-size', type=int, default=100)
+  parser.add_argument('--retry-after', type=float, default=1.0)
+  for backend in ('graph', 'sc'):
+    parser.add_argument(f'--{backend}-latency', type=float, default=0.0)
+    parser.add_argument(f'--{backend}-jitter', type=float, default=0.0)
+    parser.add_argument(f'--{backend}-throttle', type=float, default=0.0)
+    parser.add_argument(f'--{backend}-errors', type=float, default=0.0)
+  parser.add_argument('--run-job', action='store_true')
+  parser.add_argument('--watch', type=int, default=0, metavar='PORT')
+  args = parser.parse_args()
+
+  faults = {
+    backend: Faults(
+      latency=getattr(args, f'{backend}_latency'),
+      jitter=getattr(args, f'{backend}_jitter'),
+      throttle_rate=getattr(args, f'{backend}_throttle'),
+      retry_after=args.retry_after,
+      error_rate=getattr(args, f'{backend}_errors'),
+    )
+    for backend in ('graph', 'sc')
+  }
+  lists = generate_lists(args.products, args.seed)
+  server = Standin(
+    lists,
+    args.port,
+    args.page_size,
+    faults['graph'],
+    faults['sc'],
+    args.sc_max_page_size,
+  )
+
+  if not args.run_job and not args.watch:
+    print(f'Stand-in listening on {server.base_url}')
+    for name, value in server.environment().items():
+      print(f'export {name}={value}')
+    try:
+      server.serve_forever()
+    except KeyboardInterrupt:
+      server.server_close()
+    return
+
+  server.start()
+  # Set before sharepoint_discovery is imported, its modules read them at import time
+  os.environ.update(server.environment())
+  with tempfile.TemporaryDirectory() as directory:
+    os.environ.setdefault('DISCOVERY_STATE_PATH', os.path.join(directory, 'state.db'))
+    try:
+      if args.watch:
+        return watch_job(server, args.watch, lists, args.churn, args.seed)
+      run_job(server, 'Initial sync')
+      if args.churn:
+        server.graph.set_lists(apply_churn(lists, args.churn, args.seed))
+        run_job(server, f'Sync after {args.churn:g} churn')
+    finally:
+      server.stop()
+
+
+if __name__ == '__main__':
+  main()
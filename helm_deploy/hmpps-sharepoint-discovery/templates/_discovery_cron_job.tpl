@@ -0,0 +1,53 @@
+{{/*
+A discovery CronJob: the single job, a shard worker or the coordinator of the shards
+*/}}
+{{- define "discoveryCronJob.cronJob" -}}
+---
+apiVersion: batch/v1
+kind: CronJob
+metadata:
+  name: {{ .name }}
+  labels:
+    {{- include "app.labels" .root | nindent 4 }}
+spec:
+  schedule: "{{ .schedule }}"
+  concurrencyPolicy: Forbid
+  failedJobsHistoryLimit: 5
+  startingDeadlineSeconds: 600
+  successfulJobsHistoryLimit: 5
+  jobTemplate:
+    spec:
+      backoffLimit: 0 # Do not retry
+      ttlSecondsAfterFinished: 345600
+      template:
+        spec:
+          containers:
+            - name: hmpps-sharepoint-discovery
+              image: "{{ .root.Values.image.repository }}:{{ .root.Values.version }}"
+              # Dependencies are installed in the image, so uv need not check them each run
+              command: ["uv", "run", "--no-sync", "python", "-u", "/app/sharepoint_discovery.py"{{ range .args }}, {{ quote . }}{{ end }}]
+              env:
+                - name: PATH
+                  value: "/home/appuser/.local:/usr/local/bin:$PATH"
+              securityContext:
+                capabilities:
+                  drop:
+                  - ALL
+                runAsNonRoot: true
+                allowPrivilegeEscalation: false
+                seccompProfile:
+                  type: RuntimeDefault
+              {{- if .root.Values.discoveryCronJob.stateVolumeClaim }}
+              volumeMounts:
+                - name: discovery-state
+                  mountPath: /app/state
+              {{- end }}
+      {{- include "discoveryCronJob.envs" .root.Values | nindent 14 }}
+          restartPolicy: Never
+          {{- if .root.Values.discoveryCronJob.stateVolumeClaim }}
+          volumes:
+            - name: discovery-state
+              persistentVolumeClaim:
+                claimName: {{ .root.Values.discoveryCronJob.stateVolumeClaim }}
+          {{- end }}
+{{- end -}}
@@ -0,0 +1,261 @@
+"""Run-scoped snapshot over the Service Catalogue client.
+
+Each collection is paged through once per run. The results of this run's own
+add/update/delete calls are applied to the cached copy, so later phases see the
+records earlier phases have just written without a second full read.
+
+Reads can ask for only some fields, and for only some fields of each populated
+relation. A copy already read with more fields (or all of them) serves a narrower
+read of the same collection.
+
+With SC_STATE_CACHE, the snapshot is saved to the state store at the end of a run
+and the next run starts from it instead of paging through the catalogue. Every
+SC_INTEGRITY_CHECK_HOURS a collection is read from the live catalogue again. Its
+fingerprints are compared with the stored ones, and any drift (edits made outside
+this job, or writes whose outcome was lost) is reported and replaced.
+"""
+
+import os
+import threading
+import time
+from collections.abc import Mapping
+
+from includes.catalogue_api import query_params
+from includes.fingerprint import fingerprint
+from includes.log import log_debug, log_info, log_warning
+from includes.metrics import metrics
+from includes.records import compact, compact_records
+
+state_cache = os.environ.get('SC_STATE_CACHE', 'false').lower() == 'true'
+integrity_check_hours = float(os.environ.get('SC_INTEGRITY_CHECK_HOURS', '24'))
+
+
+def collection_of(table):
+  # Tables may carry a query string, eg. 'products?populate=...'
+  return table.split('?')[0].split('&')[0].split('/')[0]
+
+
+def returned_record(result):
+  if hasattr(result, 'json'):
+    try:
+      result = result.json()
+    except ValueError:
+      return {}
+  if isinstance(result, dict):
+    record = result.get('data', result)
+    if isinstance(record, dict):
+      return record
+  return {}
+
+
+class CatalogueSnapshot:
+  def __init__(self, sc, api=None, state=None):
+    self.sc = sc
+    # Reads go through the paging client when given, otherwise the hmpps client
+    self.api = api
+    # Collections are served from the state store between integrity checks
+    self.state = state if state_cache else None
+    self._records = {}
+    self._projections = {}
+    self._table_locks = {}
+    self._lock = threading.Lock()
+
+  def __getattr__(self, name):
+    # Anything not cached (connection_ok, update_scheduled_job, endpoints...)
+    return getattr(self.sc, name)
+
+  def _table_lock(self, table):
+    with self._lock:
+      return self._table_locks.setdefault(table, threading.Lock())
+
+  def _cached_tables(self, collection):
+    return [table for table in self._records if collection_of(table) == collection]
+
+  def _covering(self, table, fields, populate):
+    for key, (cached_table, cached_fields, cached_populate) in self._projections.items():
+      if (
+        cached_table == table
+        and key in self._records
+        # None means every field was read
+        and (cached_fields is None or (fields is not None and set(fields) <= cached_fields))
+        and all(
+          relation in cached_populate and set(relation_fields) <= cached_populate[relation]
+          for relation, relation_fields in (populate or {}).items()
+        )
+      ):
+        return key
+    return None
+
+  def _read(self, table, fields, populate):
+    if self.api and hasattr(self.api, 'get_all'):
+      return self.api.get_all(table, fields, populate) or []
+    query = '&'.join(f'{k}={v}' for k, v in query_params(fields, populate).items())
+    start = time.monotonic()
+    records = self.sc.get_all_records(f'{table}?{query}' if query else table) or []
+    # The hmpps client pages internally, so this is one observation per collection
+    metrics.observe(
+      'discovery_api_request_seconds',
+      time.monotonic() - start,
+      service='service_catalogue',
+      operation='get_all_records',
+    )
+    return records
+
+  def _check_due(self, key):
+    checked_at = self.state.meta(f'checked:{key}')
+    return not checked_at or time.time() - float(checked_at) >= integrity_check_hours * 3600
+
+  @staticmethod
+  def _fingerprint(record, fields, populate):
+    # Only the fields read, with relations by documentId: records written this run
+    # hold the documentId itself where a read returns the populated object
+    keys = record.keys() - {'id'} if fields is None else {*fields, *(populate or {})}
+    return fingerprint(
+      {
+        name: value.get('documentId') if isinstance(value, Mapping) else value
+        for name, value in record.items()
+      },
+      keys,
+    )
+
+  def _check_integrity(self, key, stored, records, fields, populate):
+    live = {
+      record.get('documentId'): self._fingerprint(record, fields, populate)
+      for record in records
+    }
+    drift = sum(live.get(document_id) != value for document_id, value in stored.items())
+    drift += len(live.keys() - stored.keys())
+    metrics.set('discovery_catalogue_drift_records', drift, query=key)
+    if drift:
+      log_warning(
+        'Stored copy of %s drifted from the catalogue by %s records', key, drift
+      )
+    else:
+      log_info('Stored copy of %s matches the catalogue', key)
+
+  def _load(self, key, table, fields, populate):
+    stored = None
+    if self.state:
+      stored = self.state.catalogue_fingerprints(key)
+      if stored and not self._check_due(key):
+        log_debug('Using stored Service Catalogue records for %s', key)
+        records = self.state.catalogue_records(key)
+        metrics.inc('discovery_records_read_total', len(records), source='state')
+        return records
+    records = self._read(table, fields, populate)
+    metrics.inc('discovery_records_read_total', len(records), source='service_catalogue')
+    if self.state:
+      if stored:
+        self._check_integrity(key, stored, records, fields, populate)
+      self.state.save_meta(f'checked:{key}', time.time())
+    return records
+
+  def persist(self, recheck=False):
+    """Saves every collection read this run, with this run's writes applied.
+
+    With `recheck` (some writes failed, so their outcome is uncertain) the saved
+    collections are read from the live catalogue again on the next run.
+    """
+    if not self.state:
+      return
+    with self._lock:
+      snapshot = {
+        key: (list(records.values()), self._projections[key])
+        for key, records in self._records.items()
+      }
+    for key, (records, (_, fields, populate)) in snapshot.items():
+      self.state.save_catalogue_records(
+        key,
+        {
+          record['documentId']: (self._fingerprint(record, fields, populate), record)
+          for record in records
+          if record.get('documentId')
+        },
+      )
+      if recheck:
+        self.state.save_meta(f'checked:{key}', 0)
+    log_debug('Saved %s Service Catalogue collections to the state store', len(snapshot))
+
+  def get_all_records(self, table, fields=None, populate=None):
+    params = query_params(fields, populate)
+    key = f'{table}?{"&".join(f"{k}={v}" for k, v in params.items())}' if params else table
+    with self._table_lock(key):
+      with self._lock:
+        cached = key if key in self._records else self._covering(table, fields, populate)
+      if cached:
+        log_debug('Using cached Service Catalogue records for %s', key)
+      else:
+        records = self._load(key, table, fields, populate)
+        with self._lock:
+          # Indexed by documentId so this run's writes apply in constant time, and
+          # held as compact records for the rest of the run
+          self._records[key] = {
+            record.get('documentId') or id(record): record
+            for record in compact_records(records, 'service_catalogue')
+          }
+          self._projections[key] = (
+            table,
+            set(fields) if fields is not None else None,
+            {relation: set(names) for relation, names in (populate or {}).items()},
+          )
+        cached = key
+      with self._lock:
+        return list(self._records[cached].values())
+
+  def reset(self):
+    """Forgets the collections read so far, so they are read again (watch mode)."""
+    with self._lock:
+      self._records.clear()
+      self._projections.clear()
+
+  def invalidate(self, collection):
+    with self._lock:
+      tables = self._cached_tables(collection)
+      for table in tables:
+        del self._records[table]
+    if self.state:
+      # The stored copy is just as stale, read the collection live next run
+      for table in tables:
+        self.state.save_meta(f'checked:{table}', 0)
+
+  def record_added(self, table, data, result):
+    collection = collection_of(table)
+    record = {**data, **returned_record(result)}
+    if not record.get('documentId'):
+      # Without the new documentId the cached copy cannot be trusted
+      log_debug('No documentId returned when adding to %s, refreshing cache', collection)
+      self.invalidate(collection)
+      return
+    with self._lock:
+      for cached in self._cached_tables(collection):
+        self._records[cached][record['documentId']] = compact(record, 'service_catalogue')
+
+  def record_updated(self, table, document_id, data):
+    with self._lock:
+      for cached in self._cached_tables(collection_of(table)):
+        records = self._records[cached]
+        if document_id in records:
+          # Replaced rather than mutated, phases may still hold the old record
+          records[document_id] = compact(
+            {**records[document_id], **data}, 'service_catalogue'
+          )
+
+  def record_deleted(self, table, document_id):
+    with self._lock:
+      for cached in self._cached_tables(collection_of(table)):
+        self._records[cached].pop(document_id, None)
+
+  def add(self, table, data):
+    result = self.sc.add(table, data)
+    self.record_added(table, data, result)
+    return result
+
+  def update(self, table, document_id, data):
+    result = self.sc.update(table, document_id, data)
+    self.record_updated(table, document_id, data)
+    return result
+
+  def delete(self, table, document_id):
+    result = self.sc.delete(table, document_id)
+    self.record_deleted(table, document_id)
+    return result
@@ -0,0 +1,177 @@
+"""Thin HTTP client for the Service Catalogue (Strapi) REST API.
+
+The hmpps ServiceCatalogue client logs and swallows HTTP failures, which leaves no
+way to tell a throttled request from a rejected one. This client reuses its
+endpoint and credentials but hands the raw response back so callers can retry.
+
+Collection reads can select fields and populate only the relation fields needed.
+They page with start/limit, with the page size tuned from response times: pages
+that come back quickly grow the size, slow ones shrink it, and a size capped by the
+server becomes the new maximum.
+
+Every request goes through the shared Service Catalogue concurrency limiter
+(includes/concurrency.py), so reads and the write queue back off together when
+Strapi throttles or slows down.
+"""
+
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from includes.concurrency import catalogue_limiter
+from includes.metrics import metrics
+
+timeout = int(os.environ.get('SC_API_TIMEOUT', '30'))
+read_page_size = int(os.environ.get('SC_READ_PAGE_SIZE', '100'))
+read_max_page_size = int(os.environ.get('SC_READ_MAX_PAGE_SIZE', '1000'))
+read_target_seconds = float(os.environ.get('SC_READ_TARGET_SECONDS', '1'))
+read_retries = int(os.environ.get('SC_READ_RETRIES', '3'))
+
+
+class CatalogueAPIError(Exception):
+  def __init__(self, message, status_code=None, retry_after=None):
+    super().__init__(message)
+    self.status_code = status_code
+    self.retry_after = retry_after
+
+  @property
+  def retryable(self):
+    # Throttled or failed on the server, so not applied
+    return self.status_code is not None and (
+      self.status_code == 429 or self.status_code >= 500
+    )
+
+  @property
+  def outcome_unknown(self):
+    # No response, the request may or may not have reached the catalogue
+    return self.status_code is None
+
+
+def retry_after_seconds(response):
+  value = response.headers.get('Retry-After')
+  try:
+    return float(value) if value is not None else None
+  except ValueError:
+    return None
+
+
+class PageSizeTuner:
+  def __init__(
+    self, size=read_page_size, maximum=read_max_page_size, target=read_target_seconds
+  ):
+    self.minimum = min(size, 25)
+    self.maximum = max(size, maximum)
+    self.size = size
+    self.target = target
+    self.lock = threading.Lock()
+
+  def record(self, seconds, requested, returned, remaining):
+    with self.lock:
+      if returned < requested and remaining > 0:
+        # The server caps page sizes (Strapi's maxLimit), never ask for more
+        self.maximum = self.size = max(returned, self.minimum)
+      elif seconds > self.target:
+        self.size = max(self.minimum, self.size // 2)
+      elif seconds < self.target / 2:
+        self.size = min(self.maximum, self.size * 2)
+
+
+def query_params(fields=None, populate=None):
+  params = {f'fields[{i}]': field for i, field in enumerate(fields or ())}
+  for relation, relation_fields in (populate or {}).items():
+    for i, field in enumerate(relation_fields):
+      params[f'populate[{relation}][fields][{i}]'] = field
+  return params
+
+
+class CatalogueAPI:
+  def __init__(self, sc=None, pool_size=10):
+    url = getattr(sc, 'url', None) or os.environ.get('SERVICE_CATALOGUE_API_ENDPOINT', '')
+    self.url = f'{url.rstrip("/")}/v1'
+    self.headers = getattr(sc, 'api_headers', None) or {
+      'Authorization': f'Bearer {os.environ.get("SERVICE_CATALOGUE_API_KEY", "")}',
+      'Content-Type': 'application/json',
+      'Accept': 'application/json',
+    }
+    self.session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    self.session.mount('http://', adapter)
+    self.session.mount('https://', adapter)
+    self.page_size = PageSizeTuner()
+
+  def request(self, method, path, **kwargs):
+    catalogue_limiter.acquire()
+    start = time.monotonic()
+    try:
+      response = self.session.request(
+        method, f'{self.url}/{path}', headers=self.headers, timeout=timeout, **kwargs
+      )
+    except requests.RequestException as e:
+      catalogue_limiter.release(time.monotonic() - start)
+      metrics.api_call('service_catalogue', method.lower(), time.monotonic() - start, 'error')
+      raise CatalogueAPIError(f'{method} {path} failed: {e}') from e
+    catalogue_limiter.release(
+      time.monotonic() - start, response.status_code, retry_after_seconds(response)
+    )
+    metrics.api_call(
+      'service_catalogue',
+      method.lower(),
+      time.monotonic() - start,
+      response.status_code,
+      received=len(response.content),
+      sent=len(response.request.body or b''),
+    )
+    if response.status_code >= 400:
+      raise CatalogueAPIError(
+        f'{method} {path} returned {response.status_code}: {response.text[:200]}',
+        status_code=response.status_code,
+        retry_after=retry_after_seconds(response),
+      )
+    return response
+
+  def _read(self, table, params):
+    for attempt in range(read_retries + 1):
+      try:
+        return self.request('GET', table, params=params).json()
+      except CatalogueAPIError as e:
+        # Reads change nothing, so they are retried whatever became of them
+        if not (e.retryable or e.outcome_unknown) or attempt == read_retries:
+          raise
+        delay = e.retry_after or 2**attempt
+        time.sleep(delay + random.uniform(0, delay / 2))
+
+  def get_all(self, table, fields=None, populate=None):
+    # Sorted by id so that offsets stay stable while the page size changes
+    params = {'sort[0]': 'id:asc', **query_params(fields, populate)}
+    records, start = [], 0
+    while True:
+      limit = self.page_size.size
+      began = time.monotonic()
+      body = self._read(
+        table, {**params, 'pagination[start]': start, 'pagination[limit]': limit}
+      )
+      page = body.get('data') or []
+      records.extend(page)
+      start += len(page)
+      total = body.get('meta', {}).get('pagination', {}).get('total', start)
+      self.page_size.record(time.monotonic() - began, limit, len(page), total - start)
+      if not page or start >= total:
+        return records
+
+  def find(self, table, field, value):
+    """The records whose `field` is `value`, read live."""
+    body = self._read(table, {f'filters[{field}][$eq]': value, 'fields[0]': field})
+    return body.get('data') or []
+
+  def add(self, table, data):
+    return self.request('POST', table, json={'data': data}).json()
+
+  def update(self, table, document_id, data):
+    return self.request('PUT', f'{table}/{document_id}', json={'data': data}).json()
+
+  def delete(self, table, document_id):
+    self.request('DELETE', f'{table}/{document_id}')
@@ -0,0 +1,270 @@
+"""Bounded, concurrent, rate-limited queue for Service Catalogue mutations.
+
+Compare loops submit add/update/delete mutations and carry on; a thread pool sends
+them with a token-bucket rate limit and retries throttled (429) or server failed
+(5xx) requests with exponential backoff. A request that got no response may still
+have been applied: updates and deletes are sent again, but an add only once a live
+lookup by its stable id shows the record is missing. Mutations on the same document,
+or with explicit `after` dependencies, are kept in order; everything else overlaps. A mutation's data can
+refer to the documentId of a record another mutation is still adding (DocumentRef);
+it is sent once that add has succeeded, with the reference filled in.
+
+Given a journal, each mutation is recorded just before it is first sent and marked
+with its outcome, so an interrupted run can be resumed (see includes/journal.py).
+"""
+
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from includes.catalogue import collection_of, returned_record
+from includes.catalogue_api import CatalogueAPI, CatalogueAPIError
+from includes.concurrency import sc_max_concurrency
+from includes.journal import stable_keys
+from includes.log import log_debug, log_info, log_warning
+from includes.metrics import metrics
+
+# Threads only; the Service Catalogue limiter decides how many writes are in flight
+write_workers = int(os.environ.get('SC_WRITE_WORKERS', str(sc_max_concurrency)))
+write_rate = float(os.environ.get('SC_WRITE_RATE', '10'))
+write_queue_size = int(os.environ.get('SC_WRITE_QUEUE_SIZE', '100'))
+write_retries = int(os.environ.get('SC_WRITE_RETRIES', '3'))
+write_backoff = float(os.environ.get('SC_WRITE_BACKOFF', '1'))
+
+
+class TokenBucket:
+  def __init__(self, rate, capacity=None):
+    self.rate = rate
+    self.capacity = capacity or max(1.0, rate)
+    self.tokens = self.capacity
+    self.updated = time.monotonic()
+    self.lock = threading.Lock()
+
+  def acquire(self):
+    if self.rate <= 0:
+      return
+    while True:
+      with self.lock:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+          self.tokens -= 1
+          return
+        wait = (1 - self.tokens) / self.rate
+      time.sleep(wait)
+
+
+@dataclass(eq=False)
+class Mutation:
+  action: str  # add, update, delete
+  table: str
+  data: dict | None = None
+  document_id: str | None = None
+  label: str = ''
+  after: list = field(default_factory=list)
+  status: str = 'pending'  # pending, succeeded, failed
+  error: str | None = None
+  result: dict | None = None
+  attempts: int = 0
+  entry: int | None = None  # journal entry, once recorded
+  uncertain: bool = False  # an earlier attempt may have been applied
+  done: threading.Event = field(default_factory=threading.Event)
+
+  @property
+  def key(self):
+    if self.document_id:
+      return (collection_of(self.table), self.document_id)
+    return None
+
+
+class DocumentRef:
+  __slots__ = ('mutation',)
+
+  def __init__(self, mutation):
+    self.mutation = mutation
+
+  def __repr__(self):
+    return f'<documentId of {self.mutation.label}>'
+
+  def resolve(self):
+    if not (document_id := returned_record(self.mutation.result).get('documentId')):
+      raise ValueError(f'no documentId returned for {self.mutation.label}')
+    return document_id
+
+
+class CatalogueWriter:
+  def __init__(
+    self,
+    sc,
+    api=None,
+    workers=write_workers,
+    rate=write_rate,
+    queue_size=write_queue_size,
+    retries=write_retries,
+    backoff=write_backoff,
+    journal=None,
+  ):
+    # sc is the run snapshot; successful writes are applied to it
+    self.sc = sc
+    self.journal = journal
+    self.api = api or CatalogueAPI(sc, pool_size=workers)
+    self.bucket = TokenBucket(rate)
+    self.retries = retries
+    self.backoff = backoff
+    self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='sc-write')
+    self.slots = threading.BoundedSemaphore(queue_size)
+    self.last_by_key = {}
+    self.failed_count = 0
+    self.lock = threading.Lock()
+
+  def submit(
+    self, action, table, data=None, document_id=None, label='', after=(), uncertain=False
+  ):
+    mutation = Mutation(action, table, data, document_id, label or table, list(after))
+    mutation.uncertain = uncertain
+    # Referenced adds must have succeeded before this can be sent
+    mutation.after.extend(
+      value.mutation for value in (data or {}).values() if isinstance(value, DocumentRef)
+    )
+    with self.lock:
+      # Writes to the same document must land in the order they were planned
+      if mutation.key and (previous := self.last_by_key.get(mutation.key)):
+        mutation.after.append(previous)
+      if mutation.key:
+        self.last_by_key[mutation.key] = mutation
+    self.slots.acquire()
+    self.executor.submit(self._run, mutation)
+    return mutation
+
+  def add(self, table, data, label='', after=()):
+    return self.submit('add', table, data=data, label=label, after=after)
+
+  def update(self, table, document_id, data, label='', after=()):
+    return self.submit('update', table, data, document_id, label, after)
+
+  def delete(self, table, document_id, label='', after=()):
+    return self.submit('delete', table, document_id=document_id, label=label, after=after)
+
+  def _send(self, mutation):
+    if mutation.data and any(isinstance(v, DocumentRef) for v in mutation.data.values()):
+      mutation.data = {
+        key: value.resolve() if isinstance(value, DocumentRef) else value
+        for key, value in mutation.data.items()
+      }
+    if self.journal and mutation.entry is None:
+      mutation.entry = self.journal.record(mutation)
+    if mutation.action == 'add':
+      mutation.result = self.api.add(mutation.table, mutation.data)
+      self.sc.record_added(mutation.table, mutation.data, mutation.result)
+    elif mutation.action == 'update':
+      mutation.result = self.api.update(mutation.table, mutation.document_id, mutation.data)
+      self.sc.record_updated(mutation.table, mutation.document_id, mutation.data)
+    elif mutation.action == 'delete':
+      self.api.delete(mutation.table, mutation.document_id)
+      self.sc.record_deleted(mutation.table, mutation.document_id)
+    else:
+      raise ValueError(f'Unknown mutation action {mutation.action}')
+
+  def _existing(self, mutation):
+    """The live records with the add's stable id, or None if it has none."""
+    collection = collection_of(mutation.table)
+    if not (key := stable_keys.get(collection)) or not (mutation.data or {}).get(key):
+      return None
+    return self.api.find(collection, key, mutation.data[key])
+
+  def _succeeded(self, mutation):
+    mutation.status = 'succeeded'
+    if mutation.entry is not None:
+      self.journal.mark(mutation.entry, 'done', mutation.result)
+    log_debug('%s %s succeeded', mutation.action, mutation.label)
+
+  def _run(self, mutation):
+    try:
+      for dependency in mutation.after:
+        dependency.done.wait()
+        if dependency.status != 'succeeded':
+          mutation.status = 'failed'
+          mutation.error = f'depends on {dependency.label} which failed'
+          return
+      while True:
+        self.bucket.acquire()
+        mutation.attempts += 1
+        try:
+          self._send(mutation)
+          self._succeeded(mutation)
+          return
+        except CatalogueAPIError as e:
+          retry = e.retryable
+          if e.outcome_unknown:
+            mutation.uncertain = True
+            if mutation.action != 'add':
+              retry = True
+            elif existing := self._existing(mutation):
+              log_info('%s was added, though its response was lost', mutation.label)
+              mutation.result = {'data': existing[0]}
+              self.sc.record_added(mutation.table, mutation.data, mutation.result)
+              self._succeeded(mutation)
+              return
+            else:
+              # Without a stable id there is no telling whether it was added
+              retry = existing is not None
+          elif e.status_code == 404 and mutation.action == 'delete' and mutation.uncertain:
+            # An earlier attempt deleted it
+            self.sc.record_deleted(mutation.table, mutation.document_id)
+            self._succeeded(mutation)
+            return
+          if not retry or mutation.attempts > self.retries:
+            mutation.status = 'failed'
+            mutation.error = str(e)
+            return
+          metrics.inc('discovery_mutation_retries_total', entity=collection_of(mutation.table))
+          delay = e.retry_after or self.backoff * 2 ** (mutation.attempts - 1)
+          delay += random.uniform(0, delay / 2)
+          log_warning(
+            '%s %s attempt %s failed, retrying in %.1fs: %s',
+            mutation.action,
+            mutation.label,
+            mutation.attempts,
+            delay,
+            e,
+          )
+          time.sleep(delay)
+    except Exception as e:
+      mutation.status = 'failed'
+      mutation.error = str(e)
+    finally:
+      if mutation.entry is not None and mutation.status == 'failed':
+        self.journal.mark(mutation.entry, 'failed')
+      metrics.inc(
+        'discovery_mutations_total',
+        entity=collection_of(mutation.table),
+        action=mutation.action,
+        status=mutation.status,
+      )
+      with self.lock:
+        # Later writes to the document need not wait for it, and a long running watch
+        # process does not keep every document it has written
+        if mutation.key and self.last_by_key.get(mutation.key) is mutation:
+          del self.last_by_key[mutation.key]
+      mutation.done.set()
+      self.slots.release()
+
+  def wait(self, mutations):
+    for mutation in mutations:
+      mutation.done.wait()
+    failed = [mutation for mutation in mutations if mutation.status != 'succeeded']
+    with self.lock:
+      self.failed_count += len(failed)
+    log_info(
+      'Service Catalogue writes complete: %s succeeded, %s failed',
+      len(mutations) - len(failed),
+      len(failed),
+    )
+    return failed
+
+  def close(self):
+    self.executor.shutdown(wait=True)
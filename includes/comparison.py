@@ -0,0 +1,68 @@
+"""The change detection and write wrap-up shared by the keyed entity phases.
+
+Teams, product sets and service areas each hold both sides of their collection in
+full. A Comparison fingerprints both, and their digest tells whether the collection
+is the same as it was after the last run that found nothing to change. Both sides
+are still read and extracted to work that out; what a matching digest saves is the
+record by record comparison and the delete scan.
+"""
+
+from includes.fingerprint import collection_digest, fingerprint
+from includes.log import log_error
+from includes.metrics import metrics
+
+
+def wait_for_writes(writer, writes):
+  """Waits for `writes`; returns a message per failed write and the number done."""
+  failed_writes = writer.wait(writes)
+  messages = []
+  for mutation in failed_writes:
+    message = f'Failed to {mutation.action} {mutation.label} :: {mutation.error}'
+    log_error(message)
+    messages.append(message)
+  return messages, len(writes) - len(failed_writes)
+
+
+class Comparison:
+  def __init__(self, services, entity, fields, sp_records, sc_records):
+    """`sp_records` and `sc_records` are {stable id: record} for each side."""
+    self.services = services
+    self.entity = entity
+    self.sp_fingerprints = {
+      key: fingerprint(record, fields) for key, record in sp_records.items()
+    }
+    self.sc_fingerprints = {
+      key: fingerprint(record, fields) for key, record in sc_records.items()
+    }
+    self.digest = collection_digest(self.sp_fingerprints, self.sc_fingerprints)
+    self.skipped = 0
+
+  @property
+  def unchanged(self):
+    """Whether both sides are as they were after the last run with nothing to change."""
+    state = self.services.state
+    if state is None or state.digest(self.entity) != self.digest:
+      return False
+    metrics.comparison(self.entity, 0, len(self.sp_fingerprints))
+    return True
+
+  def matches(self, key):
+    """Whether the record with stable id `key` is the same on both sides."""
+    if self.sp_fingerprints.get(key) != self.sc_fingerprints.get(key):
+      return False
+    self.skipped += 1
+    return True
+
+  def finish(self, writes, compared):
+    """Waits for `writes` and records the digest if nothing needed changing.
+
+    Returns a message per failed write and the number of writes done.
+    """
+    messages, done = wait_for_writes(self.services.writer, writes)
+    # A targeted run leaves other records unchecked, so the collection is not known
+    # to be in sync
+    state = self.services.state
+    if not writes and self.services.selection.full and state is not None:
+      state.save_digest(self.entity, self.digest)
+    metrics.comparison(self.entity, compared, self.skipped)
+    return messages, done
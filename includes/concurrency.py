@@ -0,0 +1,78 @@
+"""Adaptive (AIMD) concurrency limits for the Graph and Service Catalogue clients.
+
+Every request takes a slot from its backend's limiter and reports back its latency
+and status. The limit grows by one slot per window of requests that come back under
+the target latency (additive increase). It halves on a throttled (429) or failed
+response, or one slower than the target (multiplicative decrease). A Retry-After
+pauses every request to that backend, not only the one that was throttled.
+
+The Graph SharePoint loader and the Service Catalogue client share one limiter per
+backend, so list loading, reads and the write queue together stay within what the
+backend accepts. The hmpps SharePoint client makes its own requests, one list at a
+time, outside the Graph limiter. Thread pools are sized for the maximum; the limiter decides how
+many requests are actually in flight. The current limits are exported as the
+`discovery_concurrency_limit` metric.
+"""
+
+import os
+import threading
+import time
+
+from includes.log import log_debug
+from includes.metrics import metrics
+
+initial_concurrency = int(os.environ.get('DISCOVERY_INITIAL_CONCURRENCY', '4'))
+graph_max_concurrency = int(os.environ.get('GRAPH_MAX_CONCURRENCY', '10'))
+graph_target_seconds = float(os.environ.get('GRAPH_TARGET_SECONDS', '2'))
+sc_max_concurrency = int(os.environ.get('SC_MAX_CONCURRENCY', '16'))
+sc_target_seconds = float(os.environ.get('SC_TARGET_SECONDS', '2'))
+
+
+class AdaptiveLimiter:
+  def __init__(self, service, maximum, target, initial=initial_concurrency, minimum=1):
+    self.service = service
+    self.minimum = minimum
+    self.maximum = max(minimum, maximum)
+    self.limit = float(min(max(initial, minimum), self.maximum))
+    self.target = target
+    self.in_flight = 0
+    self.paused_until = 0.0
+    self.decreased_at = 0.0
+    self.condition = threading.Condition()
+
+  def acquire(self):
+    with self.condition:
+      while True:
+        if (pause := self.paused_until - time.monotonic()) > 0:
+          self.condition.wait(pause)
+        elif self.in_flight >= int(self.limit):
+          self.condition.wait()
+        else:
+          self.in_flight += 1
+          return
+
+  def release(self, seconds, status=None, retry_after=None):
+    """Frees the slot and adjusts the limit; no status means the request failed."""
+    throttled = status == 429
+    with self.condition:
+      self.in_flight -= 1
+      now = time.monotonic()
+      if throttled or status is None or status >= 500 or seconds > self.target:
+        # Requests already in flight saw the same congestion, count it once
+        if now - self.decreased_at > self.target:
+          self.limit = max(self.minimum, self.limit / 2)
+          self.decreased_at = now
+      else:
+        self.limit = min(self.maximum, self.limit + 1 / self.limit)
+      if retry_after:
+        self.paused_until = max(self.paused_until, now + retry_after)
+      limit = self.limit
+      self.condition.notify_all()
+    if throttled:
+      metrics.inc('discovery_throttled_total', service=self.service)
+      log_debug('%s throttled, concurrency limit now %s', self.service, int(limit))
+    metrics.set('discovery_concurrency_limit', int(limit), service=self.service)
+
+
+graph_limiter = AdaptiveLimiter('sharepoint', graph_max_concurrency, graph_target_seconds)
+catalogue_limiter = AdaptiveLimiter('service_catalogue', sc_max_concurrency, sc_target_seconds)
@@ -0,0 +1,22 @@
+"""Field-level diff between a SharePoint record and its catalogue counterpart.
+
+Builds one minimal patch per record holding only the fields that differ, so each
+changed record costs a single update however many of its fields changed.
+"""
+
+from includes.fingerprint import normalise_value
+
+
+def minimal_patch(sp_record, sc_record, keys=None, normalise=normalise_value):
+  patch = {}
+  for key in sp_record.keys() if keys is None else keys:
+    # Fields the catalogue record does not carry are not compared
+    if key not in sc_record:
+      continue
+    if normalise(sp_record.get(key)) != normalise(sc_record.get(key)):
+      patch[key] = sp_record.get(key)
+  return patch
+
+
+def describe_patch(patch, sc_record):
+  return ', '.join(f'{key}: {sc_record.get(key)} -> {value}' for key, value in patch.items())
@@ -0,0 +1,195 @@
+"""Declarative SharePoint-to-catalogue field mapping.
+
+Each entity declares its fields once: source column, target key, normaliser,
+validator and, for references, the SharePoint list to resolve them through. A
+Schema compiles these into extractor functions at import time. Regexes are compiled
+once, each lookup list is indexed once per extraction, and normalisers can be
+memoised for strings that repeat across records.
+
+A list can also be extracted a page at a time as it streams in. References into the
+list being streamed are indexed as its pages arrive; records that point at an item
+not yet seen are held back and resolved once the whole list has been read.
+"""
+
+import functools
+import re
+from dataclasses import dataclass
+from typing import Callable
+
+from includes.log import log_error, log_warning
+
+
+def memoised(normalise, maxsize=8192):
+  cached = functools.lru_cache(maxsize=maxsize)(normalise)
+
+  @functools.wraps(normalise)
+  def wrapper(value):
+    # Only strings repeat often enough to be worth caching, and are always hashable
+    return cached(value) if isinstance(value, str) else normalise(value)
+
+  return wrapper
+
+
+def matches(pattern):
+  compiled = re.compile(pattern)
+  return lambda value: isinstance(value, str) and compiled.match(value) is not None
+
+
+def list_columns(schemas):
+  """Columns to request from each SharePoint list, given {list name: Schema}."""
+  columns = {}
+  for list_name, schema in schemas.items():
+    columns.setdefault(list_name, set()).update(schema.columns)
+    for lookup, lookup_columns in schema.lookup_columns().items():
+      columns.setdefault(lookup, set()).update(lookup_columns)
+  return columns
+
+
+class Deferred:
+  # Stands in for a reference into the list being streamed, until it has been read
+  __slots__ = ('reference',)
+
+  def __init__(self, reference):
+    self.reference = reference
+
+
+class StreamIndex(dict):
+  def get(self, reference, default=None):
+    return super().get(reference) or Deferred(reference)
+
+
+@dataclass(frozen=True)
+class Field:
+  target: str
+  source: str
+  normalise: Callable | None = None
+  validate: Callable | None = None
+  invalid: str | None = None  # logged as an error when validate fails
+  lookup: str | None = None  # SharePoint list the source column references
+  lookup_field: str | None = None  # column to return from the referenced item
+  lookup_key: str | None = None  # column to index the lookup list by (default: id)
+  default: object = None
+  omit_missing: bool = False  # leave the key out when there is no reference
+  missing: str | None = None  # logged as a warning when there is no reference
+  unresolved: str | None = None  # logged as an error when the reference is unknown
+
+
+class Schema:
+  def __init__(self, entity, key, fields):
+    self.entity = entity
+    self.key = key
+    self.fields = tuple(fields)
+    self.lookups = {
+      (field.lookup, field.lookup_key, field.lookup_field)
+      for field in self.fields
+      if field.lookup
+    }
+    self._extractors = [self._compile(field) for field in self.fields]
+
+  @property
+  def columns(self):
+    return {self.key} | {field.source for field in self.fields}
+
+  def lookup_columns(self):
+    columns = {}
+    for lookup, lookup_key, lookup_field in self.lookups:
+      columns.setdefault(lookup, set()).update(c for c in (lookup_key, lookup_field) if c)
+    return columns
+
+  def _compile(self, field):
+    source, normalise, validate = field.source, field.normalise, field.validate
+    target, default = field.target, field.default
+
+    if field.lookup:
+      index = (field.lookup, field.lookup_key, field.lookup_field)
+
+      def extract(fields, key, indexes, record):
+        if not (reference := fields.get(source)):
+          if field.missing:
+            log_warning(field.missing.format(key=key, reference=reference))
+          if not field.omit_missing:
+            record[target] = default
+          return
+        value = indexes[index].get(reference)
+        if not value and field.unresolved:
+          log_error(field.unresolved.format(key=key, reference=reference))
+        record[target] = value or default
+
+      return extract
+
+    def extract(fields, key, indexes, record):
+      value = fields.get(source, default)
+      if validate and not validate(value):
+        log_error(field.invalid.format(key=key, value=value))
+      record[target] = normalise(value) if normalise else value
+
+    return extract
+
+  def _indexes(self, sp, streamed=None):
+    indexes = {}
+    for lookup, lookup_key, lookup_field in self.lookups:
+      if lookup == streamed:
+        indexes[(lookup, lookup_key, lookup_field)] = StreamIndex()
+        continue
+      items = sp.data[lookup].get('value', []) if lookup_key else sp.dict[lookup].values()
+      indexes[(lookup, lookup_key, lookup_field)] = {}
+      self._index_items(indexes, lookup, items)
+    return indexes
+
+  def _index_items(self, indexes, lookup, items):
+    for item in items:
+      fields = item.get('fields', {})
+      for (list_name, lookup_key, lookup_field), index in indexes.items():
+        if list_name == lookup:
+          reference = fields.get(lookup_key) if lookup_key else item.get('id')
+          index[reference] = fields.get(lookup_field)
+
+  def extract_item(self, item, indexes):
+    fields = item.get('fields') or {}
+    if not (key := fields.get(self.key)):
+      return None
+    record = {}
+    for extract in self._extractors:
+      extract(fields, key, indexes, record)
+    return record
+
+  def extract(self, items, sp=None):
+    indexes = self._indexes(sp) if self.lookups else {}
+    records = []
+    for item in items:
+      if (record := self.extract_item(item, indexes)) is not None:
+        records.append(record)
+    return records
+
+  def extract_pages(self, pages, sp, list_name):
+    """Yields one batch of records per page of `list_name`.
+
+    Records referencing items of `list_name` that had not arrived yet come in a
+    final batch, once every page has been indexed.
+    """
+    indexes = self._indexes(sp, streamed=list_name)
+    streamed = [field for field in self.fields if field.lookup == list_name]
+    deferred = []
+    for page in pages:
+      self._index_items(indexes, list_name, page)
+      records = []
+      for item in page:
+        if (record := self.extract_item(item, indexes)) is None:
+          continue
+        if any(isinstance(record.get(field.target), Deferred) for field in streamed):
+          deferred.append((item['fields'][self.key], record))
+        else:
+          records.append(record)
+      # The raw page is released here, only the extracted records are kept
+      del page
+      yield records
+    for key, record in deferred:
+      for field in streamed:
+        if isinstance(pending := record.get(field.target), Deferred):
+          index = indexes[(field.lookup, field.lookup_key, field.lookup_field)]
+          value = dict.get(index, pending.reference)
+          if not value and field.unresolved:
+            log_error(field.unresolved.format(key=key, reference=pending.reference))
+          record[field.target] = value or field.default
+    if deferred:
+      yield [record for _, record in deferred]
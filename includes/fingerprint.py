@@ -0,0 +1,33 @@
+"""Stable content hashes for normalised records and whole collections.
+
+Records whose SharePoint and Service Catalogue fingerprints match need no field by
+field comparison. The digest of a whole entity type (both sides) is saved in the
+state store after a run that found nothing to change. If the next run computes the
+same digest, that phase's comparison can be skipped (see includes/comparison.py).
+"""
+
+import hashlib
+import json
+
+
+def normalise_value(value):
+  if value is None:
+    return ''
+  if isinstance(value, bool):
+    return 'true' if value else 'false'
+  return str(value).strip()
+
+
+def fingerprint(record, keys=None, normalise=normalise_value):
+  keys = sorted(record.keys() if keys is None else keys)
+  canonical = json.dumps([[key, normalise(record.get(key))] for key in keys])
+  return hashlib.blake2b(canonical.encode(), digest_size=16).hexdigest()
+
+
+def collection_digest(sp_fingerprints, sc_fingerprints):
+  digest = hashlib.blake2b(digest_size=16)
+  for fingerprints in (sp_fingerprints, sc_fingerprints):
+    for key in sorted(fingerprints, key=str):
+      digest.update(f'{key}={fingerprints[key]}\n'.encode())
+    digest.update(b'--\n')
+  return digest.hexdigest()
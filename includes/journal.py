@@ -0,0 +1,133 @@
+"""Write-ahead journal of Service Catalogue mutations, for resuming interrupted runs.
+
+Each mutation is recorded in the state store just before it is sent and marked done
+(or failed) once its outcome is known, and each phase is recorded as it succeeds.
+The run is closed when the job finishes. If the job crashes or the pod is evicted,
+the next run finds the run still open:
+
+- mutations whose outcome was never recorded are replayed, except adds whose record
+  already exists in the catalogue; a replayed delete of a record already gone is done
+- phases that had already succeeded are skipped, and the interrupted phase starts
+  again, its completed writes now matching by fingerprint
+- stored catalogue copies touched by the run are read live again (SC_STATE_CACHE)
+
+Recovery therefore costs the writes and phases that were left, not a full run.
+"""
+
+import os
+import threading
+import uuid
+
+from includes.catalogue import collection_of, returned_record
+from includes.log import log_info, log_warning
+from includes.metrics import metrics
+
+journal_enabled = os.environ.get('DISCOVERY_JOURNAL', 'true').lower() == 'true'
+# Asked for explicitly, the journal keeps a state store of its own accord
+journal_requested = os.environ.get('DISCOVERY_JOURNAL', '').lower() == 'true'
+
+# The field that identifies a record in each collection, to spot replayed adds
+stable_keys = {
+  'teams': 't_id',
+  'product-sets': 'ps_id',
+  'service-areas': 'sa_id',
+  'products': 'p_id',
+}
+
+
+class Journal:
+  def __init__(self, state):
+    self.state = state
+    # A run id still in the store belongs to a run that never finished
+    self.run_id = state.meta('journal:run') or None
+    self.resumed = self.run_id is not None
+    # Phases finish on their own threads, each adding itself to the list of done ones
+    self.phases_lock = threading.Lock()
+    self.begin()
+
+  def begin(self):
+    """Opens a run, unless an interrupted one is still to be resumed."""
+    if self.run_id is None:
+      self.run_id = uuid.uuid4().hex
+      self.state.save_meta('journal:run', self.run_id)
+      self.state.save_meta('journal:phases', '')
+
+  def record(self, mutation):
+    return self.state.journal_add(
+      self.run_id,
+      mutation.action,
+      mutation.table,
+      mutation.document_id,
+      mutation.data,
+      mutation.label,
+    )
+
+  def mark(self, entry_id, status, result=None):
+    self.state.journal_mark(entry_id, status, returned_record(result).get('documentId'))
+
+  def completed_phases(self):
+    return {name for name in (self.state.meta('journal:phases') or '').split(',') if name}
+
+  def phase_done(self, name):
+    with self.phases_lock:
+      phases = self.completed_phases() | {name}
+      self.state.save_meta('journal:phases', ','.join(sorted(phases)))
+
+  def _exists(self, sc, entry):
+    collection = collection_of(entry['table'])
+    if not (key := stable_keys.get(collection)) or not entry['data']:
+      return False
+    value = entry['data'].get(key)
+    return any(
+      record.get(key) == value for record in sc.get_all_records(collection, fields=[key])
+    )
+
+  def recover(self, writer, sc):
+    """Replays the writes an interrupted run left without an outcome."""
+    if not self.resumed:
+      return []
+    entries = self.state.journal_entries(self.run_id)
+    pending = [entry for entry in entries if entry['status'] == 'pending']
+    log_info(
+      'Resuming interrupted run %s: %s writes recorded, %s pending, phases done: %s',
+      self.run_id,
+      len(entries) - len(pending),
+      len(pending),
+      sorted(self.completed_phases()),
+    )
+    for collection in {collection_of(entry['table']) for entry in entries}:
+      self.state.expire_catalogue(collection)
+
+    replays = []
+    for entry in pending:
+      if entry['action'] == 'add' and self._exists(sc, entry):
+        self.state.journal_mark(entry['id'], 'skipped')
+        continue
+      self.state.journal_mark(entry['id'], 'replayed')
+      replays.append(
+        writer.submit(
+          entry['action'],
+          entry['table'],
+          entry['data'],
+          entry['document_id'],
+          label=f'{entry["label"]} (replayed)',
+          # It may have been applied, so a delete that finds nothing is done
+          uncertain=True,
+        )
+      )
+    messages = []
+    if replays:
+      for mutation in writer.wait(replays):
+        message = f'Failed to {mutation.action} {mutation.label} :: {mutation.error}'
+        log_warning(message)
+        messages.append(message)
+      messages.append(f'Writes from the interrupted run processed: {len(replays)}')
+    metrics.set('discovery_journal_replayed', len(replays))
+    return messages
+
+  def finish(self):
+    self.run_id = None
+    self.resumed = False
+    self.state.clear_journal()
+    self.state.save_meta('journal:run', '')
+    self.state.save_meta('journal:phases', '')
@@ -0,0 +1,78 @@
+"""Level-aware logging facade over the hmpps job log helpers.
+
+The functions match the hmpps `log_*` helpers, so a plain message still works. They
+also take stdlib-style `%` arguments and key/value fields, which are only rendered
+when the level is enabled. This keeps large records and JSON dumps from being
+serialised in the compare loops when the job runs at INFO:
+
+  log_debug('Comparing product %s :: %s', p_id, sp_product, sample=True)
+  log_debug('sp_teams_data is:\\n%s', lazy(json.dumps, sp_teams_data, indent=2))
+  log_event('info', 'writes.complete', succeeded=10, failed=0)
+
+Per-record debug lines marked `sample=True` are emitted for only a share
+(LOG_DEBUG_SAMPLE_RATE) of records.
+"""
+
+import os
+import random
+
+from hmpps.services import job_log_handling
+
+levels = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40, 'CRITICAL': 50}
+log_level = levels.get(os.environ.get('LOG_LEVEL', 'INFO').upper(), levels['INFO'])
+sample_rate = float(os.environ.get('LOG_DEBUG_SAMPLE_RATE', '1'))
+
+
+class lazy:
+  """Defers an expensive call until the log line is actually rendered."""
+
+  __slots__ = ('func', 'args', 'kwargs')
+
+  def __init__(self, func, *args, **kwargs):
+    self.func = func
+    self.args = args
+    self.kwargs = kwargs
+
+  def __str__(self):
+    return str(self.func(*self.args, **self.kwargs))
+
+
+def enabled(level):
+  return levels[level.upper()] >= log_level
+
+
+def render(message, args, fields):
+  if args:
+    message = message % args
+  if fields:
+    message = ' '.join([message, *(f'{key}={value}' for key, value in fields.items())])
+  return message
+
+
+def _log(level, message, args, fields, sample=False):
+  # Errors are always passed on, the job status is decided from them
+  if level != 'error' and not enabled(level):
+    return
+  if sample and sample_rate < 1 and random.random() >= sample_rate:
+    return
+  getattr(job_log_handling, f'log_{level}')(render(message, args, fields))
+
+
+def log_debug(message, *args, sample=False, **fields):
+  _log('debug', message, args, fields, sample)
+
+
+def log_info(message, *args, **fields):
+  _log('info', message, args, fields)
+
+
+def log_warning(message, *args, **fields):
+  _log('warning', message, args, fields)
+
+
+def log_error(message, *args, **fields):
+  _log('error', message, args, fields)
+
+
+def log_event(level, event, **fields):
+  _log(level.lower(), event, (), fields)
@@ -0,0 +1,213 @@
+"""Run metrics for the discovery job.
+
+Counters, gauges and summaries are collected in memory while the job runs. At the
+end they are written in the Prometheus text format, either to a file for the node
+exporter's textfile collector (DISCOVERY_METRICS_FILE) or to a Pushgateway
+(PROMETHEUS_PUSHGATEWAY_URL), apart for each shard when sites are synced by separate
+workers. A compact timing breakdown is also added to the Slack summary.
+"""
+
+import os
+import resource
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import requests
+
+from includes.log import log_error, log_info
+
+metrics_file = os.environ.get('DISCOVERY_METRICS_FILE')
+pushgateway_url = os.environ.get('PROMETHEUS_PUSHGATEWAY_URL')
+job_name = 'hmpps-sharepoint-discovery'
+
+descriptions = {
+  'discovery_run_duration_seconds': ('gauge', 'Wall time of the last run'),
+  'discovery_last_run_timestamp_seconds': ('gauge', 'When the last run finished'),
+  'discovery_phase_duration_seconds': ('gauge', 'Wall time of each phase'),
+  'discovery_phase_succeeded': ('gauge', 'Whether each phase succeeded (1) or not (0)'),
+  'discovery_api_requests_total': ('counter', 'HTTP requests by service and status'),
+  'discovery_api_request_seconds': ('summary', 'HTTP request latency by service'),
+  'discovery_api_bytes_total': ('counter', 'Bytes sent and received by service'),
+  'discovery_records_read_total': ('counter', 'Records read from each source'),
+  'discovery_records_compared_total': ('counter', 'SharePoint records compared'),
+  'discovery_records_skipped_total': ('counter', 'Records skipped as unchanged'),
+  'discovery_mutations_total': ('counter', 'Service Catalogue writes by outcome'),
+  'discovery_mutation_retries_total': ('counter', 'Service Catalogue write retries'),
+  'discovery_startup_seconds': ('gauge', 'Start-up time by stage: import, auth, preflight'),
+  'discovery_peak_memory_bytes': ('gauge', 'Peak resident memory of the job'),
+  'discovery_compacted_records_total': ('counter', 'Records held in compact form'),
+  'discovery_compacted_bytes_saved': ('counter', 'Estimated bytes saved by compact records'),
+}
+
+
+def process_seconds():
+  """Seconds since this process started, or None where /proc is not available."""
+  try:
+    with open('/proc/self/stat') as f:
+      # Fields after the command name, which may itself contain spaces
+      start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+    with open('/proc/uptime') as f:
+      uptime = float(f.read().split()[0])
+    return max(0.0, uptime - start_ticks / os.sysconf('SC_CLK_TCK'))
+  except (OSError, ValueError, IndexError):
+    return None
+
+
+def peak_memory_bytes():
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # ru_maxrss is in bytes on macOS and kilobytes on Linux
+  return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def label_text(labels):
+  if not labels:
+    return ''
+  escaped = (
+    (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+    for name, value in labels
+  )
+  return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def human_bytes(count):
+  for unit in ('B', 'KB', 'MB'):
+    if count < 1024:
+      return f'{count:.0f} {unit}' if unit == 'B' else f'{count:.1f} {unit}'
+    count /= 1024
+  return f'{count:.1f} GB'
+
+
+class Metrics:
+  def __init__(self):
+    self._lock = threading.Lock()
+    # Set in a shard worker; its metrics are exported apart from the other shards'
+    self.shard = None
+    self.reset()
+
+  def reset(self):
+    with self._lock:
+      self.values = defaultdict(float)
+      self.started = time.monotonic()
+
+  def _key(self, name, labels):
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+  def inc(self, name, value=1, **labels):
+    with self._lock:
+      self.values[self._key(name, labels)] += value
+
+  def set(self, name, value, **labels):
+    with self._lock:
+      self.values[self._key(name, labels)] = value
+
+  def observe(self, name, seconds, **labels):
+    with self._lock:
+      self.values[self._key(f'{name}_count', labels)] += 1
+      self.values[self._key(f'{name}_sum', labels)] += seconds
+
+  @contextmanager
+  def timer(self, name, **labels):
+    start = time.monotonic()
+    try:
+      yield
+    finally:
+      self.set(name, time.monotonic() - start, **labels)
+
+  def api_call(self, service, operation, seconds, status, received=0, sent=0):
+    self.inc('discovery_api_requests_total', service=service, status=status)
+    self.observe(
+      'discovery_api_request_seconds', seconds, service=service, operation=operation
+    )
+    for direction, count in (('received', received), ('sent', sent)):
+      if count:
+        self.inc('discovery_api_bytes_total', count, service=service, direction=direction)
+
+  def comparison(self, entity, compared, skipped):
+    self.inc('discovery_records_compared_total', compared, entity=entity)
+    self.inc('discovery_records_skipped_total', skipped, entity=entity)
+
+  def total(self, name, **labels):
+    with self._lock:
+      return sum(
+        value
+        for (key, key_labels), value in self.values.items()
+        if key == name
+        and all(dict(key_labels).get(label) == str(value) for label, value in labels.items())
+      )
+
+  def render(self):
+    with self._lock:
+      values = sorted(self.values.items())
+    lines, described = [], set()
+    for (name, labels), value in values:
+      family = name.removesuffix('_count').removesuffix('_sum')
+      if family not in descriptions:
+        family = name
+      if family not in described and family in descriptions:
+        kind, help_text = descriptions[family]
+        lines += [f'# HELP {family} {help_text}', f'# TYPE {family} {kind}']
+        described.add(family)
+      lines.append(f'{name}{label_text(labels)} {value:.15g}')
+    return '\n'.join(lines) + '\n'
+
+  def export(self):
+    self.set('discovery_run_duration_seconds', time.monotonic() - self.started)
+    self.set('discovery_peak_memory_bytes', peak_memory_bytes())
+    self.set('discovery_last_run_timestamp_seconds', time.time())
+    text = self.render()
+    if path := metrics_file:
+      if self.shard:
+        # A file per shard, so workers sharing a node do not overwrite each other
+        root, extension = os.path.splitext(metrics_file)
+        path = f'{root}-{self.shard}{extension}'
+      try:
+        # Written alongside and renamed, so the collector never reads a partial file
+        temporary = f'{path}.tmp'
+        with open(temporary, 'w') as f:
+          f.write(text)
+        os.replace(temporary, path)
+        log_info('Metrics written to %s', path)
+      except OSError as e:
+        log_error('Unable to write metrics to %s: %s', path, e)
+    if pushgateway_url:
+      grouping = f'/metrics/job/{job_name}'
+      if self.shard:
+        grouping += f'/shard/{self.shard}'
+      try:
+        requests.put(
+          f'{pushgateway_url.rstrip("/")}{grouping}',
+          data=text.encode(),
+          headers={'Content-Type': 'text/plain; version=0.0.4'},
+          timeout=10,
+        ).raise_for_status()
+        log_info('Metrics pushed to the Pushgateway')
+      except requests.RequestException as e:
+        log_error('Unable to push metrics to %s: %s', pushgateway_url, e)
+    return text
+
+  def timing_breakdown(self, phases):
+    load_seconds = self.total('discovery_phase_duration_seconds', phase='load_lists')
+    timings = [f'load lists {load_seconds:.1f}s']
+    timings += [f'{phase.name} {phase.duration:.1f}s' for phase in phases]
+    calls = []
+    for service, title in (('sharepoint', 'SharePoint'), ('service_catalogue', 'SC')):
+      count = self.total('discovery_api_request_seconds_count', service=service)
+      if count:
+        seconds = self.total('discovery_api_request_seconds_sum', service=service)
+        received = self.total(
+          'discovery_api_bytes_total', service=service, direction='received'
+        )
+        calls.append(f'{title} {count:.0f} calls {seconds:.1f}s {human_bytes(received)}')
+    writes = self.total('discovery_mutations_total')
+    total = time.monotonic() - self.started
+    return (
+      f'_Timings: {total:.1f}s total; {", ".join(timings)}'
+      + (f'; {"; ".join(calls)}' if calls else '')
+      + f'; {writes:.0f} writes; {human_bytes(peak_memory_bytes())} peak memory_'
+    )
+
+
+metrics = Metrics()
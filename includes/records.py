@@ -0,0 +1,114 @@
+"""Compact in-memory records for the SharePoint items and catalogue records a run holds.
+
+Graph and the Service Catalogue return each record as a JSON object, parsed into a
+dict with its own copy of every string. Held for a whole run at tens of thousands of
+records, those dicts are most of the job's memory. Records are compacted as they
+are cached:
+
+- each becomes a `__slots__` Record holding a tuple of its values, with no
+  per-record hash table; records with the same keys share one key index
+- nested objects (item fields, populated relations) are compacted the same way
+- short strings are interned, so repeated values (phases, portfolios, people, ids
+  of related records) are held once
+- Graph metadata (`@odata.*`) is dropped
+
+Compact records are read-only mappings, so code reading them (`get`, `[]`, `in`,
+`dict(record)`, `{**record}`) need not know which form it holds. The estimated bytes
+saved are counted in the `discovery_compacted_bytes_saved` metric.
+"""
+
+import functools
+import sys
+from collections.abc import Mapping
+
+from includes.metrics import metrics
+
+# Longer strings (descriptions, urls) rarely repeat
+intern_max_length = 64
+
+
+@functools.lru_cache(maxsize=1024)
+def key_index(keys):
+  """{key: position} for a tuple of keys, shared by every record with those keys."""
+  return {key: index for index, key in enumerate(keys)}
+
+
+class Record(Mapping):
+  __slots__ = ('_index', '_values')
+
+  def __init__(self, keys, values):
+    self._index = key_index(keys)
+    self._values = tuple(values)
+
+  def __getitem__(self, key):
+    try:
+      return self._values[self._index[key]]
+    except KeyError:
+      raise KeyError(key) from None
+
+  def get(self, key, default=None):
+    index = self._index.get(key)
+    return default if index is None else self._values[index]
+
+  def __contains__(self, key):
+    return key in self._index
+
+  def __iter__(self):
+    return iter(self._index)
+
+  def __len__(self):
+    return len(self._values)
+
+  def values(self):
+    return self._values
+
+  def items(self):
+    return zip(self._index, self._values)
+
+  def __repr__(self):
+    return repr(dict(self))
+
+  def __reduce__(self):
+    return dict, (dict(self),)
+
+
+class Compaction:
+  """One batch of records being compacted, with the bytes it saved."""
+
+  def __init__(self):
+    self.saved = 0
+
+  def value(self, value):
+    kind = type(value)
+    if kind is str:
+      if len(value) <= intern_max_length and (interned := sys.intern(value)) is not value:
+        self.saved += sys.getsizeof(value)
+        return interned
+      return value
+    if kind is dict:
+      return self.mapping(value)
+    return value
+
+  def mapping(self, data):
+    keys = tuple(key for key in data if key[:7] != '@odata.')
+    record = Record(keys, map(self.value, map(data.__getitem__, keys)))
+    # Graph metadata, never read, is left behind with the dict
+    self.saved += sys.getsizeof(data) - sys.getsizeof(record)
+    if len(keys) < len(data):
+      self.saved += sum(sys.getsizeof(data[key]) for key in data.keys() - set(keys))
+    return record
+
+
+def compact_records(records, store):
+  """Compact copies of `records`; anything not a plain dict is kept as it is."""
+  compaction = Compaction()
+  compacted = [
+    compaction.mapping(record) if type(record) is dict else record for record in records
+  ]
+  metrics.inc('discovery_compacted_records_total', len(compacted), store=store)
+  metrics.inc('discovery_compacted_bytes_saved', compaction.saved, store=store)
+  return compacted
+
+
+def compact(record, store):
+  return compact_records((record,), store)[0]
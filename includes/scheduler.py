@@ -0,0 +1,99 @@
+"""Dependency-aware scheduler for the discovery phases.
+
+Phases with no outstanding dependencies run concurrently on a thread pool; a phase
+only starts once every phase it depends on has succeeded. Each phase keeps its own
+summary messages and error so one failure does not hide the results of the others.
+When resuming an interrupted run, phases its journal records as done are not run again.
+"""
+
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Callable
+
+from includes.log import log_error, log_info
+from includes.metrics import metrics
+
+max_workers = int(os.environ.get('DISCOVERY_MAX_WORKERS', '3'))
+
+
+@dataclass
+class Phase:
+  name: str
+  title: str
+  process: Callable
+  depends_on: tuple = ()
+  status: str = 'pending'  # pending, running, succeeded, failed, skipped
+  messages: list = field(default_factory=list)
+  error: Exception | None = None
+  duration: float = 0.0
+
+
+def run_phase(phase, services):
+  log_info('')
+  log_info(phase.title)
+  log_info('=' * len(phase.title))
+  log_info('')
+  start = time.monotonic()
+  try:
+    phase.messages = phase.process(services) or []
+    phase.status = 'succeeded'
+    if journal := getattr(services, 'journal', None):
+      journal.phase_done(phase.name)
+  except Exception as e:
+    log_error('Phase %s failed with error: %s', phase.name, e)
+    phase.error = e
+    phase.status = 'failed'
+  phase.duration = time.monotonic() - start
+  metrics.set('discovery_phase_duration_seconds', phase.duration, phase=phase.name)
+  metrics.set('discovery_phase_succeeded', int(phase.status == 'succeeded'), phase=phase.name)
+  log_info('Phase %s %s in %.1fs', phase.name, phase.status, phase.duration)
+  return phase
+
+
+def run_phases(services, phases, workers=None):
+  phases_by_name = {phase.name: phase for phase in phases}
+  for phase in phases:
+    for dependency in phase.depends_on:
+      if dependency not in phases_by_name:
+        raise ValueError(f'Phase {phase.name} depends on unknown phase {dependency}')
+
+  journal = getattr(services, 'journal', None)
+  if journal and journal.resumed:
+    for phase in phases:
+      if phase.name in journal.completed_phases():
+        log_info('Phase %s already completed by the interrupted run', phase.name)
+        phase.status = 'succeeded'
+
+  running = {}
+  with ThreadPoolExecutor(max_workers=workers or max_workers) as executor:
+    while True:
+      changed = True
+      while changed:
+        changed = False
+        for phase in phases:
+          if phase.status != 'pending':
+            continue
+          dependencies = [phases_by_name[name] for name in phase.depends_on]
+          if blocked := [d.name for d in dependencies if d.status in ('failed', 'skipped')]:
+            log_error(
+              'Skipping phase %s: dependencies did not succeed %s', phase.name, blocked
+            )
+            phase.status = 'skipped'
+            changed = True
+          elif all(d.status == 'succeeded' for d in dependencies):
+            phase.status = 'running'
+            running[executor.submit(run_phase, phase, services)] = phase
+      if not running:
+        # Anything still pending has a dependency cycle
+        for phase in phases:
+          if phase.status == 'pending':
+            log_error('Skipping phase %s: circular dependency', phase.name)
+            phase.status = 'skipped'
+        break
+      done, _ = wait(running, return_when=FIRST_COMPLETED)
+      for future in done:
+        running.pop(future)
+
+  return phases
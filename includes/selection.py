@@ -0,0 +1,71 @@
+"""Which entities and records a run syncs.
+
+A normal run syncs everything. An operator fixing a few records can limit a run to
+some entity types (`--only products,teams`) and to some stable ids (`--ids
+PRD123,TM045`). Only the SharePoint lists those entity types read are loaded, records
+with other ids are left alone, and nothing is deleted unless `--delete` is given.
+
+A shard worker syncing one of several sites deletes nothing (the coordinator does),
+and keeps to the id prefixes its site owns, if any.
+"""
+
+from dataclasses import dataclass
+
+from includes.xref import stable_id
+
+# Entity types as given on the command line -> sync phase
+entity_phases = {
+  'teams': 'teams',
+  'product-sets': 'product_sets',
+  'service-areas': 'service_areas',
+  'products': 'products',
+}
+
+
+def split_values(value):
+  return frozenset(part.strip() for part in value.split(',') if part.strip())
+
+
+def phase_names(entities):
+  """Phase names for comma separated entity types; raises ValueError for unknown ones."""
+  phases = set()
+  for entity in split_values(entities):
+    if (phase := entity_phases.get(entity.lower().replace('_', '-'))) is None:
+      raise ValueError(
+        f'unknown entity type {entity!r}, expected one of {", ".join(entity_phases)}'
+      )
+    phases.add(phase)
+  return frozenset(phases)
+
+
+@dataclass(frozen=True)
+class Selection:
+  phases: frozenset | None = None
+  ids: frozenset | None = None
+  deletes: bool = True
+  # Stable id prefixes the records synced must have, empty for any
+  prefixes: tuple = ()
+
+  @classmethod
+  def parse(cls, only=None, ids=None, delete=False):
+    phases = phase_names(only) if only else None
+    ids = frozenset(filter(None, map(stable_id, split_values(ids)))) if ids else None
+    # A full run deletes as it always has; a targeted one only when asked
+    return cls(phases, ids, deletes=delete or (phases is None and ids is None))
+
+  @property
+  def full(self):
+    return self.phases is None and self.ids is None
+
+  def wants(self, key):
+    """Whether the record with stable id `key` is synced this run."""
+    key = stable_id(key)
+    if self.ids is not None and key not in self.ids:
+      return False
+    return not self.prefixes or (key is not None and key.startswith(self.prefixes))
+
+  def deletes_record(self, key):
+    return self.deletes and self.wants(key)
+
+
+everything = Selection()
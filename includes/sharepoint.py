@@ -0,0 +1,518 @@
+"""SharePoint list loaders: the hmpps SharePoint client, and one built directly on the
+Microsoft Graph API.
+
+Both expose the `data`/`dict` shape of the hmpps client, so processes can use either.
+The hmpps client is used unless a feature only the Graph client has is needed (see
+`graph_client`). The Graph endpoint is configurable (GRAPH_API_URL, with an optional
+static GRAPH_ACCESS_TOKEN) so the job can run against a local stand-in. Throttled
+and 5xx responses are retried, honouring Retry-After. Lists are loaded concurrently
+over one pooled keep-alive session, with the number of requests in flight set by the
+shared Graph limiter (includes/concurrency.py); the pages of a single list are still
+read in order, as each carries the link to the next. When
+given the columns each list needs, only those fields are requested.
+
+In incremental mode each list's items are kept in the local state store along with
+a Graph delta link. A run then fetches only the items added, changed or removed
+since the last successful run and merges them into the cached copy.
+
+With SP_STREAMING, the largest lists are not loaded up front. Their pages are
+handed to the processes through a generator instead, with the next page fetched on
+a background thread while the current one is processed, so only a few pages of raw
+Graph JSON are held at a time.
+
+The Graph access token is kept in a file next to the state store (GRAPH_TOKEN_CACHE)
+and reused by later runs until shortly before it expires, so most runs skip both
+importing azure-identity and the token exchange with Azure AD.
+"""
+
+import hashlib
+import json
+import os
+import queue
+import random
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from includes.catalogue_api import retry_after_seconds
+from includes.concurrency import graph_limiter, graph_max_concurrency
+from includes.log import log_debug, log_error, log_info, log_warning
+from includes.metrics import metrics
+from includes.records import compact_records
+from includes.state import state_path
+
+graph_url = os.environ.get('GRAPH_API_URL', 'https://graph.microsoft.com/v1.0').rstrip('/')
+graph_scope = 'https://graph.microsoft.com/.default'
+timeout = int(os.environ.get('SP_API_TIMEOUT', '30'))
+retries = int(os.environ.get('SP_API_RETRIES', '5'))
+backoff = float(os.environ.get('SP_API_BACKOFF', '1'))
+incremental = os.environ.get('SP_INCREMENTAL', 'false').lower() == 'true'
+streaming = os.environ.get('SP_STREAMING', 'false').lower() == 'true'
+page_size = int(os.environ.get('SP_PAGE_SIZE', '200'))
+prefetch_pages = int(os.environ.get('SP_PREFETCH_PAGES', '1'))
+# Threads only; the Graph limiter decides how many requests are in flight
+list_workers = int(os.environ.get('SP_LIST_WORKERS', str(graph_max_concurrency)))
+select_columns = os.environ.get('SP_SELECT_COLUMNS', 'true').lower() == 'true'
+# The Graph client is used when asked for, or for features the hmpps client lacks:
+# delta queries, streaming and a configured endpoint or token (the stand-in). Watch
+# mode also needs it, for change notifications
+graph_client = (
+  os.environ.get('SP_GRAPH_CLIENT', 'false').lower() == 'true'
+  or incremental
+  or streaming
+  or bool(os.environ.get('GRAPH_API_URL'))
+  or bool(os.environ.get('GRAPH_ACCESS_TOKEN'))
+)
+# Set to an empty value to always fetch a new token
+token_cache_path = os.environ.get(
+  'GRAPH_TOKEN_CACHE', os.path.join(os.path.dirname(state_path), 'graph-token.json')
+)
+# Tokens this close to expiry are not reused
+token_margin = 300
+
+CachedToken = namedtuple('CachedToken', 'token expires_on')
+
+
+class DeltaExpired(Exception):
+  pass
+
+
+def item_sort_key(item):
+  item_id = str(item.get('id', ''))
+  return (0, int(item_id), '') if item_id.isdigit() else (1, 0, item_id)
+
+
+def prefetched(iterable, depth=1):
+  """Runs `iterable` on a background thread, keeping up to `depth` items ready."""
+  ready = queue.Queue(maxsize=max(1, depth))
+  stopped = threading.Event()
+
+  def put(entry):
+    while not stopped.is_set():
+      try:
+        ready.put(entry, timeout=0.1)
+        return True
+      except queue.Full:
+        continue
+    return False
+
+  def produce():
+    try:
+      for item in iterable:
+        if not put(('item', item)):
+          return
+      put(('end', None))
+    except Exception as e:
+      put(('error', e))
+
+  threading.Thread(target=produce, daemon=True, name='sp-prefetch').start()
+  try:
+    while True:
+      kind, value = ready.get()
+      if kind == 'end':
+        return
+      if kind == 'error':
+        raise value
+      yield value
+  finally:
+    # Stops the producer if the consumer gives up early
+    stopped.set()
+
+
+class TokenCache:
+  """A Graph access token kept in a file between runs."""
+
+  def __init__(self, path, *identity):
+    self.path = path
+    # A token is only reused for the tenant and client it was issued to
+    self.key = hashlib.sha256('|'.join(map(str, identity)).encode()).hexdigest()
+
+  def load(self):
+    if not self.path:
+      return None
+    try:
+      with open(self.path) as f:
+        cached = json.load(f)
+    except (OSError, ValueError):
+      return None
+    if cached.get('key') != self.key or cached.get('expires_on', 0) - token_margin < time.time():
+      return None
+    return CachedToken(cached['token'], cached['expires_on'])
+
+  def save(self, token):
+    if not self.path:
+      return
+    try:
+      if os.path.dirname(self.path):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+      temporary = f'{self.path}.tmp'
+      # Readable by the job's user only, and renamed so readers never see a partial file
+      descriptor = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+      with os.fdopen(descriptor, 'w') as f:
+        json.dump({'key': self.key, 'token': token.token, 'expires_on': token.expires_on}, f)
+      os.replace(temporary, self.path)
+    except OSError as e:
+      log_warning('Unable to cache the Graph token in %s: %s', self.path, e)
+
+  def clear(self):
+    if self.path:
+      try:
+        os.remove(self.path)
+      except OSError:
+        pass
+
+
+class ListData:
+  """The lists loaded in a run, as the processes read them."""
+
+  incremental = False
+  streamed = frozenset()
+  # Time spent obtaining a Graph token, reported as part of start-up
+  auth_seconds = 0.0
+
+  def _set_list(self, list_name, items):
+    # Held for the whole run, so kept as compact records rather than Graph JSON
+    items = compact_records(items, 'sharepoint')
+    self.data[list_name] = {'value': items}
+    self.dict[list_name] = {item.get('id'): item for item in items}
+
+  def iter_list_pages(self, list_name):
+    items = self.data[list_name].get('value', [])
+    for start in range(0, len(items), page_size):
+      yield items[start : start + page_size]
+
+  def commit_delta(self):
+    pass
+
+
+class HmppsSharePointLists(ListData):
+  """Lists loaded in full through the hmpps SharePoint client."""
+
+  def __init__(self, site_name, list_aliases=None):
+    from hmpps import SharePoint
+
+    self.site_name = site_name
+    self.list_aliases = list_aliases or {}
+    self.data = {}
+    self.dict = {}
+    self.changed_lists = set()
+    self.client = SharePoint(site_name=site_name)
+    self.connection_ok = self.client.connection_ok
+
+  def load_sharepoint_lists(self, list_names):
+    site_lists = {name: self.list_aliases.get(name, name) for name in list_names}
+    self.client.load_sharepoint_lists(sorted(set(site_lists.values())))
+    for site_list_name in sorted(set(site_lists.values())):
+      if site_list_name not in self.client.data:
+        raise KeyError(
+          f'SharePoint list {site_list_name} not found in site {self.site_name}'
+        )
+      # The client's raw Graph JSON is released once the list is compacted
+      items = self.client.data.pop(site_list_name).get('value', [])
+      self.client.dict.pop(site_list_name, None)
+      for list_name, name in site_lists.items():
+        if name != site_list_name:
+          continue
+        self._set_list(list_name, items)
+        self.changed_lists.add(list_name)
+        metrics.inc('discovery_records_read_total', len(items), source='sharepoint')
+        log_info('Loaded %s items from SharePoint list %s', len(items), list_name)
+
+
+class SharePointLists(ListData):
+  def __init__(
+    self,
+    site_name,
+    state=None,
+    incremental=incremental,
+    streamed=(),
+    columns=None,
+    list_aliases=None,
+  ):
+    self.site_name = site_name
+    # List name the job reads -> the list's name in this site, where they differ
+    self.list_aliases = list_aliases or {}
+    # Fields to request per list, lists not named here are read in full
+    self.columns = {
+      list_name: ','.join(sorted(list_columns))
+      for list_name, list_columns in (columns or {}).items()
+      if select_columns
+    }
+    self.state = state
+    self.incremental = incremental and state is not None
+    # Lists read page by page through iter_list_pages, rather than held in full
+    self.streamed = set(streamed) if streaming and not self.incremental else set()
+    self.data = {}
+    self.dict = {}
+    self.changed_lists = set()
+    self._pending_deltas = {}
+    self._token = None
+    self._token_lock = threading.Lock()
+    self.credential = None
+    self.token_cache = TokenCache(
+      token_cache_path, os.environ.get('AZ_TENANT_ID'), os.environ.get('SP_CLIENT_ID')
+    )
+    # Time spent obtaining the Graph token, reported as part of start-up
+    self.auth_seconds = 0.0
+    self.session = requests.Session()
+    # Enough keep-alive connections for every list loader and the prefetch thread
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=list_workers + 1)
+    self.session.mount('http://', adapter)
+    self.session.mount('https://', adapter)
+    self.static_token = os.environ.get('GRAPH_ACCESS_TOKEN')
+    try:
+      self.site_id = self._get(
+        f'{graph_url}/sites/{os.environ.get("SP_SITE_ID")}:/sites/{site_name}'
+      )['id']
+      self.list_ids = {
+        sp_list['displayName']: sp_list['id']
+        for page in self._pages(
+          f'{graph_url}/sites/{self.site_id}/lists', {'$select': 'id,displayName'}
+        )
+        for sp_list in page.get('value', [])
+      }
+      for list_name, site_list_name in self.list_aliases.items():
+        if site_list_name in self.list_ids:
+          self.list_ids[list_name] = self.list_ids[site_list_name]
+      self.connection_ok = True
+    except Exception as e:
+      log_error('Unable to connect to SharePoint site %s: %s', site_name, e)
+      self.connection_ok = False
+
+  def _fetch_token(self):
+    start = time.monotonic()
+    if (token := self.token_cache.load()) is None:
+      if self.credential is None:
+        # Imported on first use, runs with a cached token never need it
+        from azure.identity import ClientSecretCredential
+
+        self.credential = ClientSecretCredential(
+          os.environ.get('AZ_TENANT_ID'),
+          os.environ.get('SP_CLIENT_ID'),
+          os.environ.get('SP_CLIENT_SECRET'),
+        )
+      token = self.credential.get_token(graph_scope)
+      self.token_cache.save(token)
+      log_debug('Fetched a new Graph access token')
+    self.auth_seconds += time.monotonic() - start
+    return token
+
+  def _headers(self):
+    if self.static_token:
+      token = self.static_token
+    else:
+      with self._token_lock:
+        if not self._token or self._token.expires_on - 60 < time.time():
+          self._token = self._fetch_token()
+        token = self._token.token
+    return {'Authorization': f'Bearer {token}', 'Accept': 'application/json'}
+
+  def _forget_token(self, rejected):
+    with self._token_lock:
+      if self._token and self._token.token == rejected:
+        self._token = None
+        self.token_cache.clear()
+
+  def _request(self, method, url, params=None, json=None):
+    reauthenticated = False
+    for attempt in range(retries + 1):
+      status = retry_after = None
+      headers = self._headers()
+      graph_limiter.acquire()
+      start = time.monotonic()
+      try:
+        response = self.session.request(
+          method, url, headers=headers, params=params, json=json, timeout=timeout
+        )
+        status, retry_after = response.status_code, retry_after_seconds(response)
+      finally:
+        graph_limiter.release(time.monotonic() - start, status, retry_after)
+      metrics.api_call(
+        'sharepoint',
+        method.lower(),
+        time.monotonic() - start,
+        response.status_code,
+        received=len(response.content),
+      )
+      if response.status_code == 401 and not self.static_token and not reauthenticated:
+        # A cached token can be revoked before it expires, fetch a new one once
+        self._forget_token(headers['Authorization'].removeprefix('Bearer '))
+        reauthenticated = True
+        continue
+      if response.status_code != 429 and response.status_code < 500:
+        break
+      if attempt < retries:
+        delay = retry_after or backoff * 2**attempt
+        delay += random.uniform(0, delay / 2)
+        log_warning('Graph returned %s, retrying in %.1fs', response.status_code, delay)
+        time.sleep(delay)
+    if response.status_code == 410:
+      raise DeltaExpired(url)
+    response.raise_for_status()
+    return response.json() if response.content else {}
+
+  def _get(self, url, params=None):
+    return self._request('GET', url, params)
+
+  def _pages(self, url, params=None):
+    while url:
+      page = self._get(url, params)
+      yield page
+      # nextLink/deltaLink already carry the query string
+      url, params = page.get('@odata.nextLink'), None
+
+  def _list_url(self, list_name):
+    if list_name not in self.list_ids:
+      raise KeyError(f'SharePoint list {list_name} not found in site {self.site_name}')
+    return f'{graph_url}/sites/{self.site_id}/lists/{self.list_ids[list_name]}'
+
+  def _fields_params(self, list_name):
+    if columns := self.columns.get(list_name):
+      return {'$expand': f'fields($select={columns})'}
+    return {'$expand': 'fields'}
+
+  def load_list(self, list_name):
+    items = [
+      item
+      for page in self._pages(
+        f'{self._list_url(list_name)}/items',
+        {'$select': 'id', **self._fields_params(list_name)},
+      )
+      for item in page.get('value', [])
+    ]
+    self._set_list(list_name, items)
+    self.changed_lists.add(list_name)
+    metrics.inc('discovery_records_read_total', len(items), source='sharepoint')
+    log_info('Loaded %s items from SharePoint list %s', len(items), list_name)
+
+  def _read_delta(self, list_name, delta_link):
+    upserts, deletes = {}, set()
+    if delta_link:
+      url, params = delta_link, None
+    else:
+      url = f'{self._list_url(list_name)}/items/delta'
+      params = self._fields_params(list_name)
+    for page in self._pages(url, params):
+      for item in page.get('value', []):
+        item_id = item.get('id')
+        if '@removed' in item or 'deleted' in item:
+          deletes.add(item_id)
+          upserts.pop(item_id, None)
+          continue
+        if 'fields' not in item:
+          item = self._get(
+            f'{self._list_url(list_name)}/items/{item_id}', self._fields_params(list_name)
+          )
+        upserts[item_id] = item
+        deletes.discard(item_id)
+      if page.get('@odata.deltaLink'):
+        delta_link = page['@odata.deltaLink']
+    return delta_link, upserts, deletes
+
+  def load_list_delta(self, list_name):
+    delta_link = self.state.delta_link(list_name)
+    columns = self.columns.get(list_name, '')
+    if delta_link and (self.state.list_columns(list_name) or '') != columns:
+      # The cached items were read with other columns, so they cannot be reused
+      log_info('Columns read from %s have changed, resynchronising the list', list_name)
+      delta_link = None
+    reset = delta_link is None
+    try:
+      delta_link, upserts, deletes = self._read_delta(list_name, delta_link)
+    except DeltaExpired:
+      log_warning('Delta link for %s has expired, resynchronising the list', list_name)
+      reset = True
+      delta_link, upserts, deletes = self._read_delta(list_name, None)
+
+    items = {} if reset else self.state.list_items(list_name)
+    for item_id in deletes:
+      items.pop(item_id, None)
+    items.update(upserts)
+    self._set_list(list_name, sorted(items.values(), key=item_sort_key))
+
+    if reset or upserts or deletes:
+      self.changed_lists.add(list_name)
+    self._pending_deltas[list_name] = (delta_link, upserts, deletes, reset)
+    metrics.inc('discovery_records_read_total', len(upserts), source='sharepoint')
+    log_info(
+      'SharePoint list %s: %s changed, %s removed, %s cached%s',
+      list_name,
+      len(upserts),
+      len(deletes),
+      len(items),
+      ' (full resync)' if reset else '',
+    )
+
+  def load_sharepoint_lists(self, list_names, workers=list_workers):
+    load = self.load_list_delta if self.incremental else self.load_list
+    pending = []
+    for list_name in list_names:
+      if list_name in self.streamed:
+        self.changed_lists.add(list_name)
+      else:
+        pending.append(list_name)
+    if not pending:
+      return
+    # Each list's data and lookup index is set as soon as that list completes
+    with ThreadPoolExecutor(
+      max_workers=max(1, min(workers, len(pending))), thread_name_prefix='sp-list'
+    ) as executor:
+      futures = {executor.submit(load, list_name): list_name for list_name in pending}
+      for future in as_completed(futures):
+        future.result()
+
+  def iter_list_pages(self, list_name):
+    if list_name not in self.streamed:
+      yield from super().iter_list_pages(list_name)
+      return
+    count = 0
+    pages = self._pages(
+      f'{self._list_url(list_name)}/items',
+      {'$select': 'id', '$top': page_size, **self._fields_params(list_name)},
+    )
+    for page in prefetched(pages, prefetch_pages):
+      items = page.get('value', [])
+      count += len(items)
+      metrics.inc('discovery_records_read_total', len(items), source='sharepoint')
+      yield items
+    log_info('Streamed %s items from SharePoint list %s', count, list_name)
+
+  def subscribe(self, list_name, notification_url, client_state, expires):
+    """Asks Graph to post change notifications for a list to `notification_url`."""
+    return self._request(
+      'POST',
+      f'{graph_url}/subscriptions',
+      json={
+        'changeType': 'updated',
+        'notificationUrl': notification_url,
+        'resource': f'sites/{self.site_id}/lists/{self.list_ids[list_name]}',
+        'expirationDateTime': expires.isoformat().replace('+00:00', 'Z'),
+        'clientState': client_state,
+      },
+    )
+
+  def renew_subscription(self, subscription_id, expires):
+    return self._request(
+      'PATCH',
+      f'{graph_url}/subscriptions/{subscription_id}',
+      json={'expirationDateTime': expires.isoformat().replace('+00:00', 'Z')},
+    )
+
+  def commit_delta(self):
+    # Only called after a successful run, so failed runs replay the same changes
+    for list_name, (delta_link, upserts, deletes, reset) in self._pending_deltas.items():
+      if delta_link:
+        self.state.save_list_delta(
+          list_name,
+          delta_link,
+          upserts,
+          deletes,
+          reset,
+          columns=self.columns.get(list_name, ''),
+        )
+        log_debug('Saved delta link for SharePoint list %s', list_name)
+    self._pending_deltas = {}
@@ -0,0 +1,59 @@
+"""The SharePoint sites discovery reads from.
+
+DISCOVERY_SITES holds a JSON list of sites, each with:
+
+- `name`: the shard name, used for its worker, state store, metrics and summary
+- `site`: the SharePoint site name
+- `lists` (optional): {list name the job reads: the list's name in this site}, for
+  sites whose lists are named differently
+- `key_prefixes` (optional): stable id prefixes the site owns; records with other ids
+  are left to the other sites
+
+Without it, discovery reads the one site it always has.
+"""
+
+import json
+import os
+from dataclasses import dataclass, field
+
+from includes.state import state_path
+
+
+@dataclass(frozen=True)
+class Site:
+  name: str
+  site: str
+  lists: dict = field(default_factory=dict)
+  key_prefixes: tuple = ()
+
+  @property
+  def state_path(self):
+    """A state store per shard, as list item ids and delta links are per site."""
+    root, extension = os.path.splitext(state_path)
+    return f'{root}-{self.name}{extension}'
+
+
+default_site = Site('delivery-operations', 'PrisonsDigital-DeliveryOperations')
+
+
+def load_sites(value=None):
+  """The configured sites; raises ValueError for a malformed DISCOVERY_SITES."""
+  value = os.environ.get('DISCOVERY_SITES') if value is None else value
+  if not value:
+    return [default_site]
+  try:
+    sites = [
+      Site(
+        str(entry['name']),
+        str(entry['site']),
+        dict(entry.get('lists') or {}),
+        tuple(entry.get('key_prefixes') or ()),
+      )
+      for entry in json.loads(value)
+    ]
+  except (TypeError, KeyError, AttributeError, json.JSONDecodeError) as e:
+    raise ValueError(f'DISCOVERY_SITES is not a list of sites: {e}') from None
+  names = [site.name for site in sites]
+  if not sites or len(set(names)) < len(names):
+    raise ValueError('DISCOVERY_SITES must name at least one site, each once')
+  return sites
@@ -0,0 +1,254 @@
+"""Local SQLite state kept between runs.
+
+Holds each SharePoint list's Graph delta link, the columns it was read with and the
+cached copy of its items, so an incremental run only needs to fetch what changed. It
+also holds the collection digests of entity types that were found unchanged, the
+index of SharePoint items to Service Catalogue documentIds (see includes/xref.py)
+and the write-ahead journal of this run's mutations (see includes/journal.py). With
+SC_STATE_CACHE it keeps the last-synced Service Catalogue records and their
+fingerprints too, with the time each collection was last checked against the live
+catalogue.
+
+Point DISCOVERY_STATE_PATH at a mounted volume for the state to survive between
+cronjob pods.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+
+state_path = os.environ.get(
+  'DISCOVERY_STATE_PATH', '/tmp/hmpps-sharepoint-discovery/state.db'
+)
+# A path of its own keeps the store even when no feature reads it back
+state_path_set = bool(os.environ.get('DISCOVERY_STATE_PATH'))
+
+schema = """
+create table if not exists delta_links (
+  list_name text primary key,
+  delta_link text not null,
+  updated_at text not null default current_timestamp
+);
+create table if not exists list_items (
+  list_name text not null,
+  item_id text not null,
+  item text not null,
+  primary key (list_name, item_id)
+);
+create table if not exists list_columns (
+  list_name text primary key,
+  columns text not null
+);
+create table if not exists xref (
+  list_name text not null,
+  item_id text not null,
+  document_id text not null,
+  primary key (list_name, item_id)
+);
+create table if not exists catalogue_records (
+  query text not null,
+  document_id text not null,
+  fingerprint text not null,
+  record text not null,
+  primary key (query, document_id)
+);
+create table if not exists sync_meta (
+  name text primary key,
+  value text not null,
+  updated_at text not null default current_timestamp
+);
+create table if not exists journal (
+  id integer primary key autoincrement,
+  run_id text not null,
+  action text not null,
+  table_name text not null,
+  document_id text,
+  data text,
+  label text not null default '',
+  status text not null default 'pending',
+  updated_at text not null default current_timestamp
+);
+create table if not exists digests (
+  entity text primary key,
+  digest text not null,
+  updated_at text not null default current_timestamp
+);
+"""
+
+
+class StateStore:
+  def __init__(self, path=state_path):
+    if os.path.dirname(path):
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+    self.path = path
+    self.db = sqlite3.connect(path, check_same_thread=False)
+    self.lock = threading.Lock()
+    with self.lock, self.db:
+      # Journal entries are committed one mutation at a time; WAL keeps that cheap
+      self.db.execute('pragma journal_mode=wal')
+      self.db.execute('pragma synchronous=normal')
+      self.db.executescript(schema)
+
+  def delta_link(self, list_name):
+    with self.lock:
+      row = self.db.execute(
+        'select delta_link from delta_links where list_name = ?', (list_name,)
+      ).fetchone()
+    return row[0] if row else None
+
+  def list_columns(self, list_name):
+    with self.lock:
+      row = self.db.execute(
+        'select columns from list_columns where list_name = ?', (list_name,)
+      ).fetchone()
+    return row[0] if row else None
+
+  def list_items(self, list_name):
+    with self.lock:
+      rows = self.db.execute(
+        'select item_id, item from list_items where list_name = ?', (list_name,)
+      ).fetchall()
+    return {item_id: json.loads(item) for item_id, item in rows}
+
+  def save_list_delta(
+    self, list_name, delta_link, upserts, deletes, reset=False, columns=''
+  ):
+    with self.lock, self.db:
+      if reset:
+        self.db.execute('delete from list_items where list_name = ?', (list_name,))
+      self.db.executemany(
+        'insert or replace into list_items (list_name, item_id, item) values (?, ?, ?)',
+        [(list_name, item_id, json.dumps(item, default=dict)) for item_id, item in upserts.items()],
+      )
+      self.db.executemany(
+        'delete from list_items where list_name = ? and item_id = ?',
+        [(list_name, item_id) for item_id in deletes],
+      )
+      self.db.execute(
+        'insert or replace into delta_links (list_name, delta_link) values (?, ?)',
+        (list_name, delta_link),
+      )
+      self.db.execute(
+        'insert or replace into list_columns (list_name, columns) values (?, ?)',
+        (list_name, columns),
+      )
+
+  def digest(self, entity):
+    with self.lock:
+      row = self.db.execute(
+        'select digest from digests where entity = ?', (entity,)
+      ).fetchone()
+    return row[0] if row else None
+
+  def save_digest(self, entity, digest):
+    with self.lock, self.db:
+      self.db.execute(
+        'insert or replace into digests (entity, digest) values (?, ?)', (entity, digest)
+      )
+
+  def xref(self, list_name):
+    with self.lock:
+      rows = self.db.execute(
+        'select item_id, document_id from xref where list_name = ?', (list_name,)
+      ).fetchall()
+    return dict(rows)
+
+  def save_xref(self, list_name, mapping):
+    with self.lock, self.db:
+      self.db.execute('delete from xref where list_name = ?', (list_name,))
+      self.db.executemany(
+        'insert into xref (list_name, item_id, document_id) values (?, ?, ?)',
+        [(list_name, item_id, document_id) for item_id, document_id in mapping.items()],
+      )
+
+  def catalogue_records(self, query):
+    with self.lock:
+      rows = self.db.execute(
+        'select record from catalogue_records where query = ?', (query,)
+      ).fetchall()
+    return [json.loads(record) for (record,) in rows]
+
+  def catalogue_fingerprints(self, query):
+    with self.lock:
+      rows = self.db.execute(
+        'select document_id, fingerprint from catalogue_records where query = ?',
+        (query,),
+      ).fetchall()
+    return dict(rows)
+
+  def save_catalogue_records(self, query, records):
+    with self.lock, self.db:
+      self.db.execute('delete from catalogue_records where query = ?', (query,))
+      self.db.executemany(
+        'insert or replace into catalogue_records '
+        '(query, document_id, fingerprint, record) values (?, ?, ?, ?)',
+        [
+          # Compact records (includes/records.py) are written out as plain objects
+          (query, document_id, record_fingerprint, json.dumps(record, default=dict))
+          for document_id, (record_fingerprint, record) in records.items()
+        ],
+      )
+
+  def expire_catalogue(self, collection):
+    # Stored copies of the collection are read live again on the next run
+    with self.lock, self.db:
+      self.db.execute(
+        "update sync_meta set value = '0' where name = ? or name like ?",
+        (f'checked:{collection}', f'checked:{collection}?%'),
+      )
+
+  def journal_add(self, run_id, action, table, document_id, data, label):
+    with self.lock, self.db:
+      cursor = self.db.execute(
+        'insert into journal (run_id, action, table_name, document_id, data, label) '
+        'values (?, ?, ?, ?, ?, ?)',
+        (run_id, action, table, document_id, json.dumps(data), label),
+      )
+    return cursor.lastrowid
+
+  def journal_mark(self, entry_id, status, document_id=None):
+    with self.lock, self.db:
+      self.db.execute(
+        'update journal set status = ?, document_id = coalesce(?, document_id), '
+        'updated_at = current_timestamp where id = ?',
+        (status, document_id, entry_id),
+      )
+
+  def journal_entries(self, run_id):
+    with self.lock:
+      rows = self.db.execute(
+        'select id, action, table_name, document_id, data, label, status from journal '
+        'where run_id = ? order by id',
+        (run_id,),
+      ).fetchall()
+    return [
+      {
+        'id': entry_id,
+        'action': action,
+        'table': table,
+        'document_id': document_id,
+        'data': json.loads(data) if data else None,
+        'label': label,
+        'status': status,
+      }
+      for entry_id, action, table, document_id, data, label, status in rows
+    ]
+
+  def clear_journal(self):
+    with self.lock, self.db:
+      self.db.execute('delete from journal')
+
+  def meta(self, name):
+    with self.lock:
+      row = self.db.execute('select value from sync_meta where name = ?', (name,)).fetchone()
+    return row[0] if row else None
+
+  def save_meta(self, name, value):
+    with self.lock, self.db:
+      self.db.execute(
+        'insert or replace into sync_meta (name, value) values (?, ?)', (name, str(value))
+      )
+
+  def close(self):
+    self.db.close()
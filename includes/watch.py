@@ -0,0 +1,193 @@
+"""Long-running watch mode, driven by Graph list change notifications.
+
+A small HTTP receiver takes Graph change-notification webhooks for the SharePoint
+lists. Graph validates a new subscription by posting a `validationToken`, which is
+echoed back. Notifications name the list that changed, not the items, and are
+debounced and coalesced per list. Once no new notification has arrived for
+WATCH_DEBOUNCE_SECONDS (or WATCH_MAX_DELAY_SECONDS after the first), the changed
+lists are synced: their items are read with Graph delta queries and only the phases
+that read those lists are run.
+
+A full reconcile of every list runs at start-up and every WATCH_RECONCILE_HOURS as a
+safety net for missed notifications. Subscriptions are created for each list when
+WATCH_NOTIFICATION_URL (the public address of the receiver) is set, and renewed at
+each reconcile. Notifications are only taken with the subscriptions' clientState
+(WATCH_CLIENT_STATE, or a random one per process).
+"""
+
+import json
+import os
+import secrets
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+from includes.log import log_debug, log_error, log_info, log_warning
+from includes.metrics import metrics
+
+watch_port = int(os.environ.get('WATCH_PORT', '8080'))
+notification_url = os.environ.get('WATCH_NOTIFICATION_URL')
+# Graph echoes it in every notification, so the receiver can tell them from any other
+# post to its public address. Without one set, each process makes up its own
+client_state = os.environ.get('WATCH_CLIENT_STATE') or secrets.token_urlsafe(32)
+debounce_seconds = float(os.environ.get('WATCH_DEBOUNCE_SECONDS', '10'))
+max_delay_seconds = float(os.environ.get('WATCH_MAX_DELAY_SECONDS', '60'))
+reconcile_hours = float(os.environ.get('WATCH_RECONCILE_HOURS', '24'))
+# Graph allows list subscriptions up to 30 days; they are renewed at each reconcile
+subscription_hours = float(os.environ.get('WATCH_SUBSCRIPTION_HOURS', '72'))
+
+# Set to leave watch mode (SIGTERM, or a test harness)
+stopping = threading.Event()
+
+
+class ChangeQueue:
+  """Coalesces changed list names until notifications have settled."""
+
+  def __init__(self, debounce=debounce_seconds, max_delay=max_delay_seconds):
+    self.debounce = debounce
+    self.max_delay = max_delay
+    self.pending = set()
+    self.first_at = self.last_at = 0.0
+    self.condition = threading.Condition()
+
+  def add(self, list_names):
+    with self.condition:
+      now = time.monotonic()
+      if not self.pending:
+        self.first_at = now
+      self.pending.update(list_names)
+      self.last_at = now
+      self.condition.notify_all()
+
+  def take(self, timeout):
+    """The lists changed once settled, or an empty set after `timeout` seconds."""
+    deadline = time.monotonic() + timeout
+    with self.condition:
+      while not stopping.is_set():
+        now = time.monotonic()
+        if self.pending:
+          due = min(self.last_at + self.debounce, self.first_at + self.max_delay)
+          if now >= due:
+            changed, self.pending = self.pending, set()
+            return changed
+          wait = min(due, deadline) - now
+        else:
+          wait = deadline - now
+        if wait <= 0:
+          return set()
+        self.condition.wait(min(wait, 1))
+    return set()
+
+
+class NotificationHandler(BaseHTTPRequestHandler):
+  def _send(self, status, body=b'', content_type='text/plain'):
+    self.send_response(status)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_GET(self):
+    self._send(200 if urlsplit(self.path).path == '/health' else 404, b'ok')
+
+  def do_POST(self):
+    payload = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+    params = dict(parse_qsl(urlsplit(self.path).query))
+    if token := params.get('validationToken'):
+      # Subscription handshake: Graph expects the token back as plain text
+      return self._send(200, token.encode())
+    try:
+      notifications = json.loads(payload or b'{}').get('value', [])
+    except ValueError:
+      return self._send(400)
+    changed = set()
+    for notification in notifications:
+      received = str(notification.get('clientState')).encode()
+      if not secrets.compare_digest(received, client_state.encode()):
+        log_warning('Ignoring a change notification with an unexpected clientState')
+        continue
+      list_id = str(notification.get('resource', '')).rstrip('/').split('/')[-1]
+      if list_name := self.server.list_names.get(list_id):
+        changed.add(list_name)
+    metrics.inc('discovery_notifications_total', len(notifications))
+    if changed:
+      log_debug('Change notification for %s', sorted(changed))
+      self.server.changes.add(changed)
+    # Graph retries notifications that are not acknowledged quickly
+    self._send(202)
+
+  def log_message(self, format, *args):
+    log_debug(format, *args)
+
+
+class NotificationReceiver(ThreadingHTTPServer):
+  daemon_threads = True
+
+  def __init__(self, changes, list_names, port=watch_port):
+    super().__init__(('0.0.0.0', port), NotificationHandler)
+    self.changes = changes
+    # Graph list id -> list display name
+    self.list_names = list_names
+
+  def start(self):
+    threading.Thread(target=self.serve_forever, daemon=True).start()
+    return self
+
+
+def subscribe(sp, list_names, subscriptions):
+  expires = datetime.now(timezone.utc) + timedelta(hours=subscription_hours)
+  for list_name in list_names:
+    try:
+      if subscription_id := subscriptions.get(list_name):
+        sp.renew_subscription(subscription_id, expires)
+      else:
+        subscriptions[list_name] = sp.subscribe(
+          list_name, notification_url, client_state, expires
+        )['id']
+    except Exception as e:
+      # Renewal fails for expired subscriptions, they are created again next time
+      log_error('Unable to subscribe to changes in %s: %s', list_name, e)
+      subscriptions.pop(list_name, None)
+
+
+def run(sync, services, changed):
+  # A failed sync is reported and retried by the next notification or reconcile
+  try:
+    sync(services, changed)
+  except Exception as e:
+    log_error('Watch mode sync failed: %s', e)
+
+
+def watch(services, sync, list_names, port=watch_port):
+  """Runs `sync(services, changed_lists)` on change notifications until stopped.
+
+  `sync` is called with None for a full reconcile of `list_names`.
+  """
+  changes = ChangeQueue()
+  receiver = NotificationReceiver(
+    changes,
+    {list_id: name for name, list_id in services.sp.list_ids.items() if name in list_names},
+    port,
+  ).start()
+  log_info(
+    'Watching %s SharePoint lists, notifications on port %s', len(list_names), port
+  )
+  subscriptions = {}
+  next_reconcile = 0.0
+  try:
+    while not stopping.is_set():
+      if time.monotonic() >= next_reconcile:
+        log_info('Running a full reconcile')
+        if notification_url:
+          subscribe(services.sp, list_names, subscriptions)
+        run(sync, services, None)
+        next_reconcile = time.monotonic() + reconcile_hours * 3600
+      if changed := changes.take(timeout=max(0.0, next_reconcile - time.monotonic())):
+        log_info('Syncing changed SharePoint lists: %s', sorted(changed))
+        run(sync, services, changed)
+  finally:
+    receiver.shutdown()
+    receiver.server_close()
+    log_info('Watch mode stopped')
@@ -0,0 +1,72 @@
+"""Cross-reference from SharePoint list items to Service Catalogue documentIds.
+
+SharePoint lookup columns hold the item id of the referenced list item. Each entity
+phase links its list's items to the catalogue records that carry the same stable id
+(t_id, ps_id, sa_id, p_id), so a reference resolves straight to a documentId. Display
+names are not involved, so duplicate or renamed names cannot link the wrong record.
+
+The index is kept in the state store, so a phase that is skipped (or a list that is
+not reloaded) still leaves its references resolvable on the next run.
+"""
+
+import threading
+
+from includes.log import log_debug, log_warning
+from includes.metrics import metrics
+
+
+def stable_id(value):
+  if value is None:
+    return None
+  return str(value).strip() or None
+
+
+def item_keys(items, source_key):
+  """{item id: stable id} for raw SharePoint items, read from their `source_key` column."""
+  return {item['id']: (item.get('fields') or {}).get(source_key) for item in items}
+
+
+class CrossReference:
+  def __init__(self, state=None):
+    self.state = state
+    self._maps = {}
+    self._lock = threading.Lock()
+
+  def _map(self, list_name):
+    with self._lock:
+      if list_name not in self._maps:
+        self._maps[list_name] = self.state.xref(list_name) if self.state else {}
+      return self._maps[list_name]
+
+  def resolve(self, list_name, item_id):
+    """The documentId of the record a SharePoint item of `list_name` is, or None."""
+    if item_id is None:
+      return None
+    return self._map(list_name).get(str(item_id))
+
+  def linked(self, list_name):
+    """Whether any items of `list_name` are linked, this run or a previous one."""
+    return bool(self._map(list_name))
+
+  def link(self, list_name, keys, records, key):
+    """Links items of `list_name` ({item id: stable id}) to the records with that `key`."""
+    document_ids = {}
+    for record in records:
+      if (value := stable_id(record.get(key))) is None:
+        continue
+      if value in document_ids:
+        log_warning('Duplicate %s %s in Service Catalogue, using the first', key, value)
+        continue
+      document_ids[value] = record.get('documentId')
+    mapping = {
+      str(item_id): document_id
+      for item_id, value in keys.items()
+      if (document_id := document_ids.get(stable_id(value)))
+    }
+    with self._lock:
+      self._maps[list_name] = mapping
+    if self.state:
+      self.state.save_xref(list_name, mapping)
+    log_debug('Linked %s %s items to Service Catalogue records', len(mapping), list_name)
+    metrics.set('discovery_xref_entries', len(mapping), list=list_name)
+    return mapping
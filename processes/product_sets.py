@@ -1,34 +1,48 @@
-from hmpps.services.job_log_handling import log_warning, log_info, log_debug
 import json
 
-
-def find_lead_developer(sp_product_set, sp_lead_developer_dict):
-  if lead_developer_id := sp_product_set.get('fields').get('LeadDeveloperLookupId'):
-    return (
-      sp_lead_developer_dict.get(lead_developer_id, {}).get('fields', {}).get('Title')
-    ) or None
-  else:
-    product_set_id = sp_product_set.get('fields').get('ProductSetID', 'Unknown')
-    log_warning(
-      f'Product Set {product_set_id} Lead Developer ID {lead_developer_id} '
-      'not found in SharePoint lead developers data.'
-    )
-  return None
+from includes.comparison import Comparison
+from includes.diff import describe_patch, minimal_patch
+from includes.field_mapping import Field, Schema
+from includes.log import lazy, log_debug, log_info, log_warning
+from includes.xref import item_keys
+
+product_set_schema = Schema(
+  'product-sets',
+  key='ProductSetID',
+  fields=[
+    Field('ps_id', 'ProductSetID'),
+    Field('name', 'ProductSet'),
+    Field(
+      'lead_developer',
+      'LeadDeveloperLookupId',
+      lookup='Lead Developers',
+      lookup_field='Title',
+      missing='Product Set {key} Lead Developer ID {reference} '
+      'not found in SharePoint lead developers data.',
+    ),
+    # "updated_by_id": 34
+  ],
+)
+product_set_fields = tuple(field.target for field in product_set_schema.fields)
+# The SharePoint lists this phase reads
+source_lists = ('Product Set', *product_set_schema.lookup_columns())
+
+
+def link_sp_product_sets(services):
+  # Products resolve their Product Set lookups to documentIds through this
+  services.xref.link(
+    'Product Set',
+    item_keys(services.sp.data['Product Set'].get('value', []), product_set_schema.key),
+    services.sc.get_all_records('product-sets', fields=product_set_fields),
+    'ps_id',
+  )
 
 
 def fetch_sp_product_sets_data(sp):
-  sp_product_sets_data = []
-  for sp_product_set in sp.data['Product Set'].get('value'):
-    if product_set_id := sp_product_set.get('fields', {}).get('ProductSetID', None):
-      lead_developer = find_lead_developer(sp_product_set, sp.dict['Lead Developers'])
-      sp_product_set_data = {
-        'ps_id': product_set_id,
-        'name': sp_product_set.get('fields').get('ProductSet', None),
-        'lead_developer': lead_developer,
-        # "updated_by_id": 34
-      }
-      sp_product_sets_data.append(sp_product_set_data)
-  log_debug(f'sp_product_sets_data is:\n{json.dumps(sp_product_sets_data, indent=2)}')
+  sp_product_sets_data = product_set_schema.extract(sp.data['Product Set'].get('value'), sp)
+  log_debug(
+    'sp_product_sets_data is:\n%s', lazy(json.dumps, sp_product_sets_data, indent=2)
+  )
   return sp_product_sets_data
 
 
@@ -39,11 +53,12 @@ def process_sc_product_sets(services):
 
   sc = services.sc
   sp = services.sp
+  selection = services.selection
 
   log_info('Processing Product Sets')
 
   # Fetch the data from Service Catalogue
-  sc_product_sets_data = sc.get_all_records('product-sets')
+  sc_product_sets_data = sc.get_all_records('product-sets', fields=product_set_fields)
   if not sc_product_sets_data:
     log_warning('No product sets returned from the Service Catalogue')
 
@@ -61,45 +76,85 @@ def process_sc_product_sets(services):
 
   # Compare and update sp_product_set_data
   log_info('Comparing and updating product sets in service catalogue')
-  change_count = 0
+  writer = services.writer
+  writes = []
   log_messages = []
 
   # Quick summary before we start
   log_info(
-    f'Found {len(sp.data["Product Set"].get("value", []))} product sets in Sharepoint'
+    'Found %s product sets in Sharepoint', len(sp.data['Product Set'].get('value', []))
   )
-  log_info(f'Found {len(sc_product_sets_data)} product sets in Service Catalogue')
+  log_info('Found %s product sets in Service Catalogue', len(sc_product_sets_data))
+
+  # Fingerprints let unchanged product sets (or the whole collection) skip comparison
+  comparison = Comparison(
+    services,
+    'product-sets',
+    product_set_fields,
+    sp_product_sets_dict,
+    sc_product_sets_dict,
+  )
+  if comparison.unchanged:
+    log_and_append('Product Sets unchanged since the last successful run, not compared')
+    link_sp_product_sets(services)
+    return log_messages
 
   log_info('************** Processing Product Sets *********************')
   for sp_product_set in sp_product_sets_data:
     ps_id = sp_product_set.get('ps_id')
-    log_debug(f'Comparing product set {ps_id}')
+    if not selection.wants(ps_id):
+      continue
+    log_debug('Comparing product set %s', ps_id, sample=True)
     if ps_id not in sc_product_sets_dict:
       log_and_append(f'Adding product set :: {sp_product_set.get("name")}')
-      sc.add('product-sets', sp_product_set)
-      change_count += 1
+      writes.append(
+        writer.add('product-sets', sp_product_set, label=f'Product Set {ps_id}')
+      )
+      continue
+
+    if comparison.matches(ps_id):
       continue
 
     sc_product_set = sc_product_sets_dict.get(ps_id, {})
-    log_debug(f'\ncomparing SC product set {sc_product_set}'
-               f'\nwith SP product set {sp_product_set}')
-    if (sp_product_set.get('name', '').strip() != sc_product_set.get('name', '').strip()
-        or sp_product_set.get('lead_developer', '') != 
-        sc_product_set.get('lead_developer', '')):
+    log_debug(
+      '\ncomparing SC product set %s\nwith SP product set %s',
+      sc_product_set,
+      sp_product_set,
+      sample=True,
+    )
+    # One update per product set, carrying only the fields that changed
+    if patch := minimal_patch(sp_product_set, sc_product_set):
       log_and_append(
-        f'Updating product set :: ps_id {ps_id} :: {sc_product_set} -> {sp_product_set}'
+        f'Updating product set :: ps_id {ps_id} :: '
+        f'{describe_patch(patch, sc_product_set)}'
+      )
+      writes.append(
+        writer.update(
+          'product-sets',
+          sc_product_set.get('documentId'),
+          patch,
+          label=f'Product Set {ps_id}',
+        )
       )
-      sc.update('product-sets', sc_product_set.get('documentId'), sp_product_set)
-      change_count += 1
     else:
-      log_info(f'No changes detected for Product Set ps_id {ps_id}')
+      log_info('No changes detected for Product Set ps_id %s', ps_id)
 
   # Delete the product sets that no longer exist in Sharepoint
   for sc_product_set in sc_product_sets_data:
-    if sc_product_set.get('ps_id') not in sp_product_sets_dict:
+    ps_id = sc_product_set.get('ps_id')
+    if ps_id not in sp_product_sets_dict and selection.deletes_record(ps_id):
       log_and_append(f'Deleting product set :: {sc_product_set}')
-      sc.delete('product-sets', sc_product_set.get('documentId'))
-      change_count += 1
+      writes.append(
+        writer.delete(
+          'product-sets',
+          sc_product_set.get('documentId'),
+          label=f'Product Set {ps_id}',
+        )
+      )
+
+  failed_messages, change_count = comparison.finish(writes, len(sp_product_sets_data))
+  log_messages.extend(failed_messages)
+  link_sp_product_sets(services)
 
   log_and_append(f'Product Sets in Service Catalogue processed: {change_count}')
   return log_messages
@@ -1,14 +1,32 @@
-import os
-import re
 import html
+from collections.abc import Mapping
 from datetime import datetime
-from hmpps.services.job_log_handling import (
-  log_debug,
-  log_error,
-  log_info,
-)
 
-log_level = os.environ.get('LOG_LEVEL', 'INFO').upper()
+from includes.catalogue_writer import DocumentRef
+from includes.comparison import wait_for_writes
+from includes.diff import describe_patch, minimal_patch
+from includes.field_mapping import Field, Schema, matches, memoised
+from includes.fingerprint import fingerprint, normalise_value
+from includes.log import log_debug, log_error, log_info
+from includes.metrics import metrics
+from includes.xref import stable_id
+
+products_list = 'Products and Teams Main List'
+# Catalogue relations, and the SharePoint list their lookup ids refer to
+relation_lists = {
+  'parent': products_list,
+  'team': 'Teams',
+  'product_set': 'Product Set',
+  'service_area': 'Service Areas',
+}
+relation_keys = tuple(relation_lists)
+# The catalogue collection each relation refers to
+relation_collections = {
+  'parent': 'products',
+  'team': 'teams',
+  'product_set': 'product-sets',
+  'service_area': 'service-areas',
+}
 
 
 def clean_value(value):
@@ -19,136 +37,152 @@ def clean_value(value):
   return value
 
 
-def fetchID(sp_product, dict, key):
-  if key in sp_product and sp_product[key] is not None:
-    parent_key = sp_product[key]
-    if parent_key in dict:
-      sp_product[key] = dict[parent_key]['documentId']
-    else:
-      log_error(
-        f'Product reference key not found for {key} in Service Catalogue :: '
-        f'{sp_product[key]}'
-      )
-      del sp_product[key]
-  return sp_product
-
-
-# generic lookup
-def link_product_data(sp, sp_product):
-  log_debug('Linking product with other Sharepoint data')
-  product_id = sp_product.get('fields', {}).get('ProductID', None)
-  product_data = {}
-  # This is a tuple of
-  # dictionary_key,lookup_key,sharepoint_list,field_to_return
-  fields = [
-    ('parent', 'ParentProductLookupId', 'Products and Teams Main List', 'Product'),
-    ('team', 'TeamLookupId', 'Teams', 'Team'),
-    ('product_set', 'ProductSetLookupId', 'Product Set', 'ProductSet'),
-    ('service_area', 'ServiceAreaLookupId', 'Service Areas', 'ServiceArea'),
-    (
+@memoised
+def normalise_product_value(value):
+  return normalise_value(clean_value(value))
+
+
+def sc_product_view(sc_product):
+  # Relations come back from the catalogue as objects, compared by their documentId.
+  # Records written this run (or stored from the last) hold the documentId itself
+  view = dict(sc_product.items())
+  for key in relation_keys:
+    related = view.get(key)
+    view[key] = related.get('documentId') if isinstance(related, Mapping) else related
+  if view.get('decommissioned') is None:
+    view['decommissioned'] = False
+  return view
+
+
+def product_compare_keys(sp_product):
+  # Only populated SharePoint values are ever compared
+  return [
+    key
+    for key, value in sp_product.items()
+    if value is not None and key != 'updated_by_id'
+  ]
+
+
+def product_fingerprint(product, keys):
+  return fingerprint(product, keys, normalise=normalise_product_value)
+
+
+def format_date(date_str):
+  if not date_str:
+    return None
+  try:
+    # Parse the date string and convert to 'DD/MM/YYYY'
+    return datetime.strptime(date_str, '%Y-%m-%dT%H:%M:%SZ').strftime('%Y-%m-%d')
+  except ValueError:
+    log_error('Invalid date format: %s', date_str)
+    return None
+
+
+def is_value(expected):
+  return lambda value: str(value or '').strip().lower() == expected
+
+
+def reference(target, source):
+  # Lookup ids, resolved to catalogue documentIds through the cross-reference
+  return Field(target, source, normalise=stable_id)
+
+
+def relation(target, source, sp_list, sp_field):
+  # Lookups to other Sharepoint lists, only present when the product references one
+  return Field(
+    target,
+    source,
+    lookup=sp_list,
+    lookup_field=sp_field,
+    omit_missing=True,
+    unresolved=f'{target} matching {source} not found for product_id: {{key}}',
+  )
+
+
+product_schema = Schema(
+  'products',
+  key='ProductID',
+  fields=[
+    Field(
+      'p_id',
+      'ProductID',
+      validate=matches(r'^[A-Z]{3,5}[0-9]{0,5}$'),
+      invalid='Invalid productId format for product_id: {key}',
+    ),
+    Field(
+      'name',
+      'Product',
+      normalise=memoised(clean_value),
+      validate=matches(r'^.+$'),
+      invalid='Invalid name format for product_id: {key}',
+    ),
+    # set subproduct directly from the comparison
+    Field('subproduct', 'ProductType', normalise=is_value('subproduct')),
+    Field(
+      'description',
+      'Description_x0028_SourceData_x00',
+      normalise=memoised(clean_value),
+    ),
+    Field('phase', 'field_7'),
+    Field('slack_channel_id', 'SlackchannelID'),
+    Field('portfolio', 'Portfolio', normalise=memoised(clean_value)),
+    Field('business_owner', 'HMPPSBusinessOwner', normalise=memoised(clean_value)),
+    Field('decommissioned', 'DecommissionedProduct', normalise=is_value('yes')),
+    # Not memoised, so every product with an invalid date is reported
+    Field('decommissioned_date', 'DecommissionedEndDate', normalise=format_date),
+    # "updated_by_id": 34
+    reference('parent', 'ParentProductLookupId'),
+    reference('team', 'TeamLookupId'),
+    reference('product_set', 'ProductSetLookupId'),
+    reference('service_area', 'ServiceAreaLookupId'),
+    relation(
       'delivery_manager',
       'DeliveryManagerLookupId',
       'Delivery Managers',
       'DeliveryManagerName',
     ),
-    (
+    relation(
       'product_manager',
       'ProductManagerLookupId',
       'Product Managers',
       'ProductManagerName',
     ),
-    ('lead_developer', 'LeadDeveloperLookupId', 'Lead Developers', 'Title'),
-    (
+    relation('lead_developer', 'LeadDeveloperLookupId', 'Lead Developers', 'Title'),
+    relation(
       'technical_architect',
       'TechnicalArchitectLookupId',
       'Technical Architects',
       'TechnicalArchitectName',
     ),
-    (
+    relation(
       'principal_architect',
       'OversightPrincipalTechnicalArchiLookupId',
       'Principal Technical Architect',
       'PrincipalTechnicalArchitectName',
     ),
-  ]
-  for field in fields:
-    if field_id := sp_product.get('fields', {}).get(field[1]):
-      product_data[field[0]] = (
-        sp.dict[field[2]].get(field_id, {}).get('fields', {}).get(field[3], None)
-      )
-      if not product_data[field[0]]:
-        log_error(
-          f'{field[0]} matching {field[1]} not found for product_id: {product_id}'
-        )
-  return product_data
-
-
-def extract_sp_products_data(sp):
-  sp_products_data = []
-  for sp_product in sp.data['Products and Teams Main List'].get('value'):
-    log_debug(
-      'Extracting SharePoint product data for: '
-      f'{sp_product.get("fields", {}).get("ProductID", None)}'
-    )
-
-    product_id = sp_product.get('fields', {}).get('ProductID', None)
-    if product_id:
-      if not re.match(r'^.+$', sp_product.get('fields', {}).get('Product')):
-        log_error(f'Invalid name format for product_id: {product_id}')
+  ],
+)
+product_fields = tuple(field.target for field in product_schema.fields)
+product_scalar_fields = tuple(key for key in product_fields if key not in relation_keys)
+# Populated relations always carry their documentId
+product_relation_fields = {key: ('name',) for key in relation_keys}
+# The SharePoint lists this phase reads; other relations resolve through the
+# cross-reference the other phases link
+source_lists = (products_list, *product_schema.lookup_columns())
 
-      if not re.match(
-        r'^[A-Z]{3,5}[0-9]{0,5}$', sp_product.get('fields', {}).get('ProductID')
-      ):
-        log_error(f'Invalid productId format for product_id: {product_id}')
 
-      # set subproductBool directly from the comparison
-      subproductBool = (
-        str(sp_product.get('fields', {}).get('ProductType', '')).strip().lower()
-        == 'subproduct'
-      )
+def iter_sp_products_data(sp, note_item):
+  # One batch per SharePoint page, extracted while the next page is fetched. Item ids
+  # are noted as pages arrive, so parent lookups can be matched to products
+  def pages():
+    for page in sp.iter_list_pages(products_list):
+      for item in page:
+        if p_id := stable_id((item.get('fields') or {}).get(product_schema.key)):
+          note_item(str(item['id']), p_id)
+      yield page
 
-      # fetch links to other Sharepoint lists
-      linked_product_data = link_product_data(sp, sp_product)
-
-      sp_product_data = {
-        'p_id': product_id,
-        'name': clean_value(sp_product.get('fields', {}).get('Product', None)),
-        'subproduct': subproductBool,
-        'description': clean_value(
-          sp_product['fields'].get('Description_x0028_SourceData_x00', None)
-        ),
-        'phase': sp_product.get('fields', {}).get('field_7', None),
-        'slack_channel_id': sp_product.get('fields', {}).get('SlackchannelID', None),
-        'portfolio': clean_value(sp_product.get('fields', {}).get('Portfolio', None)),
-        'business_owner': clean_value(
-          sp_product.get('fields', {}).get('HMPPSBusinessOwner', None)
-        ),
-        'decommissioned': clean_value(
-          str(sp_product.get('fields', {}).get('DecommissionedProduct', ''))
-          .strip()
-          .lower()
-          == 'yes'
-        ),
-        'decommissioned_date': format_date(
-          sp_product.get('fields', {}).get('DecommissionedEndDate', None)
-        ),
-        # "updated_by_id": 34
-      }
-      # add the fetched data
-      sp_product_data.update(linked_product_data)
-      sp_products_data.append(sp_product_data)
-  return sp_products_data
-
-
-def format_date(date_str):
-  if not date_str:
-    return None
-  try:
-    # Parse the date string and convert to 'DD/MM/YYYY'
-    return datetime.strptime(date_str, '%Y-%m-%dT%H:%M:%SZ').strftime('%Y-%m-%d')
-  except ValueError:
-    log_error(f'Invalid date format: {date_str}')
-    return None
+  log_debug('Streaming SharePoint product data')
+  return product_schema.extract_pages(pages(), sp, products_list)
 
 
 def process_sc_products(services):
@@ -158,153 +192,198 @@ def process_sc_products(services):
 
   sc = services.sc
   sp = services.sp
+  xref = services.xref
+  selection = services.selection
 
   # Service Catalogue
   log_info('Processing Products ')
 
-  log_debug(
-    'Fetching Products, Teams, Products Sets, Service Areas from Service Catalogue'
+  log_debug('Fetching Products from Service Catalogue')
+  # Only the compared fields, and the documentIds of the related records
+  sc_products_data = sc.get_all_records(
+    'products', fields=product_scalar_fields, populate=product_relation_fields
   )
-  sc_products_data = sc.get_all_records(sc.sharepoint_discovery_products_get)
-  sc_teams_data = sc.get_all_records('teams')
-  sc_product_sets_data = sc.get_all_records('product-sets')
-  sc_service_areas_data = sc.get_all_records('service-areas')
   # Create the dictionaries
   sc_products_dict = {
     product.get('p_id').strip(): product for product in sc_products_data
   }
-  sc_product_name_dict = {
-    product.get('name').strip(): product for product in sc_products_data
-  }
-  sc_team_name_dict = {team.get('name').strip(): team for team in sc_teams_data}
-  sc_product_set_name_dict = {
-    product_set.get('name').strip(): product_set for product_set in sc_product_sets_data
-  }
-  sc_service_area_name_dict = {
-    service_area.get('name').strip(): service_area
-    for service_area in sc_service_areas_data
-  }
+  sc_document_ids = {product.get('documentId') for product in sc_products_data}
 
-  # Sharepoint data processing
-  sp_products_data = extract_sp_products_data(sp)
+  log_info('Found %s products in Service Catalogue', len(sc_products_data))
 
-  # Quick summary before we start
-  log_info(f'Found {len(sp_products_data)} products in SharePoint (after processing)')
-  log_info(f'Found {len(sc_products_data)} products in Service Catalogue')
-
-  # Compare and update sp_product_data
-  log_info('Processing prepared products sharepoint data for service catalogue ')
-  change_count = 0
   log_messages = []
-  log_info('************** Processing Products *********************')
-  for sp_product in sp_products_data:
+
+  # SharePoint item id <-> p_id, for every product page that has arrived so far
+  item_products = {}
+  product_items = {}
+
+  def note_item(item_id, p_id):
+    item_products[item_id] = p_id
+    product_items[p_id] = item_id
+  # Products added this run, so children can link to them before the catalogue has
+  # returned their documentIds; products whose parent has not been written yet (it
+  # is new and further down the list) wait for it
+  pending_adds = {}
+  waiting = {}
+
+  def resolve_parent(sp_product, hold):
+    # Returns the parent's item id when the product has to wait for it
+    if (item_id := sp_product.get('parent')) is None:
+      sp_product.pop('parent', None)
+      return None
+    parent_p_id = item_products.get(item_id)
+    if parent_p_id in pending_adds:
+      sp_product['parent'] = DocumentRef(pending_adds[parent_p_id])
+    elif parent_p_id in sc_products_dict:
+      sp_product['parent'] = sc_products_dict[parent_p_id].get('documentId')
+    elif parent_p_id is None and (
+      document_id := xref.resolve(products_list, item_id)
+    ) in sc_document_ids:
+      # Not streamed in yet, but linked on an earlier run
+      sp_product['parent'] = document_id
+    elif hold:
+      return item_id
+    else:
+      log_error(
+        'parent matching %s not found for product_id: %s', item_id, sp_product['p_id']
+      )
+      del sp_product['parent']
+    return None
+
+  # documentId -> name of the related records, read when first needed
+  related_names = {}
+
+  def related(collection):
+    if collection not in related_names:
+      related_names[collection] = {
+        record.get('documentId'): record.get('name')
+        for record in sc.get_all_records(collection, fields=('name',))
+      }
+    return related_names[collection]
+
+  def resolve_relations(sp_product):
+    for key, list_name in relation_lists.items():
+      if key == 'parent':
+        continue
+      if (item_id := sp_product.get(key)) is None:
+        sp_product.pop(key, None)
+      # A stored link can outlive its record, e.g. a team deleted and recreated
+      elif (document_id := xref.resolve(list_name, item_id)) in related(
+        relation_collections[key]
+      ):
+        sp_product[key] = document_id
+      else:
+        log_error(
+          '%s matching %s not found for product_id: %s', key, item_id, sp_product['p_id']
+        )
+        del sp_product[key]
+
+  def named(record):
+    # Relations are written as documentIds but reported by the related record's name
+    shown = dict(record)
+    for key in relation_keys:
+      if (value := shown.get(key)) is None:
+        continue
+      if isinstance(value, DocumentRef):
+        shown[key] = (value.mutation.data or {}).get('name')
+      else:
+        shown[key] = related(relation_collections[key]).get(value, value)
+    return shown
+
+  def compare(sp_product):
+    nonlocal skipped_count
     p_id = sp_product.get('p_id')
-    log_debug(f'Comparing Product p_id {p_id} :: {sp_product}')
-    if p_id in sc_products_dict:
-      try:
-        sc_product = sc_products_dict.get(p_id, {})
-        log_debug(
-          f'\nComparing SC product {sc_product} \n with SP product {sp_product}'
+    if p_id not in sc_products_dict:
+      log_and_append(f'Adding Product :: {named(sp_product)}')
+      pending_adds[p_id] = writer.add('products', sp_product, label=f'Product {p_id}')
+      writes.append(pending_adds[p_id])
+      return
+    sc_product = sc_products_dict.get(p_id, {})
+    sc_view = sc_product_view(sc_product)
+    compare_keys = product_compare_keys(sp_product)
+    if product_fingerprint(sp_product, compare_keys) == product_fingerprint(
+      sc_view, compare_keys
+    ):
+      skipped_count += 1
+      return
+    try:
+      log_debug(
+        '\nComparing SC product %s \n with SP product %s',
+        sc_product,
+        sp_product,
+        sample=True,
+      )
+      # One update per product, carrying only the fields that changed
+      patch = minimal_patch(
+        sp_product,
+        sc_view,
+        keys=[key for key in compare_keys if key in sc_product and key != 'p_id'],
+        normalise=normalise_product_value,
+      )
+      if patch:
+        log_and_append(
+          f'SC Updating Products p_id {p_id} :: '
+          f'{describe_patch(named(patch), named(sc_view))}'
         )
-        mismatch_flag = False
-        for key in list(sp_product.keys()):
-          sp_value = clean_value(sp_product.get(key))
-          sc_value = None
-          compare_flag = False
-          if key in sp_product and key in sc_product:
-            compare_flag = True
-          if (
-            compare_flag
-            and key != 'updated_by_id'
-            and key != 'subproduct'
-            and key != 'decommissioned'
-            and key != 'p_id'
-          ):
-            if (
-              key == 'parent'
-              or key == 'team'
-              or key == 'product_set'
-              or key == 'service_area'
-            ):
-              if sc_product.get(key):
-                try:
-                  sc_value = clean_value(sc_product.get(key).get('name'))
-                except KeyError:
-                  log_error(
-                    f'Key {key} not found in Service Catalogue data for p_id {p_id}'
-                  )
-            else:
-              try:
-                sc_value = clean_value(sc_product.get(key))
-              except KeyError:
-                log_error(
-                  f'Key {key} not found in Service Catalogue data for p_id {p_id}'
-                )
-
-            if sp_value is not None:
-              if (sp_value or '').strip() != (sc_value or '').strip():
-                log_and_append(
-                  f'SC Updating Products p_id {p_id}({key}) :: {sc_value} -> {sp_value}'
-                )
-                log_info(
-                  f'SC Updating Products p_id {p_id}({key}) :: {sc_value} -> {sp_value}'
-                )
-                mismatch_flag = True
-              else:
-                del sp_product[key]
-
-          elif compare_flag and key == 'subproduct':
-            if sp_product.get(key) != sc_product.get(key):
-              log_and_append(
-                f'Updating Products p_id {p_id}({key}) :: {sp_value} -> {sc_value}'
-              )
-              mismatch_flag = True
-            else:
-              del sp_product[key]
-          elif compare_flag and key == 'decommissioned':
-            sp_value = sp_product.get(key)
-            sc_value = sc_product.get(key) if sc_product.get(key) is not None else False
-            if sp_value != sc_value:
-              log_and_append(
-                f'Updating Products p_id {p_id}({key}) :: {sp_value} -> {sc_value}'
-              )
-              mismatch_flag = True
-            else:
-              del sp_product[key]
-
-        if mismatch_flag:
-          sp_product = (
-            fetchID(sp_product, sc_product_name_dict, 'parent')
-            if 'parent' in sp_product
-            else sp_product
-          )
-          sp_product = (
-            fetchID(sp_product, sc_team_name_dict, 'team')
-            if 'team' in sp_product
-            else sp_product
-          )
-          sp_product = (
-            fetchID(sp_product, sc_product_set_name_dict, 'product_set')
-            if 'product_set' in sp_product
-            else sp_product
+        writes.append(
+          writer.update(
+            'products', sc_product.get('documentId'), patch, label=f'Product {p_id}'
           )
-          sp_product = (
-            fetchID(sp_product, sc_service_area_name_dict, 'service_area')
-            if 'service_area' in sp_product
-            else sp_product
-          )
-          sc.update('products', sc_product.get('documentId'), sp_product)
-          change_count += 1
-      except Exception as e:
-        log_error(f'Error processing product p_id {p_id}: {e}')
-    else:
-      sp_product = fetchID(sp_product, sc_product_name_dict, 'parent')
-      sp_product = fetchID(sp_product, sc_team_name_dict, 'team')
-      sp_product = fetchID(sp_product, sc_product_set_name_dict, 'product_set')
-      sp_product = fetchID(sp_product, sc_service_area_name_dict, 'service_area')
-      log_and_append(f'Adding Product :: {sp_product}')
-      sc.add('products', sp_product)
-      change_count += 1
+        )
+    except Exception as e:
+      log_error('Error processing product p_id %s: %s', p_id, e)
+
+  def process(sp_product, hold=True):
+    queue = [sp_product]
+    while queue:
+      sp_product = queue.pop(0)
+      if (parent := resolve_parent(sp_product, hold)) is not None:
+        log_debug('Product %s waits for parent %s', sp_product['p_id'], parent, sample=True)
+        waiting.setdefault(parent, []).append(sp_product)
+        continue
+      resolve_relations(sp_product)
+      compare(sp_product)
+      queue.extend(waiting.pop(product_items.get(sp_product['p_id']), []))
+
+  # SharePoint products arrive a page at a time, so there is no collection digest to
+  # check up front; unchanged products are skipped individually by fingerprint
+  sp_count = 0
+  skipped_count = 0
+
+  # Compare and update sp_product_data
+  log_info('Processing prepared products sharepoint data for service catalogue ')
+  writer = services.writer
+  writes = []
+  log_info('************** Processing Products *********************')
+  for sp_products_page in iter_sp_products_data(sp, note_item):
+    for sp_product in sp_products_page:
+      log_debug(
+        'Comparing Product p_id %s :: %s', sp_product.get('p_id'), sp_product, sample=True
+      )
+      sp_count += 1
+      if selection.wants(sp_product.get('p_id')):
+        process(sp_product)
+
+  # Parents that never appeared (or cycles) are reported and the link left out
+  while waiting:
+    _, held = waiting.popitem()
+    for sp_product in held:
+      process(sp_product, hold=False)
+
+  log_info('Found %s products in SharePoint (after processing)', sp_count)
+
+  failed_messages, change_count = wait_for_writes(writer, writes)
+  log_messages.extend(failed_messages)
+  # Parent lookups can resolve before the parent has streamed in on the next run
+  xref.link(
+    products_list,
+    item_products,
+    sc.get_all_records(
+      'products', fields=product_scalar_fields, populate=product_relation_fields
+    ),
+    'p_id',
+  )
+  metrics.comparison('products', sp_count, skipped_count)
 
   log_and_append(f'Products in Service Catalogue processed: {change_count}')
   return log_messages
@@ -1,36 +1,55 @@
-from hmpps.services.job_log_handling import log_error, log_info, log_debug
 import json
 
+from includes.comparison import Comparison
+from includes.diff import describe_patch, minimal_patch
+from includes.field_mapping import Field, Schema
+from includes.log import lazy, log_debug, log_error, log_info
+from includes.xref import item_keys
+
+service_area_schema = Schema(
+  'service-areas',
+  key='ServiceAreaID',
+  fields=[
+    Field('sa_id', 'ServiceAreaID'),
+    Field('name', 'ServiceArea'),
+    # Could be be missing a service owner, so default to blank if it is..
+    Field(
+      'owner',
+      'ServiceOwnerLookupId',
+      lookup='Service Owners',
+      lookup_key='ServiceOwnerLookupId',
+      lookup_field='ServiceOwnerName',
+      default='',
+    ),
+    # "updated_by_id": 34 Not working in strapi5
+  ],
+)
+service_area_fields = tuple(field.target for field in service_area_schema.fields)
+# The SharePoint lists this phase reads
+source_lists = ('Service Areas', *service_area_schema.lookup_columns())
+
+
+def link_sp_service_areas(services):
+  # Products resolve their Service Areas lookups to documentIds through this
+  services.xref.link(
+    'Service Areas',
+    item_keys(services.sp.data['Service Areas'].get('value', []), service_area_schema.key),
+    services.sc.get_all_records('service-areas', fields=service_area_fields),
+    'sa_id',
+  )
 
-def fetch_sp_service_areas_data(sp):
-  sp_service_areas_data = []
-  log_debug('Creating service owners dictionary')
-  sp_service_owners_dict = {
-    service_owner.get('fields').get('ServiceOwnerLookupId'): service_owner
-    for service_owner in sp.data['Service Owners'].get('value')
-  }
 
+def fetch_sp_service_areas_data(sp):
   log_info('Preparing SharePoint service areas data for processing')
   # this populates linked Service Onwers as well as the 'name' field
-  for sp_service_area in sp.data['Service Areas'].get('value'):
-    service_area = sp_service_area.get('fields').get('ServiceArea')
-    if service_area_id := sp_service_area.get('fields').get('ServiceAreaID', None):
-      log_debug(f'Service area ID for {service_area}: {service_area_id}')
-      service_owner_id = sp_service_area.get('fields').get('ServiceOwnerLookupId', '')
-      log_debug(f'Service owner ID: {service_owner_id}')
-      sp_service_owner = sp_service_owners_dict.get(service_owner_id, {})
-      # Could be be missing a service owner, so skip if it is..
-      service_owner = sp_service_owner.get('fields', {}).get('ServiceOwnerName', '')
-      sp_service_area_data = {
-        'sa_id': service_area_id,
-        'name': sp_service_area.get('fields').get('ServiceArea'),
-        'owner': service_owner,
-        # "updated_by_id": 34 Not working in strapi5
-      }
-      sp_service_areas_data.append(sp_service_area_data)
+  sp_service_areas_data = service_area_schema.extract(
+    sp.data['Service Areas'].get('value'), sp
+  )
 
   log_info('SharePoint service areas prepared successfully for SC processing.')
-  log_debug(f'sp_service_areas_data is:\n{json.dumps(sp_service_areas_data, indent=2)}')
+  log_debug(
+    'sp_service_areas_data is:\n%s', lazy(json.dumps, sp_service_areas_data, indent=2)
+  )
   return sp_service_areas_data
 
 
@@ -41,9 +60,12 @@ def process_sc_service_areas(services):
 
   sc = services.sc
   sp = services.sp
+  selection = services.selection
 
   log_info('Processing Service Areas ')
-  sc_service_areas_data = sc.get_all_records('service-areas')
+  sc_service_areas_data = sc.get_all_records(
+    'service-areas', fields=service_area_fields
+  )
   if not sc_service_areas_data:
     log_error('No service areas returned from the Service Catalogue')
     return None
@@ -62,56 +84,92 @@ def process_sc_service_areas(services):
 
   # Quick summary before we start
   service_area_sp_count = len(sp.data['Service Areas'].get('value', []))
-  log_info(f'Found {service_area_sp_count} service areas in Sharepoint')
-  log_info(f'Found {len(sc_service_areas_data)} service areas in Service Catalogue')
+  log_info('Found %s service areas in Sharepoint', service_area_sp_count)
+  log_info('Found %s service areas in Service Catalogue', len(sc_service_areas_data))
 
   # Compare and update sp_service_area_data
-  change_count = 0
+  writer = services.writer
+  writes = []
   log_messages = []
+
+  # Fingerprints let unchanged service areas (or the whole collection) skip comparison
+  comparison = Comparison(
+    services,
+    'service-areas',
+    service_area_fields,
+    sp_service_areas_dict,
+    sc_service_areas_dict,
+  )
+  if comparison.unchanged:
+    log_and_append('Service Areas unchanged since the last successful run, not compared')
+    link_sp_service_areas(services)
+    return log_messages
   log_info('Processing prepared service area sharepoint data for service catalogue ')
   log_info('************** Processing Service Areas *********************')
   for sp_service_area in sp_service_areas_data:
     sa_id = sp_service_area.get('sa_id')
+    if not selection.wants(sa_id):
+      continue
 
     # If the record doesn't exist in service catalogue, add it and continue
     if not sc_service_areas_dict.get(sa_id):
       log_and_append(f'Adding Service Area :: {sp_service_area}')
-      sc.add('service-areas', sp_service_area)
-      change_count += 1
+      writes.append(
+        writer.add('service-areas', sp_service_area, label=f'Service Area {sa_id}')
+      )
+      continue
+
+    if comparison.matches(sa_id):
       continue
 
     # Otherwise do the comparisons
-    log_debug(f'Comparing Service Area {sa_id}')
+    log_debug('Comparing Service Area %s', sa_id, sample=True)
     sc_service_area = sc_service_areas_dict.get(sa_id, {})
     log_debug(
-      f'\ncomparing SC service area {sc_service_area}'
-      f'\nwith SP service area {sp_service_area}'
+      '\ncomparing SC service area %s\nwith SP service area %s',
+      sc_service_area,
+      sp_service_area,
+      sample=True,
     )
-    for key in sp_service_area.keys():
-      if (
-        sa_id in sc_service_areas_dict
-        and key in sp_service_area
-        and key in sc_service_area
-        and key != 'updated_by_id'
-      ):
-        sp_value = str(sp_service_area.get(key, '') or '').strip()
-        sc_value = str(sc_service_area.get(key, '') or '').strip()
-        if sp_value != sc_value:
-          log_and_append(
-            f'Updating Service Areas sa_id {sa_id}({key}) :: {sc_value} -> {sp_value}'
-          )
-          sc.update('service-areas', sc_service_area.get('documentId'), sp_service_area)
-          change_count += 1
-        else:
-          log_debug(f'No change for Service Area sa_id {sa_id} ({key})')
+    # One update per service area, carrying only the fields that changed
+    if patch := minimal_patch(sp_service_area, sc_service_area):
+      log_and_append(
+        f'Updating Service Areas sa_id {sa_id} :: '
+        f'{describe_patch(patch, sc_service_area)}'
+      )
+      writes.append(
+        writer.update(
+          'service-areas',
+          sc_service_area.get('documentId'),
+          patch,
+          label=f'Service Area {sa_id}',
+        )
+      )
+    else:
+      log_debug('No change for Service Area sa_id %s', sa_id, sample=True)
 
   # Delete those that no longer exist in Sharepoint
   for sc_service_area in sc_service_areas_data:
     sa_id = sc_service_area.get('sa_id')
-    if sa_id not in sp_service_areas_dict and 'SP' not in sa_id:
+    if (
+      sa_id not in sp_service_areas_dict
+      and 'SP' not in sa_id
+      and selection.deletes_record(sa_id)
+    ):
       log_and_append(f'Deleting Service Area :: {sc_service_area}')
-      sc.delete('service-areas', sc_service_area.get('documentId'))
-      change_count += 1
+      writes.append(
+        writer.delete(
+          'service-areas',
+          sc_service_area.get('documentId'),
+          label=f'Service Area {sa_id}',
+        )
+      )
+
+  failed_messages, change_count = comparison.finish(
+    writes, len(sp_service_areas_data)
+  )
+  log_messages.extend(failed_messages)
+  link_sp_service_areas(services)
 
   log_and_append(f'Service Areas in Service Catalogue processed: {change_count}')
   return log_messages
@@ -0,0 +1,200 @@
+"""Sharded discovery: a worker per SharePoint site, and the coordinator that merges them.
+
+Each site in DISCOVERY_SITES is synced by its own worker, a local process or a
+Kubernetes job of its own (`--shard NAME`), with its own state store, so discovery
+takes as long as the largest site rather than all of them together. A shard adds and
+updates the records in its site but deletes nothing, as a record missing from one
+site may belong to another. It leaves a summary in DISCOVERY_SHARD_DIR: its outcome,
+its messages and the stable ids in its lists.
+
+The coordinator merges the summaries into one notification and deletes the teams,
+product sets and service areas that no site has. Deletion is skipped unless every
+site has a successful summary from this round (or, for separate jobs, the last
+SHARD_MAX_AGE_HOURS), so a failed or missing shard never looks like a site whose
+records were all removed. Ids more than one site owns are reported.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+import processes.product_sets as productSets
+import processes.service_areas as serviceAreas
+import processes.teams as teams
+from includes.comparison import wait_for_writes
+from includes.log import log_error, log_info, log_warning
+from includes.state import state_path
+from includes.xref import item_keys, stable_id
+
+shard_dir = os.environ.get(
+  'DISCOVERY_SHARD_DIR', os.path.join(os.path.dirname(state_path), 'shards')
+)
+max_age_hours = float(os.environ.get('SHARD_MAX_AGE_HOURS', '24'))
+# Duplicate ids listed in the summary, the rest are counted
+duplicates_shown = 10
+
+# Collections records are deleted from -> the SharePoint list and column of their ids.
+# Products are never deleted by discovery
+deletable = {
+  'teams': ('t_id', 'Teams', teams.team_schema.key),
+  'product-sets': ('ps_id', 'Product Set', productSets.product_set_schema.key),
+  'service-areas': ('sa_id', 'Service Areas', serviceAreas.service_area_schema.key),
+}
+
+
+def kept(collection, key):
+  # Service areas created in the catalogue itself have SP in their id
+  return collection == 'service-areas' and 'SP' in key
+
+
+def summary_path(name):
+  return os.path.join(shard_dir, f'{name}.json')
+
+
+def site_keys(sp):
+  """{collection: sorted stable ids} of the records in the site's loaded lists."""
+  keys = {}
+  for collection, (_, list_name, column) in deletable.items():
+    items = (sp.data.get(list_name) or {}).get('value', [])
+    keys[collection] = sorted(
+      {key for value in item_keys(items, column).values() if (key := stable_id(value))}
+    )
+  return keys
+
+
+def write_summary(site, succeeded, messages, keys):
+  summary = {
+    'name': site.name,
+    'site': site.site,
+    'status': 'succeeded' if succeeded else 'failed',
+    'finished_at': time.time(),
+    'messages': list(messages),
+    'keys': keys,
+  }
+  path = summary_path(site.name)
+  try:
+    os.makedirs(shard_dir, exist_ok=True)
+    # Written alongside and renamed, so the coordinator never reads a partial file
+    with open(f'{path}.tmp', 'w') as f:
+      json.dump(summary, f)
+    os.replace(f'{path}.tmp', path)
+  except OSError as e:
+    log_error('Unable to write the summary for shard %s: %s', site.name, e)
+
+
+def read_summaries(sites, since):
+  """The summaries of `sites` finished after `since`, and why any others are unusable."""
+  summaries, problems = [], []
+  for site in sites:
+    try:
+      with open(summary_path(site.name)) as f:
+        summary = json.load(f)
+    except (OSError, ValueError) as e:
+      problems.append(f'{site.name}: no summary ({e})')
+      continue
+    if summary.get('finished_at', 0) < since:
+      finished = datetime.fromtimestamp(summary.get('finished_at', 0), timezone.utc)
+      problems.append(f'{site.name}: last summary is from {finished:%Y-%m-%d %H:%M} UTC')
+    elif summary.get('status') != 'succeeded':
+      problems.append(f'{site.name}: shard failed')
+    summaries.append(summary)
+  return summaries, problems
+
+
+def run_workers(script, sites):
+  """Runs `script --shard NAME` for every site side by side; {name: exit code}."""
+  workers = {}
+  try:
+    for site in sites:
+      log_info('Starting the worker for shard %s (%s)', site.name, site.site)
+      workers[site.name] = subprocess.Popen(
+        [sys.executable, '-u', script, '--shard', site.name]
+      )
+    return {name: worker.wait() for name, worker in workers.items()}
+  finally:
+    # Workers are not left running if the coordinator is stopped
+    for worker in workers.values():
+      if worker.poll() is None:
+        worker.terminate()
+
+
+def owner(site, key):
+  return not site.key_prefixes or key.startswith(site.key_prefixes)
+
+
+def duplicate_messages(sites, summaries):
+  by_name = {site.name: site for site in sites}
+  messages = []
+  for collection in deletable:
+    owners = {}
+    for summary in summaries:
+      site = by_name[summary['name']]
+      for key in summary.get('keys', {}).get(collection, ()):
+        if owner(site, key):
+          owners.setdefault(key, []).append(site.name)
+    duplicates = sorted(key for key, names in owners.items() if len(names) > 1)
+    if duplicates:
+      shown = ', '.join(
+        f'{key} ({" and ".join(owners[key])})' for key in duplicates[:duplicates_shown]
+      )
+      more = len(duplicates) - duplicates_shown
+      messages.append(
+        f'{collection} ids in more than one site: {shown}'
+        + (f' and {more} more' if more > 0 else '')
+      )
+  return messages
+
+
+def delete_orphans(services, summaries):
+  """Deletes the records no site has; returns the log messages."""
+  sc = services.sc
+  writer = services.writer
+  writes = []
+  log_messages = []
+  for collection, (key_field, _, _) in deletable.items():
+    claimed = set()
+    for summary in summaries:
+      claimed.update(summary.get('keys', {}).get(collection, ()))
+    # As in a single site run, an empty list is never taken as every record removed
+    if not claimed:
+      log_warning('No site has any %s, none deleted', collection)
+      continue
+    for record in sc.get_all_records(collection, fields=(key_field,)):
+      key = stable_id(record.get(key_field))
+      if key is None or key in claimed or kept(collection, key):
+        continue
+      message = f'Deleting {collection} record {key_field} {key} :: no site has it'
+      log_info(message)
+      log_messages.append(message)
+      writes.append(
+        writer.delete(collection, record.get('documentId'), label=f'{collection} {key}')
+      )
+  failed_messages, done = wait_for_writes(writer, writes)
+  log_messages.extend(failed_messages)
+  log_messages.append(f'Records no site has deleted, processed: {done}')
+  return log_messages
+
+
+def coordinate(services, sites, since):
+  """Merges the shard summaries and deletes across sites.
+
+  Returns the messages, and whether every shard succeeded so deletion could run.
+  """
+  summaries, problems = read_summaries(sites, since)
+  messages = []
+  for summary in summaries:
+    messages.append(f'*{summary.get("site")}* ({summary.get("status")})')
+    messages.extend(summary.get('messages', []))
+  messages.extend(duplicate_messages(sites, summaries))
+  if problems:
+    # A site without a good, recent summary may still have any record
+    message = 'Deletion skipped, not every shard succeeded: ' + '; '.join(problems)
+    log_warning(message)
+    messages.append(message)
+    services.slack.alert(f'*Sharepoint Discovery failed*: {message}')
+  else:
+    messages.extend(delete_orphans(services, summaries))
+  return messages, not problems
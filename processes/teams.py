@@ -1,24 +1,43 @@
-from hmpps.services.job_log_handling import log_debug, log_error, log_info, log_warning
 import json
 
+from includes.comparison import Comparison
+from includes.diff import describe_patch, minimal_patch
+from includes.field_mapping import Field, Schema
+from includes.log import lazy, log_debug, log_error, log_info, log_warning
+from includes.xref import item_keys
+
+team_schema = Schema(
+  'teams',
+  key='TeamID',
+  fields=[
+    Field('t_id', 'TeamID'),
+    Field('name', 'Team'),
+    Field('budget_code', 'BudgetCode'),
+    Field('confluence_link', 'ConfluenceLink'),
+    # "description": "n/a",  field not available in SC
+    # "slack_channel": "n/a", Not populated so commenting out
+    # "updated_by_id": 34 Not working in strapi5
+  ],
+)
+team_fields = tuple(field.target for field in team_schema.fields)
+# The SharePoint lists this phase reads
+source_lists = ('Teams', *team_schema.lookup_columns())
+
+
+def link_sp_teams(services):
+  # Products resolve their Teams lookups to documentIds through this
+  services.xref.link(
+    'Teams',
+    item_keys(services.sp.data['Teams'].get('value', []), team_schema.key),
+    services.sc.get_all_records('teams', fields=team_fields),
+    't_id',
+  )
+
 
 def fetch_sp_teams_data(sp_teams):
-  sp_teams_data = []
   log_debug('Preparing SharePoint teams data for service catalogue processing')
-  for sp_team in sp_teams['value']:
-    if team_id := sp_team.get('fields').get('TeamID', None):
-      log_debug(f'Processing team {team_id} from SharePoint')
-      sp_team_data = {
-        't_id': team_id,
-        'name': sp_team.get('fields').get('Team'),
-        'budget_code': sp_team.get('fields').get('BudgetCode'),
-        'confluence_link': sp_team.get('fields').get('ConfluenceLink'),
-        # "description": "n/a",  field not available in SC
-        # "slack_channel": "n/a", Not populated so commenting out
-        # "updated_by_id": 34 Not working in strapi5
-      }
-      sp_teams_data.append(sp_team_data)
-  log_debug(f'sp_teams_data is:\n{json.dumps(sp_teams_data, indent=2)}')
+  sp_teams_data = team_schema.extract(sp_teams['value'])
+  log_debug('sp_teams_data is:\n%s', lazy(json.dumps, sp_teams_data, indent=2))
   log_info('SharePoint teams prepared successfully for SC processing.')
   return sp_teams_data
 
@@ -30,12 +49,14 @@ def process_sc_teams(services):
 
   sc = services.sc
   sp = services.sp
-  change_count = 0
+  selection = services.selection
+  writer = services.writer
+  writes = []
   log_messages = []
 
   # Service Catalogue
   log_info('Creating Lookup dictionaries ')
-  sc_teams_data = sc.get_all_records('teams')
+  sc_teams_data = sc.get_all_records('teams', fields=team_fields)
 
   if not sc_teams_data:
     log_warning('No teams returned from Service Catalogue')
@@ -48,8 +69,15 @@ def process_sc_teams(services):
     return None
 
   # Quick summary before we start
-  log_info(f'Found {len(sp.data["Teams"].get("value", []))} teams in Sharepoint')
-  log_info(f'Found {len(sc_teams_data)} teams in Service Catalogue')
+  log_info('Found %s teams in Sharepoint', len(sp.data['Teams'].get('value', [])))
+  log_info('Found %s teams in Service Catalogue', len(sc_teams_data))
+
+  # Fingerprints let unchanged teams (or the whole collection) skip comparison
+  comparison = Comparison(services, 'teams', team_fields, sp_teams_dict, sc_teams_dict)
+  if comparison.unchanged:
+    log_and_append('Teams unchanged since the last successful run, not compared')
+    link_sp_teams(services)
+    return log_messages
 
   # Compare and update sp_teams_data
   log_info('Processing prepared teams sharepoint data for service catalogue ')
@@ -57,38 +85,42 @@ def process_sc_teams(services):
 
   for sp_team in sp_teams_data:
     t_id = sp_team.get('t_id')
+    if not selection.wants(t_id):
+      continue
 
     # If the record doesn't exist in service catalogue, add it and continue
     if not sc_teams_dict.get(t_id):
       log_and_append(f'Adding Team :: {sp_team}')
-      sc.add('teams', sp_team)
-      change_count += 1
+      writes.append(writer.add('teams', sp_team, label=f'Team {t_id}'))
+      continue
+
+    if comparison.matches(t_id):
       continue
 
     # Otherwise do the comparisons
-    log_info(f'Comparing team {t_id} from SharePoint')
+    log_debug('Comparing team %s from SharePoint', t_id, sample=True)
     sc_team = sc_teams_dict.get(t_id, {})
-    # Add or update teams in Service Catalogue
-    for key in sp_team.keys():
-      if t_id in sc_teams_dict and key in sp_team and key in sc_team:
-        sp_value = str(sp_team.get(key, '') or '').strip()
-        sc_value = str(sc_team.get(key, '') or '').strip()
-        if sp_value != sc_value:
-          log_and_append(
-            f'Updating Team t_id {t_id}({key}) :: {sc_value} -> {sp_value}'
-          )
-          sc.update('teams', sc_team.get('documentId'), sp_team)
-          change_count += 1
-        else:
-          log_debug(f'No change for Team t_id {t_id} key ({key})')
+    # One update per team, carrying only the fields that changed
+    if patch := minimal_patch(sp_team, sc_team):
+      log_and_append(f'Updating Team t_id {t_id} :: {describe_patch(patch, sc_team)}')
+      writes.append(
+        writer.update('teams', sc_team.get('documentId'), patch, label=f'Team {t_id}')
+      )
+    else:
+      log_debug('No change for Team t_id %s', t_id, sample=True)
 
   # Delete the teams that no longer exist in Sharepoint
   for sc_team in sc_teams_data:
     t_id = sc_team.get('t_id')
-    if t_id not in sp_teams_dict:
+    if t_id not in sp_teams_dict and selection.deletes_record(t_id):
       log_and_append(f'Deleting team :: {sc_team}')
-      sc.delete('teams', sc_team.get('documentId'))
-      change_count += 1
+      writes.append(
+        writer.delete('teams', sc_team.get('documentId'), label=f'Team {t_id}')
+      )
+
+  failed_messages, change_count = comparison.finish(writes, len(sp_teams_data))
+  log_messages.extend(failed_messages)
+  link_sp_teams(services)
 
   log_and_append(f'Teams in Service Catalogue processed: {change_count}')
   return log_messages
@@ -6,7 +6,7 @@ Required environment variables
 ------------------------------
 
 Sharepoint (Credentials for Discovery app that has access to Sharepoint lists)
-- TENANT_ID: Azure Tenant ID
+- AZ_TENANT_ID: Azure Tenant ID
 - SP_CLIENT_ID: Sharepoint Client ID
 - SP_CLIENT_SECRET: Sharepoint Client Secret
 - SP_SITE_ID: Sharepoint Site ID
@@ -21,39 +21,194 @@ Optional environment variables
 - SLACK_NOTIFY_CHANNEL: Slack channel for notifications
 - SLACK_ALERT_CHANNEL: Slack channel for alerts
 - LOG_LEVEL: Log level (default: INFO)
+- LOG_DEBUG_SAMPLE_RATE: Share of per-record debug lines to emit, 0-1 (default: 1)
+- DISCOVERY_MAX_WORKERS: Number of phases that may run concurrently (default: 3)
+- DISCOVERY_INITIAL_CONCURRENCY: Requests in flight per backend at start-up (default: 4)
+- GRAPH_MAX_CONCURRENCY: Most Graph requests in flight (default: 10)
+- GRAPH_TARGET_SECONDS: Graph latency above which concurrency is reduced (default: 2)
+- SC_MAX_CONCURRENCY: Most Service Catalogue requests in flight (default: 16)
+- SC_TARGET_SECONDS: Service Catalogue latency above which concurrency is reduced
+  (default: 2)
+- SC_WRITE_WORKERS: Service Catalogue write threads (default: SC_MAX_CONCURRENCY)
+- SC_WRITE_RATE: Maximum Service Catalogue writes per second (default: 10)
+- SC_WRITE_QUEUE_SIZE: Writes queued before compare loops wait (default: 100)
+- SC_WRITE_RETRIES: Retries for throttled (429) or 5xx writes (default: 3)
+- SC_WRITE_BACKOFF: Initial retry backoff in seconds, doubled per attempt (default: 1)
+- SC_READ_PAGE_SIZE: Initial page size for Service Catalogue reads (default: 100)
+- SC_READ_MAX_PAGE_SIZE: Largest page size reads may grow to (default: 1000)
+- SC_READ_TARGET_SECONDS: Page response time the read page size is tuned towards
+  (default: 1)
+- SP_GRAPH_CLIENT: Load lists with the Graph client rather than the hmpps one; implied
+  by SP_INCREMENTAL, SP_STREAMING, GRAPH_API_URL, GRAPH_ACCESS_TOKEN and --watch
+  (default: false)
+- SP_INCREMENTAL: Load SharePoint lists with Graph delta queries (default: false)
+- SP_LIST_WORKERS: SharePoint list loading threads (default: GRAPH_MAX_CONCURRENCY)
+- SP_SELECT_COLUMNS: Request only the columns the field mappings read (default: true)
+- SP_STREAMING: Stream the Products and Teams Main List page by page (default: false)
+- SP_PAGE_SIZE: Items per SharePoint page (default: 200)
+- SP_PREFETCH_PAGES: Pages fetched ahead while streaming (default: 1)
+- GRAPH_API_URL: Microsoft Graph endpoint (default: https://graph.microsoft.com/v1.0)
+- GRAPH_ACCESS_TOKEN: Static Graph token, used instead of client credentials
+  (for stand-ins)
+- GRAPH_TOKEN_CACHE: File the Graph token is reused from until it expires
+  (default: next to the state store)
+- SP_API_RETRIES: Retries for throttled (429) or 5xx Graph requests (default: 5)
+- DISCOVERY_STATE_PATH: SQLite file holding delta links, cached list items and digests;
+  only kept when set, or when SP_INCREMENTAL, SC_STATE_CACHE, DISCOVERY_JOURNAL=true
+  or --watch needs it (default: /tmp/hmpps-sharepoint-discovery/state.db)
+- DISCOVERY_SITES: JSON list of SharePoint sites, each synced by its own worker
+- DISCOVERY_SHARD_DIR: Where shard workers leave summaries for the coordinator
+  (default: next to the state store)
+- SHARD_MAX_AGE_HOURS: Age beyond which the coordinator ignores a shard's summary
+  (default: 24)
+- DISCOVERY_JOURNAL: Journal writes so an interrupted run can be resumed, whenever a
+  state store is kept (default: true)
+- SC_STATE_CACHE: Start from the Service Catalogue records stored by the last run
+  (default: false)
+- SC_INTEGRITY_CHECK_HOURS: Hours between live reads that check the stored records
+  (default: 24)
+- DISCOVERY_METRICS_FILE: Write run metrics here in Prometheus text format
+  (for the textfile collector)
+- PROMETHEUS_PUSHGATEWAY_URL: Push run metrics to this Pushgateway
+- WATCH_PORT: Port the watch mode notification receiver listens on (default: 8080)
+- WATCH_NOTIFICATION_URL: Public address of the receiver, Graph subscriptions are
+  made for it
+- WATCH_CLIENT_STATE: Secret Graph echoes in each notification, others are ignored
+  (default: random per process)
+- WATCH_DEBOUNCE_SECONDS: Quiet time before changed lists are synced (default: 10)
+- WATCH_MAX_DELAY_SECONDS: Longest a change waits while notifications keep arriving
+  (default: 60)
+- WATCH_RECONCILE_HOURS: Hours between full reconciles in watch mode (default: 24)
+- WATCH_SUBSCRIPTION_HOURS: Lifetime requested for Graph subscriptions (default: 72)
 
 """
 
+import argparse
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 # hmpps-sre-python-lib
-from hmpps import ServiceCatalogue, Slack, SharePoint
-from hmpps.services.job_log_handling import log_error, log_info, job
+from hmpps import ServiceCatalogue, Slack
+from hmpps.services.job_log_handling import job
 
 # Components
 import processes.teams as teams
 import processes.product_sets as productSets
 import processes.service_areas as serviceAreas
 import processes.products as products
+import processes.shards as shards
+from includes.catalogue import CatalogueSnapshot, state_cache
+from includes.catalogue_api import CatalogueAPI
+from includes.catalogue_writer import CatalogueWriter, write_workers
+from includes.field_mapping import list_columns
+from includes.journal import Journal, journal_enabled, journal_requested
+from includes.log import log_debug, log_error, log_info
+from includes.metrics import metrics, process_seconds
+from includes.scheduler import Phase, run_phases
+from includes.selection import Selection, everything
+from includes.sharepoint import (
+  HmppsSharePointLists,
+  SharePointLists,
+  graph_client,
+  incremental,
+)
+from includes.sites import default_site, load_sites
+from includes.state import StateStore, state_path_set
+from includes.xref import CrossReference
 
+sp_lists = [
+  'Service Areas',
+  'Product Set',
+  'Teams',
+  'Service Owners',
+  'Product Managers',
+  'Delivery Managers',
+  'Lead Developers',
+  'Products and Teams Main List',
+  'Technical Architects',
+  'Principal Technical Architect',
+]
 
-class Services:
-  def __init__(self):
-    self.slack = Slack()
-    self.sc = ServiceCatalogue()
-    self.sp = SharePoint(site_name='PrisonsDigital-DeliveryOperations')
 
+def keeps_state(watching=False):
+  """Whether the run keeps a state store, only when something reads it back.
+
+  A path of its own, delta queries, the stored catalogue, an explicitly enabled
+  journal and watch mode each need one. Otherwise nothing is written, so no file
+  left at the default path can feed the cross-reference or journal of a later run.
+  """
+  return state_path_set or incremental or state_cache or journal_requested or watching
 
-def log_info_u(message):
-  log_info('')
-  log_info(message)
-  log_info(f'{"=" * len(message)}')
-  log_info('')
+
+class Services:
+  def __init__(
+    self, watching=False, selection=everything, site=default_site, shard=False
+  ):
+    # The entity types and records this run syncs (all of them, unless targeted)
+    self.selection = selection
+    # The SharePoint site read, or None for the coordinator of a sharded run. A shard
+    # worker reports to the coordinator rather than to Slack
+    self.site = site
+    self.shard = shard
+    if site is None or not keeps_state(watching):
+      self.state = None
+    else:
+      self.state = StateStore(site.state_path) if shard else StateStore()
+    # The clients check their connections as they are created, side by side rather
+    # than one after another
+    with ThreadPoolExecutor(max_workers=3, thread_name_prefix='preflight') as executor:
+      slack = executor.submit(Slack)
+      service_catalogue = executor.submit(ServiceCatalogue)
+      sp = executor.submit(self._sharepoint, watching) if site else None
+    self.slack = slack.result()
+    service_catalogue = service_catalogue.result()
+    self.sp = sp.result() if sp else None
+    # One pooled client for reads (selected fields, tuned page size) and writes
+    api = CatalogueAPI(service_catalogue, pool_size=write_workers + 1)
+    # Collections are read once per run and kept current with this run's writes.
+    # With SC_STATE_CACHE they are kept in the state store between runs as well
+    self.sc = CatalogueSnapshot(service_catalogue, api=api, state=self.state)
+    # Mutations are journalled so an interrupted run can be resumed
+    self.journal = Journal(self.state) if journal_enabled and self.state else None
+    # Mutations are queued and sent concurrently, with rate limiting and retries
+    self.writer = CatalogueWriter(self.sc, api=api, journal=self.journal)
+    # SharePoint item ids -> catalogue documentIds, kept between runs
+    self.xref = CrossReference(self.state)
+    # Start-up timings, reported with the first sync's metrics
+    self.startup = {}
+
+  def _sharepoint(self, watching):
+    if not (graph_client or watching):
+      return HmppsSharePointLists(self.site.site, list_aliases=self.site.lists)
+    # With SP_INCREMENTAL, lists are read via Graph delta queries into the state store.
+    # With SP_STREAMING, the products list is read page by page as it is processed.
+    # Watch mode always reads changed lists through delta queries
+    return SharePointLists(
+      self.site.site,
+      state=self.state,
+      list_aliases=self.site.lists,
+      incremental=incremental or watching,
+      streamed=(products.products_list,),
+      # Only the columns the field mappings read are requested from Graph
+      columns=list_columns(
+        {
+          'Teams': teams.team_schema,
+          'Product Set': productSets.product_set_schema,
+          'Service Areas': serviceAreas.service_area_schema,
+          products.products_list: products.product_schema,
+        }
+      ),
+    )
 
 
 def should_send_slack_notification(processed_messages):
   for message in processed_messages:
     if 'processed' in message:
       parts = message.split('processed: ')
-      log_info(parts)
+      log_debug('Processed count parts: %s', parts)
       if len(parts) > 1:
         try:
           count = int(parts[1].strip().split()[0])
@@ -64,14 +219,332 @@ def should_send_slack_notification(processed_messages):
   return False  # All categories have 0 processed
 
 
-def main():
+def send_summary(slack, messages):
+  summary_header = '*SharePoint Discovery Summary*'
+  generated_by = '_(generated by <https://github.com/ministryofjustice/hmpps-sharepoint-discovery|hmpps-sharepoint-discovery>)_'
+  processed_messages = [summary_header, *messages, generated_by]
+  log_info('Processing complete, preparing to send Slack notification if required.')
+  log_debug('Processed messages: %s', processed_messages)
+
+  if should_send_slack_notification(processed_messages):
+    log_info('Sending Slack notification')
+    slack.notify('\n'.join(processed_messages))
+  else:
+    log_info('No records processed, not sending Slack notification')
+
+
+# Phases whose cross-reference products resolve relations through -> the list they
+# link, and how to link it without syncing the records
+relation_links = {
+  'teams': ('Teams', teams.link_sp_teams),
+  'product_sets': ('Product Set', productSets.link_sp_product_sets),
+  'service_areas': ('Service Areas', serviceAreas.link_sp_service_areas),
+}
+
+
+def missing_links(services, selection):
+  """The phases a targeted products run leaves out that have nothing linked yet.
+
+  Their cross-reference normally comes from the state store; without one (a new or
+  deleted store) their lists are read and linked before products are synced.
+  """
+  if selection.phases is None or 'products' not in selection.phases:
+    return []
+  return [
+    name
+    for name, (list_name, _) in relation_links.items()
+    if name not in selection.phases and not services.xref.linked(list_name)
+  ]
+
+
+def build_phases(changed_lists=None, selection=everything, links=()):
+  """The sync phases selected, or with `changed_lists` only those that read one of them.
+
+  `links` names left out phases whose lists are linked first, for products to resolve.
+  """
+  phases = [
+    Phase('teams', 'Processing teams', teams.process_sc_teams),
+    Phase(
+      'product_sets', 'Processing product sets', productSets.process_sc_product_sets
+    ),
+    Phase(
+      'service_areas',
+      'Processing service areas',
+      serviceAreas.process_sc_service_areas,
+    ),
+    # Products resolve team, product set and service area lookups through the
+    # cross-reference these phases link
+    Phase(
+      'products',
+      'Batch processing products',
+      products.process_sc_products,
+      depends_on=('teams', 'product_sets', 'service_areas'),
+    ),
+  ]
+  if changed_lists is None and selection.phases is None:
+    return phases
+
+  phase_lists = {
+    'teams': set(teams.source_lists),
+    'product_sets': set(productSets.source_lists),
+    'service_areas': set(serviceAreas.source_lists),
+    # Products also change when the records their relations link to do
+    'products': {*products.source_lists, *products.relation_lists.values()},
+  }
+  selected = [
+    phase
+    for phase in phases
+    if (changed_lists is None or phase_lists[phase.name] & set(changed_lists))
+    and (selection.phases is None or phase.name in selection.phases)
+  ]
+  # Phases left out have nothing new to link, their cross-references are in the store
+  names = {phase.name for phase in selected}
+  for phase in selected:
+    phase.depends_on = tuple(name for name in phase.depends_on if name in names)
+  for name in links:
+    list_name, link = relation_links[name]
+    selected.insert(0, Phase(f'link_{name}', f'Linking {list_name}', link))
+    for phase in selected:
+      if phase.name == 'products':
+        phase.depends_on += (f'link_{name}',)
+  return selected
+
+
+def sync(services, changed_lists=None, resume_messages=()):
+  """Loads the SharePoint lists and runs the sync phases once.
+
+  With `changed_lists` (watch mode) only those lists are read, and only the phases
+  that read them are run.
+  """
+  sc = services.sc
+  slack = services.slack
+  sp = services.sp
+  job.error_messages = []
+  metrics.reset()
+  startup, services.startup = services.startup, {}
+  for stage, seconds in startup.items():
+    metrics.set('discovery_startup_seconds', seconds, stage=stage)
+  if services.journal:
+    services.journal.begin()
+
+  selection = services.selection
+  links = [] if changed_lists else missing_links(services, selection)
+  if changed_lists:
+    load_lists = sorted(changed_lists)
+  elif selection.phases is not None:
+    # Only the lists the selected phases read, and those products need linked
+    load_lists = sorted(
+      {*source_lists(selection.phases), *(relation_links[name][0] for name in links)}
+    )
+  else:
+    load_lists = sp_lists
+  sp.changed_lists.clear()
+  with metrics.timer('discovery_phase_duration_seconds', phase='load_lists'):
+    sp.load_sharepoint_lists(load_lists)
+
+  # A targeted run pushes its records whether or not SharePoint has changed
+  if sp.incremental and not sp.changed_lists and selection.full:
+    log_info('No SharePoint lists have changed since the last run, nothing to do.')
+    if services.journal:
+      services.journal.finish()
+    if services.shard:
+      shards.write_summary(services.site, True, [], shards.site_keys(sp))
+    else:
+      sc.update_scheduled_job('Succeeded')
+    metrics.export()
+    return []
+
+  phases = build_phases(sp.changed_lists if changed_lists else None, selection, links)
+  run_messages = list(resume_messages)
+
+  try:
+    run_phases(services, phases)
+    if failed_phases := [phase for phase in phases if phase.error]:
+      slack.alert(
+        '*Sharepoint Discovery failed*: '
+        + '; '.join(f'{phase.name}: {phase.error}' for phase in failed_phases)
+      )
+
+    # Combine output of all the processes
+    for phase in phases:
+      run_messages.extend(phase.messages)
+    run_messages.append(metrics.timing_breakdown(phases))
+    # A shard's messages go to the coordinator, in its summary
+    if not services.shard:
+      send_summary(slack, run_messages)
+
+  except Exception as e:
+    log_error('Sharepoint discovery job failed with error: %s', e)
+    slack.alert(f'*Sharepoint Discovery failed*: {e}')
+    log_error('Sharepoint discovery job failed with error: %s', e)
+
+  # Every queued write has its outcome by now, the writer stays open for watch mode
+  failed_writes = services.writer.failed_count
+  services.writer.failed_count = 0
+  sc.persist(recheck=bool(failed_writes))
+
+  # Advance the delta links only once every change has reached the catalogue. A
+  # targeted run skips most changes, so they are left for the next full run
+  phases_ok = all(phase.status == 'succeeded' for phase in phases) and not failed_writes
+  if sp.incremental and selection.full:
+    if phases_ok:
+      sp.commit_delta()
+    else:
+      log_info('Run incomplete, SharePoint changes will be replayed next run.')
+  if services.journal:
+    services.journal.finish()
+
+  if services.shard:
+    # The coordinator reports the whole run and updates the scheduled job
+    shards.write_summary(
+      services.site,
+      phases_ok and not job.error_messages,
+      run_messages,
+      shards.site_keys(sp),
+    )
+  elif job.error_messages:
+    sc.update_scheduled_job('Errors')
+    log_info('SharePoint discovery job completed  with errors.')
+  else:
+    sc.update_scheduled_job('Succeeded')
+    log_info('SharePoint discovery job completed successfully.')
+  log_info(metrics.timing_breakdown(phases))
+  metrics.export()
+  return phases
+
+
+def source_lists(phase_names):
+  modules = {
+    'teams': teams,
+    'product_sets': productSets,
+    'service_areas': serviceAreas,
+    'products': products,
+  }
+  for name in phase_names:
+    yield from modules[name].source_lists
+
+
+def parse_args(argv=None):
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  # A single full run is the default, -f is what the cronjob has always passed
+  parser.add_argument('-f', '--full', action='store_true', help='run a single sync')
+  parser.add_argument(
+    '-w',
+    '--watch',
+    action='store_true',
+    help='keep running, syncing lists as Graph change notifications arrive',
+  )
+  parser.add_argument(
+    '--only',
+    metavar='ENTITIES',
+    help='sync only these entity types: teams, product-sets, service-areas, products',
+  )
+  parser.add_argument(
+    '--ids',
+    metavar='IDS',
+    help='sync only the records with these ids (p_id, t_id, ps_id or sa_id)',
+  )
+  parser.add_argument(
+    '--delete',
+    action='store_true',
+    help='in a targeted run, delete selected records that are gone from SharePoint',
+  )
+  parser.add_argument(
+    '--shard',
+    metavar='NAME',
+    help='sync one site of DISCOVERY_SITES as a shard, for the coordinator to merge',
+  )
+  parser.add_argument(
+    '--coordinate',
+    action='store_true',
+    help='merge the summaries of shards run as separate jobs, and delete across sites',
+  )
+  args = parser.parse_args(argv)
+  try:
+    args.selection = Selection.parse(args.only, args.ids, args.delete)
+    args.sites = load_sites()
+  except ValueError as e:
+    parser.error(str(e))
+  if args.watch and not args.selection.full:
+    parser.error('--only and --ids cannot be used with --watch')
+  sharded = args.shard or args.coordinate or len(args.sites) > 1
+  if sharded and (args.watch or not args.selection.full):
+    parser.error('--watch, --only and --ids sync a single site')
+  if args.shard and args.coordinate:
+    parser.error('--shard and --coordinate cannot be used together')
+  args.site = args.sites[0]
+  if args.shard:
+    if not (named := [site for site in args.sites if site.name == args.shard]):
+      parser.error(f'no site named {args.shard!r} in DISCOVERY_SITES')
+    args.site = named[0]
+    # Deletes are left to the coordinator, which knows what every site has
+    args.selection = Selection(deletes=False, prefixes=args.site.key_prefixes)
+  args.coordinating = not args.shard and (args.coordinate or len(args.sites) > 1)
+  return args
+
+
+def coordinate(args):
+  """Runs a worker per site (unless they run as jobs of their own) and merges them."""
+  started = time.time()
+  job.error_messages = []
+  if args.coordinate:
+    since = started - shards.max_age_hours * 3600
+  else:
+    since = started
+    exit_codes = shards.run_workers(os.path.abspath(__file__), args.sites)
+    for name, code in exit_codes.items():
+      if code:
+        log_error('The worker for shard %s exited with code %s', name, code)
+  metrics.reset()
+  services = Services(site=None)
+  sc = services.sc
+  if not sc.connection_ok:
+    services.slack.alert(
+      '*Sharepoint Discovery failed*: Unable to connect to the Service Catalogue'
+    )
+    raise SystemExit()
+  try:
+    messages, complete = shards.coordinate(services, args.sites, since)
+  finally:
+    services.writer.close()
+  total = time.time() - started
+  messages.append(f'_Timings: {total:.1f}s total for {len(args.sites)} shards_')
+  send_summary(services.slack, messages)
+  if complete and not job.error_messages:
+    sc.update_scheduled_job('Succeeded')
+  else:
+    sc.update_scheduled_job('Errors')
+  metrics.export()
+
+
+def main(argv=None):
   #### Create resources ####
 
+  # Interpreter start-up and imports, up to here
+  import_seconds = process_seconds()
+  args = parse_args(argv)
   job.name = 'hmpps-sharepoint-discovery'
-  services = Services()
+  if args.coordinating:
+    return coordinate(args)
+  metrics.shard = args.shard
+  metrics.reset()
+  preflight_started = time.monotonic()
+  services = Services(
+    watching=args.watch, selection=args.selection, site=args.site, shard=bool(args.shard)
+  )
   sc = services.sc
   slack = services.slack
   sp = services.sp
+  # Authentication happens during the SharePoint check, so it is reported apart
+  services.startup = {
+    **({'import': import_seconds} if import_seconds is not None else {}),
+    'auth': sp.auth_seconds,
+    'preflight': time.monotonic() - preflight_started - sp.auth_seconds,
+  }
+  log_info(
+    'Start-up: '
+    + ', '.join(f'{stage} {seconds:.2f}s' for stage, seconds in services.startup.items())
+  )
 
   # Send some alerts if there are service issues
 
@@ -83,72 +556,37 @@ def main():
 
   if not sp.connection_ok:
     log_error('Unable to connect to Sharepoint Graph API')
-    sc.update_scheduled_job('Failed')
+    if services.shard:
+      message = 'Unable to connect to Sharepoint Graph API'
+      shards.write_summary(args.site, False, [message], {})
+    else:
+      sc.update_scheduled_job('Failed')
     slack.alert(
       '*Sharepoint Discovery failed*: Unable to connect to Sharepoint Graph API'
     )
     raise SystemExit()
 
-  sp_lists = [
-    'Service Areas',
-    'Product Set',
-    'Teams',
-    'Service Owners',
-    'Product Managers',
-    'Delivery Managers',
-    'Lead Developers',
-    'Products and Teams Main List',
-    'Technical Architects',
-    'Principal Technical Architect',
-  ]
-  sp.load_sharepoint_lists(sp_lists)
+  # Writes an interrupted run left without an outcome are replayed first
+  resume_messages = services.journal.recover(services.writer, sc) if services.journal else []
 
   try:
-    # Process Teams
-    log_info_u('Processing teams')
-    processed_teams = teams.process_sc_teams(services) or []
-
-    # # Process Product Sets
-    log_info_u('Processing product sets')
-    processed_product_sets = productSets.process_sc_product_sets(services) or []
-
-    # # Process Service areas
-    log_info_u('Processing service areas')
-    processed_service_area = serviceAreas.process_sc_service_areas(services) or []
+    if args.watch:
+      from includes import watch
 
-    # Process products
-    log_info_u('Batch processing products')
-    processed_products = products.process_sc_products(services) or []
+      def watch_sync(services, changed_lists):
+        if changed_lists is None:
+          # A reconcile reads the catalogue afresh as well
+          services.sc.reset()
+        sync(services, changed_lists, resume_messages if changed_lists is None else ())
+        resume_messages.clear()
 
-    # Combine output of all the processes
-    summary_header = '*SharePoint Discovery Summary*'
-    processed_messages = [summary_header]
-    processed_messages.extend(processed_teams)
-    processed_messages.extend(processed_product_sets)
-    processed_messages.extend(processed_service_area)
-    processed_messages.extend(processed_products)
-    generated_by = '_(generated by <https://github.com/ministryofjustice/hmpps-sharepoint-discovery|hmpps-sharepoint-discovery>)_'
-    processed_messages.append(generated_by)
-    log_info('Processing complete, preparing to send Slack notification if required.')
-    log_info(f'Processed messages: {processed_messages}')
-
-    if should_send_slack_notification(processed_messages):
-      log_info('Sending Slack notification')
-      slack.notify('\n'.join(processed_messages))
+      if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, lambda *_: watch.stopping.set())
+      watch.watch(services, watch_sync, sp_lists)
     else:
-      log_info('No records processed, not sending Slack notification')
-
-  except Exception as e:
-    log_error(f'Sharepoint discovery job failed with error: {e}')
-    slack.alert(f'*Sharepoint Discovery failed*: {e}')
-    log_error(f'Sharepoint discovery job failed with error: {e}')
-
-  if job.error_messages:
-    sc.update_scheduled_job('Errors')
-    log_info('SharePoint discovery job completed  with errors.')
-  else:
-    sc.update_scheduled_job('Succeeded')
-    log_info('SharePoint discovery job completed successfully.')
+      sync(services, resume_messages=resume_messages)
+  finally:
+    services.writer.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,107 @@
+"""Fixtures that run the sync against the local stand-in (benchmarks/standin.py).
+
+The hmpps Slack and ServiceCatalogue clients are replaced by recorders, everything
+else is the job's own code talking HTTP to the stand-in.
+"""
+
+import pytest
+
+import includes.sharepoint
+import processes.product_sets as productSets
+import processes.products as products
+import processes.service_areas as serviceAreas
+import processes.teams as teams
+from includes.catalogue import CatalogueSnapshot
+from includes.catalogue_api import CatalogueAPI
+from includes.catalogue_writer import CatalogueWriter, write_workers
+from includes.field_mapping import list_columns
+from includes.journal import Journal
+from includes.selection import everything
+from includes.sharepoint import SharePointLists
+from includes.state import StateStore
+from includes.xref import CrossReference
+
+pytest_plugins = ['benchmarks.standin']
+
+
+class Slack:
+  def __init__(self):
+    self.notifications = []
+    self.alerts = []
+
+  def notify(self, message):
+    self.notifications.append(message)
+
+  def alert(self, message):
+    self.alerts.append(message)
+
+
+class ServiceCatalogue:
+  """The parts of the hmpps client the job uses besides reads and writes."""
+
+  def __init__(self, url):
+    self.url = url
+    self.api_headers = None
+    self.connection_ok = True
+    self.job_statuses = []
+
+  def update_scheduled_job(self, status):
+    self.job_statuses.append(status)
+
+
+class Services:
+  """The job's services (sharepoint_discovery.Services) pointed at the stand-in."""
+
+  def __init__(
+    self, server, state_path, selection=everything, journal=True, incremental=False
+  ):
+    self.selection = selection
+    self.shard = False
+    self.startup = {}
+    self.state = StateStore(state_path)
+    self.slack = Slack()
+    self.service_catalogue = ServiceCatalogue(
+      server.environment()['SERVICE_CATALOGUE_API_ENDPOINT']
+    )
+    api = CatalogueAPI(self.service_catalogue, pool_size=write_workers + 1)
+    self.sc = CatalogueSnapshot(self.service_catalogue, api=api, state=self.state)
+    self.journal = Journal(self.state) if journal else None
+    self.writer = CatalogueWriter(
+      self.sc, api=api, rate=0, backoff=0, journal=self.journal
+    )
+    self.xref = CrossReference(self.state)
+    self.sp = SharePointLists(
+      'standin',
+      state=self.state,
+      incremental=incremental,
+      columns=list_columns(
+        {
+          'Teams': teams.team_schema,
+          'Product Set': productSets.product_set_schema,
+          'Service Areas': serviceAreas.service_area_schema,
+          products.products_list: products.product_schema,
+        }
+      ),
+    )
+
+  def close(self):
+    self.writer.close()
+    self.state.close()
+
+
+@pytest.fixture
+def discovery(standin, tmp_path, monkeypatch):
+  """Builds services against the stand-in, sharing a state store by default."""
+  monkeypatch.setattr(
+    includes.sharepoint, 'graph_url', standin.environment()['GRAPH_API_URL']
+  )
+  built = []
+
+  def build(state_name='state.db', **kwargs):
+    services = Services(standin, str(tmp_path / state_name), **kwargs)
+    built.append(services)
+    return services
+
+  yield build
+  for services in built:
+    services.close()
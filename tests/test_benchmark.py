@@ -0,0 +1,27 @@
+from benchmarks.run import compare
+
+
+def results(seconds, calls):
+  return {
+    'scenarios': [
+      {
+        'size': 1000,
+        'churn': 0.01,
+        'total_seconds': seconds,
+        'api_calls': {'get': calls},
+      }
+    ]
+  }
+
+
+def test_slower_runs_are_reported_but_not_regressions():
+  regressions, timings = compare(results(2.0, 30), results(1.0, 30), 0.25)
+
+  assert regressions == []
+  assert timings == ['size=1000 churn=0.01 total_seconds: 1.0 -> 2.0 (+100%)']
+
+
+def test_more_api_calls_are_regressions():
+  regressions, _ = compare(results(1.0, 40), results(1.0, 30), 0.25)
+
+  assert regressions == ['size=1000 churn=0.01 api_calls: 30 -> 40']
@@ -0,0 +1,156 @@
+import pytest
+
+from includes.catalogue_api import CatalogueAPIError
+from includes.catalogue_writer import CatalogueWriter
+
+
+class Snapshot:
+  def record_added(self, table, data, result):
+    pass
+
+  def record_updated(self, table, document_id, data):
+    pass
+
+  def record_deleted(self, table, document_id):
+    pass
+
+
+class FlakyAPI:
+  """Fails each call with the next of `errors`, then succeeds."""
+
+  def __init__(self, *errors, existing=()):
+    self.errors = list(errors)
+    self.existing = list(existing)
+    self.calls = 0
+    self.lookups = 0
+
+  def _call(self, result=None):
+    self.calls += 1
+    if self.errors:
+      raise self.errors.pop(0)
+    return result
+
+  def add(self, table, data):
+    return self._call({'data': {**data, 'documentId': 'doc1'}})
+
+  def update(self, table, document_id, data):
+    return self._call({'data': data})
+
+  def delete(self, table, document_id):
+    return self._call()
+
+  def find(self, table, field, value):
+    self.lookups += 1
+    return [record for record in self.existing if record.get(field) == value]
+
+
+@pytest.fixture
+def writer():
+  built = []
+
+  def build(api):
+    built.append(
+      CatalogueWriter(Snapshot(), api=api, workers=2, rate=0, retries=3, backoff=0)
+    )
+    return built[-1]
+
+  yield build
+  for catalogue_writer in built:
+    catalogue_writer.close()
+
+
+@pytest.mark.parametrize('status_code', [429, 500, 503])
+def test_throttled_and_server_errors_are_retried(writer, status_code):
+  api = FlakyAPI(CatalogueAPIError('busy', status_code=status_code))
+  catalogue_writer = writer(api)
+  mutation = catalogue_writer.update('products', 'doc1', {'name': 'x'})
+
+  assert catalogue_writer.wait([mutation]) == []
+  assert api.calls == 2
+
+
+def test_rejected_writes_are_not_retried(writer):
+  api = FlakyAPI(CatalogueAPIError('bad request', status_code=400))
+  catalogue_writer = writer(api)
+  mutation = catalogue_writer.add('products', {'p_id': 'PRA00001'})
+
+  assert catalogue_writer.wait([mutation]) == [mutation]
+  assert api.calls == 1
+
+
+def test_retries_give_up(writer):
+  api = FlakyAPI(*[CatalogueAPIError('busy', status_code=503)] * 5)
+  catalogue_writer = writer(api)
+  mutation = catalogue_writer.delete('teams', 'doc1')
+
+  assert catalogue_writer.wait([mutation]) == [mutation]
+  assert api.calls == 4
+
+
+def test_writes_depending_on_a_failed_add_are_not_sent(writer):
+  api = FlakyAPI(CatalogueAPIError('bad request', status_code=400))
+  catalogue_writer = writer(api)
+  parent = catalogue_writer.add('products', {'p_id': 'PRA00001'})
+  child = catalogue_writer.add('products', {'p_id': 'PRA00002'}, after=[parent])
+
+  assert catalogue_writer.wait([parent, child]) == [parent, child]
+  assert api.calls == 1
+
+
+def test_finished_writes_are_not_kept(writer):
+  catalogue_writer = writer(FlakyAPI())
+  first = catalogue_writer.update('products', 'doc1', {'name': 'x'})
+  second = catalogue_writer.update('products', 'doc1', {'name': 'y'})
+
+  assert catalogue_writer.wait([first, second]) == []
+  assert catalogue_writer.last_by_key == {}
+
+
+def lost():
+  return CatalogueAPIError('connection reset')
+
+
+def test_updates_without_a_response_are_retried(writer):
+  api = FlakyAPI(lost())
+  catalogue_writer = writer(api)
+  mutation = catalogue_writer.update('products', 'doc1', {'name': 'x'})
+
+  assert catalogue_writer.wait([mutation]) == []
+  assert api.calls == 2
+
+
+def test_adds_without_a_response_are_not_repeated_once_found(writer):
+  api = FlakyAPI(lost(), existing=[{'p_id': 'PRA00001', 'documentId': 'doc7'}])
+  catalogue_writer = writer(api)
+  mutation = catalogue_writer.add('products', {'p_id': 'PRA00001'})
+
+  assert catalogue_writer.wait([mutation]) == []
+  assert api.calls == 1
+  assert mutation.result == {'data': {'p_id': 'PRA00001', 'documentId': 'doc7'}}
+
+
+def test_adds_without_a_response_are_retried_when_missing(writer):
+  api = FlakyAPI(lost())
+  catalogue_writer = writer(api)
+  mutation = catalogue_writer.add('products', {'p_id': 'PRA00001'})
+
+  assert catalogue_writer.wait([mutation]) == []
+  assert (api.calls, api.lookups) == (2, 1)
+
+
+def test_adds_without_a_response_or_stable_id_are_not_retried(writer):
+  api = FlakyAPI(lost())
+  catalogue_writer = writer(api)
+  mutation = catalogue_writer.add('scheduled-jobs', {'name': 'discovery'})
+
+  assert catalogue_writer.wait([mutation]) == [mutation]
+  assert api.calls == 1
+
+
+def test_retried_delete_of_a_deleted_record_succeeds(writer):
+  api = FlakyAPI(lost(), CatalogueAPIError('not found', status_code=404))
+  catalogue_writer = writer(api)
+  mutation = catalogue_writer.delete('teams', 'doc1')
+
+  assert catalogue_writer.wait([mutation]) == []
+  assert api.calls == 2
@@ -0,0 +1,101 @@
+import threading
+
+import sharepoint_discovery
+
+
+def by_key(records, key):
+  return {record.get(key): record for record in records.values()}
+
+
+def interrupt(services, standin):
+  """Leaves the journal as a run killed after its teams phase, with writes in flight."""
+  journal = services.journal
+  journal.begin()
+  products = by_key(standin.catalogue.collection('products'), 'p_id')
+  state = services.state
+  # Sent and applied, but the outcome was never recorded
+  state.journal_add(
+    journal.run_id,
+    'add',
+    'products',
+    None,
+    {'p_id': 'PRA00001', 'name': 'Product 1'},
+    'Product PRA00001',
+  )
+  # Never sent
+  state.journal_add(
+    journal.run_id,
+    'add',
+    'teams',
+    None,
+    {'t_id': 'TM09999', 'name': 'Interrupted'},
+    'Team TM09999',
+  )
+  state.journal_add(
+    journal.run_id,
+    'update',
+    'products',
+    products['PRA00002']['documentId'],
+    {'name': 'Interrupted'},
+    'Product PRA00002',
+  )
+  journal.phase_done('teams')
+
+
+def test_resume_replays_pending_writes_and_skips_finished_phases(standin, discovery):
+  first = discovery()
+  sharepoint_discovery.sync(first)
+  interrupt(first, standin)
+  products_before = len(standin.catalogue.collection('products'))
+
+  services = discovery()
+  assert services.journal.resumed
+  messages = services.journal.recover(services.writer, services.sc)
+  assert 'Writes from the interrupted run processed: 2' in messages
+  # The add that reached the catalogue is not made twice
+  assert len(standin.catalogue.collection('products')) == products_before
+  teams = by_key(standin.catalogue.collection('teams'), 't_id')
+  assert 'TM09999' in teams
+
+  standin.requests.clear()
+  phases = {phase.name: phase for phase in sharepoint_discovery.sync(services)}
+
+  # The teams phase finished before the interruption, so the team it would delete stays
+  assert phases['teams'].messages == []
+  assert 'TM09999' in by_key(standin.catalogue.collection('teams'), 't_id')
+  # The interrupted products phase runs again and corrects the replayed update
+  products = by_key(standin.catalogue.collection('products'), 'p_id')
+  assert products['PRA00002']['name'] == 'Product 2'
+  assert standin.requests['sc_put'] == 1
+  assert services.state.meta('journal:run') == ''
+
+
+def test_phases_finishing_together_are_all_recorded(discovery):
+  journal = discovery().journal
+  names = [f'phase{i}' for i in range(20)]
+  threads = [
+    threading.Thread(target=journal.phase_done, args=(name,)) for name in names
+  ]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  assert journal.completed_phases() == set(names)
+
+
+def test_replayed_delete_of_a_deleted_record_is_done(standin, discovery):
+  first = discovery()
+  area = next(iter(standin.catalogue.collection('service-areas').values()))
+  first.state.journal_add(
+    first.journal.run_id, 'delete', 'service-areas', 'doc09999999', None, 'Gone'
+  )
+  first.state.journal_add(
+    first.journal.run_id, 'delete', 'service-areas', area['documentId'], None, 'Area'
+  )
+
+  services = discovery()
+  messages = services.journal.recover(services.writer, services.sc)
+
+  assert messages == ['Writes from the interrupted run processed: 2']
+  assert area['documentId'] not in standin.catalogue.collection('service-areas')
@@ -0,0 +1,45 @@
+import hmpps
+
+from includes.sharepoint import HmppsSharePointLists
+
+
+class SharePoint:
+  """The hmpps client, holding each list it loads as Graph JSON."""
+
+  # {list name: items}, set by each test
+  lists = None
+
+  def __init__(self, site_name=None):
+    self.connection_ok = True
+    self.data = {}
+    self.dict = {}
+
+  def load_sharepoint_lists(self, list_names):
+    for list_name in list_names:
+      items = self.lists[list_name]
+      self.data[list_name] = {'value': items}
+      self.dict[list_name] = {item['id']: item for item in items}
+
+
+def test_hmpps_loader_releases_the_raw_lists(monkeypatch):
+  monkeypatch.setattr(hmpps, 'SharePoint', SharePoint)
+  monkeypatch.setattr(
+    SharePoint,
+    'lists',
+    {
+      'Teams': [{'id': '1', '@odata.etag': 'x', 'fields': {'Team': 'Team 1'}}],
+      'Products': [{'id': '2', 'fields': {'Product': 'Product 2'}}],
+    },
+  )
+  sp = HmppsSharePointLists(
+    'site', list_aliases={'Products and Teams Main List': 'Products'}
+  )
+
+  sp.load_sharepoint_lists(['Teams', 'Products and Teams Main List'])
+
+  assert sp.client.data == {}
+  assert sp.client.dict == {}
+  assert sp.dict['Teams']['1']['fields']['Team'] == 'Team 1'
+  [product] = sp.data['Products and Teams Main List']['value']
+  assert product['fields']['Product'] == 'Product 2'
+  assert sp.changed_lists == {'Teams', 'Products and Teams Main List'}
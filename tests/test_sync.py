@@ -0,0 +1,181 @@
+import sharepoint_discovery
+from benchmarks.datasets import apply_churn, generate_lists
+from benchmarks.standin import GraphData
+from includes.selection import Selection
+
+
+def writes(server):
+  return sum(server.requests[f'sc_{method}'] for method in ('post', 'put', 'delete'))
+
+
+def test_first_run_adds_every_record(standin, discovery):
+  services = discovery()
+  sharepoint_discovery.sync(services)
+  services.writer.close()
+
+  assert services.service_catalogue.job_statuses == ['Succeeded']
+  assert len(standin.catalogue.collection('products')) == 100
+  assert len(standin.catalogue.collection('teams')) == len(generate_lists(100)['Teams'])
+  # Relations are reported by name
+  [summary] = services.slack.notifications
+  assert "'team': 'Team " in summary
+  assert "'doc0" not in summary
+
+
+def test_unchanged_rerun_makes_no_writes(standin, discovery):
+  sharepoint_discovery.sync(discovery())
+  standin.requests.clear()
+
+  services = discovery()
+  sharepoint_discovery.sync(services)
+
+  assert writes(standin) == 0
+  assert services.service_catalogue.job_statuses == ['Succeeded']
+  assert services.slack.notifications == []
+
+
+def test_products_are_added_after_their_parents(standin, discovery):
+  lists = generate_lists(100)
+  # Sub-products listed before their parents
+  lists['Products and Teams Main List'].reverse()
+  standin.graph = GraphData(lists)
+  sharepoint_discovery.sync(discovery())
+
+  products = standin.catalogue.collection('products')
+  sub_products = [record for record in products.values() if record.get('parent')]
+  assert sub_products
+  for record in sub_products:
+    parent = products[record['parent']]
+    # documentIds are issued in the order records are added
+    assert parent['id'] < record['id']
+
+
+def test_churn_writes_only_the_changes(standin, discovery):
+  lists = generate_lists(100)
+  sharepoint_discovery.sync(discovery())
+  standin.graph.set_lists(apply_churn(lists, 0.05))
+  standin.requests.clear()
+
+  services = discovery()
+  sharepoint_discovery.sync(services)
+
+  # Up to 5 products changed, 2 added and 2 teams removed
+  assert standin.requests['sc_post'] == 2
+  assert standin.requests['sc_delete'] == 2
+  assert 0 < standin.requests['sc_put'] <= 5
+  assert services.service_catalogue.job_statuses == ['Succeeded']
+
+
+def test_targeted_run_writes_only_the_selected_records(standin, discovery):
+  lists = generate_lists(100)
+  sharepoint_discovery.sync(discovery())
+  for product in lists['Products and Teams Main List'][:2]:
+    product['fields']['field_7'] = 'Retired'
+  standin.graph.set_lists(lists)
+  standin.requests.clear()
+
+  services = discovery(selection=Selection.parse('products', 'PRA00001'))
+  sharepoint_discovery.sync(services)
+
+  assert writes(standin) == 1
+  products = {
+    record['p_id']: record
+    for record in standin.catalogue.collection('products').values()
+  }
+  assert products['PRA00001']['phase'] == 'Retired'
+  assert products['PRA00002']['phase'] != 'Retired'
+  assert services.service_catalogue.job_statuses == ['Succeeded']
+
+
+def test_targeted_products_run_links_relations_without_a_state_store(
+  standin, discovery
+):
+  lists = generate_lists(100)
+  sharepoint_discovery.sync(discovery())
+  product = lists['Products and Teams Main List'][0]
+  team = product['fields']['TeamLookupId']
+  product['fields']['TeamLookupId'] = '2' if team == '1' else '1'
+  standin.graph.set_lists(lists)
+  standin.requests.clear()
+
+  # A new store has no cross-reference for the teams the run leaves out
+  services = discovery(
+    state_name='new.db', selection=Selection.parse('products', 'PRA00001')
+  )
+  sharepoint_discovery.sync(services)
+
+  teams = {
+    record['documentId']: record['name']
+    for record in standin.catalogue.collection('teams').values()
+  }
+  [record] = [
+    record
+    for record in standin.catalogue.collection('products').values()
+    if record['p_id'] == 'PRA00001'
+  ]
+  assert teams[record['team']] == f'Team {product["fields"]["TeamLookupId"]}'
+  assert writes(standin) == 1
+  assert services.service_catalogue.job_statuses == ['Succeeded']
+  assert not services.slack.alerts
+
+
+def test_targeted_products_run_drops_links_to_deleted_records(standin, discovery):
+  lists = generate_lists(100)
+  sharepoint_discovery.sync(discovery())
+  products = standin.catalogue.collection('products')
+  [product] = [record for record in products.values() if record['p_id'] == 'PRA00001']
+  # The team is deleted and recreated, so the stored link points at no record
+  stale = product['team']
+  team = standin.catalogue.delete('teams', stale)
+  # As Strapi does, relations to the deleted record are cleared
+  product['team'] = None
+  standin.catalogue.add('teams', {k: v for k, v in team.items() if k != 'documentId'})
+  lists['Products and Teams Main List'][0]['fields']['field_7'] = 'Retired'
+  standin.graph.set_lists(lists)
+
+  services = discovery(selection=Selection.parse('products', 'PRA00001'))
+  sharepoint_discovery.sync(services)
+
+  assert product['phase'] == 'Retired'
+  assert product['team'] is None
+  assert services.service_catalogue.job_statuses == ['Errors']
+
+
+def test_relation_changes_are_reported_by_name(standin, discovery):
+  lists = generate_lists(100)
+  sharepoint_discovery.sync(discovery())
+  product = lists['Products and Teams Main List'][0]
+  team = product['fields']['TeamLookupId']
+  product['fields']['TeamLookupId'] = '2' if team == '1' else '1'
+  standin.graph.set_lists(lists)
+
+  services = discovery()
+  sharepoint_discovery.sync(services)
+
+  [summary] = services.slack.notifications
+  new_team = product['fields']['TeamLookupId']
+  assert f'team: Team {team} -> Team {new_team}' in summary
+
+
+def test_collections_found_in_sync_are_not_compared_again(standin, discovery):
+  sharepoint_discovery.sync(discovery())
+  # Nothing to change, so the collection digests are saved
+  sharepoint_discovery.sync(discovery())
+
+  phases = {phase.name: phase for phase in sharepoint_discovery.sync(discovery())}
+
+  assert phases['teams'].messages == [
+    'Teams unchanged since the last successful run, not compared'
+  ]
+  assert 'Product Sets unchanged' in phases['product_sets'].messages[0]
+  assert phases['products'].messages == ['Products in Service Catalogue processed: 0']
+
+
+def test_state_is_only_kept_when_something_reads_it_back(monkeypatch):
+  for setting in ('state_path_set', 'incremental', 'state_cache', 'journal_requested'):
+    monkeypatch.setattr(sharepoint_discovery, setting, False)
+  assert not sharepoint_discovery.keeps_state()
+  assert sharepoint_discovery.keeps_state(watching=True)
+
+  monkeypatch.setattr(sharepoint_discovery, 'incremental', True)
+  assert sharepoint_discovery.keeps_state()
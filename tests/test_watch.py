@@ -0,0 +1,88 @@
+import json
+import socket
+import threading
+import time
+from functools import partial
+from urllib.request import Request, urlopen
+
+import pytest
+
+import sharepoint_discovery
+from benchmarks.datasets import generate_lists
+from benchmarks.standin import list_id
+from includes import watch
+
+
+def free_port():
+  with socket.socket() as s:
+    s.bind(('127.0.0.1', 0))
+    return s.getsockname()[1]
+
+
+def post(url, notifications):
+  request = Request(
+    url,
+    data=json.dumps({'value': notifications}).encode(),
+    headers={'Content-Type': 'application/json'},
+    method='POST',
+  )
+  with urlopen(request, timeout=10):
+    pass
+
+
+def wait_for(condition, timeout=30):
+  deadline = time.monotonic() + timeout
+  while not condition():
+    if time.monotonic() > deadline:
+      pytest.fail('timed out')
+    time.sleep(0.05)
+
+
+@pytest.fixture
+def watching(standin, discovery, monkeypatch):
+  """Runs watch mode in the background; yields its syncs as (lists, phases run)."""
+  port = free_port()
+  url = f'http://127.0.0.1:{port}/notifications'
+  monkeypatch.setattr(watch, 'notification_url', url)
+  monkeypatch.setattr(watch, 'stopping', threading.Event())
+  monkeypatch.setattr(
+    watch, 'ChangeQueue', partial(watch.ChangeQueue, debounce=0.2, max_delay=2)
+  )
+  services = discovery(incremental=True)
+  syncs = []
+
+  def sync(services, changed_lists):
+    phases = sharepoint_discovery.sync(services, changed_lists)
+    syncs.append((changed_lists, [phase.name for phase in phases]))
+
+  thread = threading.Thread(
+    target=watch.watch,
+    args=(services, sync, sharepoint_discovery.sp_lists, port),
+    daemon=True,
+  )
+  thread.start()
+  # The initial reconcile has run once every list is subscribed
+  wait_for(lambda: syncs and len(standin.subscriptions) == len(standin.graph.names))
+  yield url, syncs
+  watch.stopping.set()
+  thread.join(timeout=10)
+
+
+def test_notified_changes_run_only_the_affected_phases(standin, watching):
+  url, syncs = watching
+  lists = generate_lists(100)
+  lists['Teams'][0]['fields']['Team'] = 'Renamed team'
+
+  # Graph sends the subscription's clientState, a post without it is ignored
+  [products] = [
+    subscription['resource']
+    for subscription in standin.subscriptions.values()
+    if subscription['resource'].endswith(list_id('Products and Teams Main List'))
+  ]
+  post(url, [{'resource': products, 'changeType': 'updated'}])
+  standin.set_lists(lists)
+  wait_for(lambda: len(syncs) == 2)
+
+  assert syncs[1] == ({'Teams'}, ['teams', 'products'])
+  names = {record['name'] for record in standin.catalogue.collection('teams').values()}
+  assert 'Renamed team' in names